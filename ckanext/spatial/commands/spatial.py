@@ -1,11 +1,15 @@
+import os
 import sys
 import re
+import time
+import multiprocessing
 from pprint import pprint
 import logging
 
 from ckan.lib.cli import CkanCommand
 from ckan.lib.helpers import json
-from ckanext.spatial.lib import save_package_extent
+from sqlalchemy import text as sql_text
+from ckanext.spatial.lib import parse_package_extent, save_parsed_package_extents
 log = logging.getLogger(__name__)
 
 class Spatial(CkanCommand):
@@ -17,9 +21,38 @@ class Spatial(CkanCommand):
             and configured in the database.
             You can provide the SRID of the geometry column. Default is 4326.
 
-        spatial extents
+        spatial migrate
+            Adds the columns introduced by newer versions of the extension
+            to an existing package_extent table, and fills them in when
+            possible. Run it after upgrading, before starting CKAN.
+
+        spatial extents [--batch-size=N] [--workers=N] [--resume] [--force]
             Creates or updates the extent geometry column for datasets with
-            an extent defined in the 'spatial' extra.
+            an extent defined in the 'spatial' extra. Extents with the same
+            fingerprint as the stored one are skipped, unless --force is
+            used (eg to repair geometries changed on the database).
+            Datasets are processed in batches of 1000 (--batch-size), with
+            the geometries parsed on as many processes as CPUs (--workers).
+            The progress is saved after each batch to a checkpoint file
+            (--checkpoint-file), so an interrupted run can be continued with
+            --resume.
+
+        spatial simplify [--batch-size=N] [--tolerance=X]
+            Creates or updates the simplified geometries used to speed up
+            the spatial queries, for extents not simplified with the
+            current tolerance (the ckanext.spatial.simplify_tolerance
+            config option, or --tolerance).
+
+        spatial envelopes
+            Writes the file with the extent envelopes used to rank datasets
+            with NumPy (see ckanext.spatial.use_numpy_ranking). Run it from
+            cron if ckanext.spatial.ranking.write_in_background is False.
+
+        spatial benchmark-parsing <path> [--rounds=N]
+            Compares the time needed to extract the values of ISO19139
+            documents (a file, or all .xml files in a directory) with the
+            compiled XPath expressions and evaluating the search paths
+            every time (--rounds times each, 10 by default).
       
     The commands should be run from the ckanext-spatial directory and expect
     a development.ini file to be present. Most of the time you will
@@ -34,7 +67,35 @@ class Spatial(CkanCommand):
     max_args = 2 
     min_args = 0
 
+    def __init__(self, name):
+        super(Spatial, self).__init__(name)
+        self.parser.add_option('-b', '--batch-size', dest='batch_size',
+                               type='int', default=1000,
+                               help='Number of datasets saved on each commit')
+        self.parser.add_option('-w', '--workers', dest='workers',
+                               type='int', default=multiprocessing.cpu_count(),
+                               help='Number of processes parsing the geometries')
+        self.parser.add_option('--resume', dest='resume',
+                               action='store_true', default=False,
+                               help='Continue from the last saved checkpoint')
+        self.parser.add_option('-f', '--force', dest='force',
+                               action='store_true', default=False,
+                               help='Rewrite the extents even if they have not changed')
+        self.parser.add_option('--checkpoint-file', dest='checkpoint_file',
+                               default='spatial_extents.checkpoint',
+                               help='File where the progress is saved')
+        self.parser.add_option('-t', '--tolerance', dest='tolerance',
+                               type='float', default=None,
+                               help='Tolerance used to simplify the extents')
+        self.parser.add_option('-r', '--rounds', dest='rounds',
+                               type='int', default=10,
+                               help='Times each document is parsed on benchmarks')
+
     def command(self):
+        if self.args and self.args[0] == 'migrate':
+            # Don't fail on the missing columns when loading the config
+            from ckanext.spatial.model import package_extent
+            package_extent.check_columns = False
         self._load_config()
         print ''
 
@@ -44,8 +105,16 @@ class Spatial(CkanCommand):
         cmd = self.args[0]
         if cmd == 'initdb':
             self.initdb()    
+        elif cmd == 'migrate':
+            self.migrate()
         elif cmd == 'extents':
             self.update_extents()
+        elif cmd == 'simplify':
+            self.simplify_extents()
+        elif cmd == 'envelopes':
+            self.write_envelopes()
+        elif cmd == 'benchmark-parsing':
+            self.benchmark_parsing()
         else:
             print 'Command %s not recognized' % cmd
 
@@ -61,37 +130,201 @@ class Spatial(CkanCommand):
 
         print 'DB tables created'
 
+    def migrate(self):
+        from ckanext.spatial.model.package_extent import migrate
+
+        added = migrate()
+        if added:
+            print 'Added columns: %s' % ', '.join(added)
+        else:
+            print 'The package_extent table is up to date'
+
     def update_extents(self):
-        from ckan.model import PackageExtra, Package, Session
-        conn = Session.connection()
-        packages = [extra.package \
-                    for extra in \
-                    Session.query(PackageExtra).filter(PackageExtra.key == 'spatial').all()]
+        from ckan.model import Session, meta
+        from ckan.lib.base import config
+
+        batch_size = self.options.batch_size
+        checkpoint_file = self.options.checkpoint_file
+        db_srid = int(config.get('ckan.spatial.srid', '4326'))
+
+        last_package_id = u''
+        if self.options.resume and os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                last_package_id = f.read().strip().decode('utf8')
+            print 'Resuming after package %s' % last_package_id
+
+        # Workers only parse the geometries, they never use the database
+        pool = None
+        if self.options.workers > 1:
+            pool = multiprocessing.Pool(self.options.workers)
+
+        # Rows are streamed with a server side cursor on a separate
+        # connection, so the extents can be committed as they are saved
+        connection = meta.engine.connect()
+        rows = connection.execution_options(stream_results=True).execute(
+            sql_text('''SELECT package_extra.package_id, package_extra.value
+                        FROM package_extra, package
+                        WHERE package_extra.package_id = package.id
+                            AND package.state = 'active'
+                            AND package_extra.key = 'spatial'
+                            AND package_extra.state = 'active'
+                            AND package_extra.package_id > :last_package_id
+                        ORDER BY package_extra.package_id'''),
+            last_package_id=last_package_id)
 
         errors = []
         count = 0
-        for package in packages:
-            try:
-                value = package.extras['spatial']
-                log.debug('Received: %r' % value)
-                geometry = json.loads(value)
-
-                count += 1
-            except ValueError,e:
-                errors.append(u'Package %s - Error decoding JSON object: %s' % (package.id,str(e)))
-            except TypeError,e:
-                errors.append(u'Package %s - Error decoding JSON object: %s' % (package.id,str(e)))
-
-            save_package_extent(package.id,geometry)
-        
+        total = 0
+        t0 = time.time()
+        try:
+            while True:
+                batch = rows.fetchmany(batch_size)
+                if not batch:
+                    break
+                batch = [(package_id, value, db_srid) for package_id, value in batch]
+                if pool:
+                    parsed = pool.map(_parse_extent, batch)
+                else:
+                    parsed = map(_parse_extent, batch)
+
+                extents = {}
+                for package_id, values, error in parsed:
+                    if error:
+                        errors.append(u'Package %s - %s' % (package_id, error))
+                    else:
+                        extents[package_id] = values
+                save_parsed_package_extents(extents, self.options.force)
+                Session.commit()
+
+                count += len(extents)
+                total += len(batch)
+                last_package_id = batch[-1][0]
+                with open(checkpoint_file, 'w') as f:
+                    f.write(last_package_id.encode('utf8'))
+
+                elapsed = time.time() - t0
+                print '%i packages processed (%.0f rows/s)' % (
+                    total, total / elapsed if elapsed else 0)
+        finally:
+            rows.close()
+            connection.close()
+            if pool:
+                pool.terminate()
+
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
 
-        Session.commit()
-        
         if errors:
             msg = 'Errors were found:\n%s' % '\n'.join(errors)
             print msg
 
-        msg = "Done. Extents generated for %i out of %i packages" % (count,len(packages))
+        msg = "Done. Extents generated for %i out of %i packages" % (count,total)
 
         print msg
 
+    def simplify_extents(self):
+        from ckan.model import Session
+        from ckanext.spatial.lib import (get_simplify_tolerance,
+                                         simplify_package_extents)
+
+        tolerance = self.options.tolerance
+        if tolerance is None:
+            tolerance = get_simplify_tolerance()
+
+        count = 0
+        total = 0
+        last_package_id = u''
+        t0 = time.time()
+        while True:
+            package_ids = [row[0] for row in Session.execute(
+                '''SELECT package_id FROM package_extent
+                   WHERE package_id > :last_package_id
+                       AND simplify_tolerance IS DISTINCT FROM :tolerance
+                   ORDER BY package_id LIMIT :limit''',
+                {'last_package_id': last_package_id,
+                 'tolerance': tolerance if tolerance > 0 else None,
+                 'limit': self.options.batch_size})]
+            if not package_ids:
+                break
+            count += simplify_package_extents(package_ids, tolerance)
+            Session.commit()
+
+            total += len(package_ids)
+            last_package_id = package_ids[-1]
+
+            elapsed = time.time() - t0
+            print '%i extents processed (%.0f rows/s)' % (
+                total, total / elapsed if elapsed else 0)
+
+        print 'Done. %i out of %i extents simplified (tolerance %s)' % (
+            count, total, tolerance)
+
+    def write_envelopes(self):
+        from ckanext.spatial.lib.ranking import write_envelopes, get_directory
+
+        count = write_envelopes()
+        print 'Done. %i envelopes written to %s' % (count, get_directory())
+
+
+def _parse_extent(row):
+    '''
+    Parses the spatial extra of a package, returning a
+    (package_id, values, error) tuple. Called from the worker processes of
+    the extents command.
+    '''
+    package_id, value, db_srid = row
+    try:
+        geometry = json.loads(value)
+    except (ValueError, TypeError), e:
+        return package_id, None, 'Error decoding JSON object: %s' % str(e)
+    if not geometry:
+        return package_id, None, None
+    try:
+        return package_id, parse_package_extent(geometry, db_srid=db_srid), None
+    except Exception, e:
+        return package_id, None, 'Error creating geometry: %s' % str(e)
+
+    def benchmark_parsing(self):
+        from ckanext.spatial.model import ISODocument, MappedXmlElement
+
+        if len(self.args) < 2:
+            print 'Please provide a file or directory'
+            sys.exit(1)
+        path = self.args[1]
+        if os.path.isdir(path):
+            file_paths = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                          if name.endswith('.xml')]
+        else:
+            file_paths = [path]
+
+        xml_strings = []
+        for file_path in file_paths:
+            with open(file_path, 'r') as f:
+                xml_strings.append(f.read())
+        if not xml_strings:
+            print 'No documents found in %s' % path
+            sys.exit(1)
+
+        def extract():
+            t0 = time.time()
+            for i in xrange(self.options.rounds):
+                for xml_string in xml_strings:
+                    ISODocument(xml_string).read_values()
+            return (time.time() - t0) / (self.options.rounds * len(xml_strings))
+
+        def uncompiled_get_elements(element, tree, xpath):
+            # Previous behaviour, compiling the search path every time
+            return tree.xpath(xpath, namespaces=element.namespaces)
+
+        compiled_get_elements = MappedXmlElement.get_elements
+        MappedXmlElement.get_elements = uncompiled_get_elements
+        try:
+            uncompiled_time = extract()
+        finally:
+            MappedXmlElement.get_elements = compiled_get_elements
+        compiled_time = extract()
+
+        print '%i documents, %i rounds' % (len(xml_strings), self.options.rounds)
+        print 'Time per document: %.2fms uncompiled, %.2fms compiled (%.1fx)' % (
+            uncompiled_time * 1000, compiled_time * 1000,
+            uncompiled_time / compiled_time if compiled_time else 0)
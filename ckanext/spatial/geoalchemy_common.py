@@ -49,7 +49,17 @@ def setup_spatial_table(package_extent_class, db_srid=None):
         package_extent_table = Table(
             'package_extent', meta.metadata,
             Column('package_id', types.UnicodeText, primary_key=True),
-            GeometryExtensionColumn('the_geom', Geometry(2, srid=db_srid))
+            GeometryExtensionColumn('the_geom', Geometry(2, srid=db_srid)),
+            Column('geom_fingerprint', types.UnicodeText),
+            Column('minx', types.Float),
+            Column('miny', types.Float),
+            Column('maxx', types.Float),
+            Column('maxy', types.Float),
+            Column('area', types.Float),
+            GeometryExtensionColumn('the_geom_simplified',
+                                    Geometry(2, srid=db_srid,
+                                             spatial_index=False)),
+            Column('simplify_tolerance', types.Float),
         )
 
         meta.mapper(
@@ -57,6 +67,9 @@ def setup_spatial_table(package_extent_class, db_srid=None):
             package_extent_table,
             properties={'the_geom':
                         GeometryColumn(package_extent_table.c.the_geom,
+                                       comparator=PGComparator),
+                        'the_geom_simplified':
+                        GeometryColumn(package_extent_table.c.the_geom_simplified,
                                        comparator=PGComparator)}
         )
 
@@ -72,6 +85,16 @@ def setup_spatial_table(package_extent_class, db_srid=None):
             Column('package_id', types.UnicodeText, primary_key=True),
             Column('the_geom', Geometry('GEOMETRY', srid=db_srid,
                                         management=management)),
+            Column('geom_fingerprint', types.UnicodeText),
+            Column('minx', types.Float),
+            Column('miny', types.Float),
+            Column('maxx', types.Float),
+            Column('maxy', types.Float),
+            Column('area', types.Float),
+            Column('the_geom_simplified', Geometry('GEOMETRY', srid=db_srid,
+                                                   spatial_index=False,
+                                                   management=management)),
+            Column('simplify_tolerance', types.Float),
         )
 
         meta.mapper(package_extent_class, package_extent_table)
@@ -27,9 +27,10 @@ from ckan.lib.search.index import PackageSearchIndex
 
 from ckanext.harvest.harvesters.base import HarvesterBase
 from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
 from ckanext.spatial.validation import Validators, all_validators
-from ckanext.spatial.model import ISODocument
+from ckanext.spatial.model import ISODocument, parse_xml_string
 from ckanext.spatial.interfaces import ISpatialHarvester
 
 log = logging.getLogger(__name__)
@@ -533,6 +534,19 @@ class SpatialHarvester(HarvesterBase):
 
             return True
 
+        # Skip validation, parsing and updating the package if the document
+        # is the same as the one harvested for the previous object, and the
+        # source settings used to import it have not changed either
+        content_hash = self._get_content_hash(harvest_object)
+        source_hash = self._get_source_hash(harvest_object)
+        if status == 'change' and previous_object and not force_import and \
+                content_hash and \
+                content_hash == self._get_object_extra(previous_object, 'content_hash') and \
+                source_hash == self._get_object_extra(previous_object, 'source_hash'):
+            self._set_object_unchanged(harvest_object, previous_object, context)
+            model.Session.commit()
+            return True
+
         # Check if it is a non ISO document
         original_document = self._get_object_extra(harvest_object, 'original_document')
         original_format = self._get_object_extra(harvest_object, 'original_format')
@@ -552,13 +566,22 @@ class SpatialHarvester(HarvesterBase):
             else:
                 self._save_object_error('Transformation to ISO failed', harvest_object, 'Import')
                 return False
+
+            xml_tree = self._parse_document(harvest_object.content, harvest_object)
+            if xml_tree is None:
+                return False
         else:
             if harvest_object.content is None:
                 self._save_object_error('Empty content for object {0}'.format(harvest_object.id), harvest_object, 'Import')
                 return False
 
+            xml_tree = self._parse_document(harvest_object.content, harvest_object)
+            if xml_tree is None:
+                return False
+
             # Validate ISO document
-            is_valid, profile, errors = self._validate_document(harvest_object.content, harvest_object)
+            is_valid, profile, errors = self._validate_document(harvest_object.content, harvest_object,
+                                                                xml_tree=xml_tree)
             if not is_valid:
                 # If validation errors were found, import will stop unless
                 # configuration per source or per instance says otherwise
@@ -570,7 +593,7 @@ class SpatialHarvester(HarvesterBase):
         # Parse ISO document
         try:
 
-            iso_parser = ISODocument(harvest_object.content)
+            iso_parser = ISODocument(harvest_object.content, xml_tree=xml_tree)
             iso_values = iso_parser.read_values()
         except Exception, e:
             self._save_object_error('Error parsing ISO document for object {0}: {1}'.format(harvest_object.id, str(e)),
@@ -679,35 +702,7 @@ class SpatialHarvester(HarvesterBase):
 
             # Check if the modified date is more recent
             if not force_import and previous_object and harvest_object.metadata_modified_date <= previous_object.metadata_modified_date:
-
-                # Assign the previous job id to the new object to
-                # avoid losing history
-                harvest_object.harvest_job_id = previous_object.job.id
-                harvest_object.add()
-
-                # Delete the previous object to avoid cluttering the object table
-                previous_object.delete()
-
-                # Reindex the corresponding package to update the reference to the
-                # harvest object
-                if ((config.get('ckanext.spatial.harvest.reindex_unchanged', True) != 'False'
-                    or self.source_config.get('reindex_unchanged') != 'False')
-                    and harvest_object.package_id):
-                    context.update({'validate': False, 'ignore_auth': True})
-                    try:
-                        package_dict = logic.get_action('package_show')(context,
-                            {'id': harvest_object.package_id})
-                    except p.toolkit.ObjectNotFound:
-                        pass
-                    else:
-                        for extra in package_dict.get('extras', []):
-                            if extra['key'] == 'harvest_object_id':
-                                extra['value'] = harvest_object.id
-                        if package_dict:
-                            package_index = PackageSearchIndex()
-                            package_index.index_package(package_dict)
-
-                log.info('Document with GUID %s unchanged, skipping...' % (harvest_object.guid))
+                self._set_object_unchanged(harvest_object, previous_object, context)
             else:
                 package_schema = logic.schema.default_update_package_schema()
                 package_schema['tags'] = tag_schema
@@ -726,6 +721,46 @@ class SpatialHarvester(HarvesterBase):
         return True
     ##
 
+    def _set_object_unchanged(self, harvest_object, previous_object, context):
+        '''
+        Replaces the previous harvest object with the provided one when the
+        harvested document has not changed, without updating the dataset.
+        '''
+        harvest_object.current = True
+        if not harvest_object.package_id:
+            harvest_object.package_id = previous_object.package_id
+        if not harvest_object.metadata_modified_date:
+            harvest_object.metadata_modified_date = previous_object.metadata_modified_date
+
+        # Assign the previous job id to the new object to
+        # avoid losing history
+        harvest_object.harvest_job_id = previous_object.job.id
+        harvest_object.add()
+
+        # Delete the previous object to avoid cluttering the object table
+        previous_object.delete()
+
+        # Reindex the corresponding package to update the reference to the
+        # harvest object
+        if ((config.get('ckanext.spatial.harvest.reindex_unchanged', True) != 'False'
+            or self.source_config.get('reindex_unchanged') != 'False')
+            and harvest_object.package_id):
+            context.update({'validate': False, 'ignore_auth': True})
+            try:
+                package_dict = logic.get_action('package_show')(context,
+                    {'id': harvest_object.package_id})
+            except p.toolkit.ObjectNotFound:
+                pass
+            else:
+                for extra in package_dict.get('extras', []):
+                    if extra['key'] == 'harvest_object_id':
+                        extra['value'] = harvest_object.id
+                if package_dict:
+                    package_index = PackageSearchIndex()
+                    package_index.index_package(package_dict)
+
+        log.info('Document with GUID %s unchanged, skipping...' % (harvest_object.guid))
+
     def _is_wms(self, url):
         '''
         Checks if the provided URL actually points to a Web Map Service.
@@ -752,6 +787,78 @@ class SpatialHarvester(HarvesterBase):
                 return extra.value
         return None
 
+    def _set_object_extra(self, harvest_object, key, value):
+        '''
+        Helper function for setting the value of a harvest object extra,
+        creating it if it does not exist. The harvest object needs to be
+        saved afterwards.
+        '''
+        for extra in harvest_object.extras:
+            if extra.key == key:
+                extra.value = value
+                return
+        harvest_object.extras.append(HOExtra(key=key, value=value))
+
+    def _get_previous_object(self, harvest_object):
+        '''
+        Returns the current harvest object with the same guid as the
+        provided one, if any
+        '''
+        if not harvest_object.guid:
+            return None
+        return model.Session.query(HarvestObject) \
+                .filter(HarvestObject.guid==harvest_object.guid) \
+                .filter(HarvestObject.current==True) \
+                .first()
+
+    def _get_content_hash(self, harvest_object):
+        '''
+        Returns the hash of the harvested document (or of the original one
+        if it needs to be transformed to ISO), stored as the `content_hash`
+        extra. It is computed and stored if the fetch stage did not do it.
+        '''
+        content_hash = self._get_object_extra(harvest_object, 'content_hash')
+        if content_hash:
+            return content_hash
+
+        content = harvest_object.content or \
+            self._get_object_extra(harvest_object, 'original_document')
+        if not content:
+            return None
+        content_hash = hashlib.sha1(content.encode('utf8', 'ignore')).hexdigest()
+        self._set_object_extra(harvest_object, 'content_hash', content_hash)
+        return content_hash
+
+    def _get_source_hash(self, harvest_object):
+        '''
+        Returns a hash of the harvest source settings that affect how the
+        documents are imported (the source configuration, its organization
+        and the validation profiles), and stores it as the `source_hash`
+        extra.
+        '''
+        source_dataset = model.Package.get(harvest_object.source.id)
+        settings = json.dumps({
+            'config': harvest_object.source.config,
+            'owner_org': source_dataset.owner_org if source_dataset else None,
+            'validator_profiles': config.get('ckan.spatial.validator.profiles'),
+        }, sort_keys=True)
+        source_hash = hashlib.sha1(settings.encode('utf8')).hexdigest()
+        self._set_object_extra(harvest_object, 'source_hash', source_hash)
+        return source_hash
+
+    def _copy_previous_content(self, harvest_object, previous_object):
+        '''
+        Copies the harvested document and the extras related to it from the
+        previous harvest object, for when the remote document has not been
+        modified.
+        '''
+        harvest_object.content = previous_object.content
+        for key in ('original_document', 'original_format', 'content_hash',
+                    'etag', 'last_modified'):
+            value = self._get_object_extra(previous_object, key)
+            if value is not None:
+                self._set_object_extra(harvest_object, key, value)
+
     def _set_source_config(self, config_str):
         '''
         Loads the source configuration JSON object into a dict for
@@ -793,6 +900,8 @@ class SpatialHarvester(HarvesterBase):
                     if custom_validator not in all_validators:
                         self._validator.add_validator(custom_validator)
 
+            # Compile the schemas now rather than on the first document
+            self._validator.warm_up()
 
         return self._validator
 
@@ -852,6 +961,51 @@ class SpatialHarvester(HarvesterBase):
         url = url.replace(' ', '%20')
         response = requests.get(url, timeout=10)
 
+        return self._response_as_unicode(response)
+
+    def _get_content_if_modified(self, url, harvest_object, previous_object=None):
+        '''
+        Get remote content as unicode (see `_get_content_as_unicode`) unless
+        it has not been modified since it was harvested for the previous
+        object.
+
+        The `ETag` and `Last-Modified` headers of the response are stored as
+        the `etag` and `last_modified` extras of the harvest object, and
+        sent as `If-None-Match` and `If-Modified-Since` on the following
+        harvests. If the server responds with a 304 Not Modified, the
+        document and its extras are copied from the previous object and None
+        is returned.
+        '''
+        url = url.replace(' ', '%20')
+
+        headers = {}
+        if previous_object:
+            etag = self._get_object_extra(previous_object, 'etag')
+            last_modified = self._get_object_extra(previous_object, 'last_modified')
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = requests.get(url, timeout=10, headers=headers)
+
+        if response.status_code == 304 and headers:
+            log.debug('Document %s not modified, using the previous one', url)
+            self._copy_previous_content(harvest_object, previous_object)
+            return None
+
+        for header, key in (('etag', 'etag'), ('last-modified', 'last_modified')):
+            if response.headers.get(header):
+                self._set_object_extra(harvest_object, key, response.headers[header])
+
+        content = self._response_as_unicode(response)
+
+        self._set_object_extra(harvest_object, 'content_hash',
+            hashlib.sha1(content.encode('utf8', 'ignore')).hexdigest())
+
+        return content
+
+    def _response_as_unicode(self, response):
         content = response.text
 
         # Remove original XML declaration
@@ -863,11 +1017,31 @@ class SpatialHarvester(HarvesterBase):
 
         return content
 
-    def _validate_document(self, document_string, harvest_object, validator=None):
+    def _parse_document(self, document_string, harvest_object):
+        '''
+        Parses an XML document into an etree.
+
+        The import stage parses each document once and the resulting tree
+        is shared by the validators, the ISO values extraction and the
+        ISpatialHarvester extensions.
+
+        Returns the root Element, or None if the document could not be
+        parsed, in which case a HarvestObjectError is created.
+        '''
+        try:
+            return parse_xml_string(document_string)
+        except (etree.XMLSyntaxError, ValueError), e:
+            self._save_object_error('Could not parse XML file: {0}'.format(str(e)), harvest_object, 'Import')
+            return None
+
+    def _validate_document(self, document_string, harvest_object, validator=None, xml_tree=None):
         '''
         Validates an XML document with the default, or if present, the
         provided validators.
 
+        If the document has already been parsed, the etree can be passed as
+        `xml_tree` to avoid parsing `document_string` again.
+
         It will create a HarvestObjectError for each validation error found,
         so they can be shown properly on the frontend.
 
@@ -878,13 +1052,16 @@ class SpatialHarvester(HarvesterBase):
         if not validator:
             validator = self._get_validator()
 
-        document_string = re.sub('<\?xml(.*)\?>', '', document_string)
+        if xml_tree is not None:
+            xml = xml_tree
+        else:
+            document_string = re.sub('<\?xml(.*)\?>', '', document_string)
 
-        try:
-            xml = etree.fromstring(document_string)
-        except etree.XMLSyntaxError, e:
-            self._save_object_error('Could not parse XML file: {0}'.format(str(e)), harvest_object, 'Import')
-            return False, None, []
+            try:
+                xml = etree.fromstring(document_string)
+            except etree.XMLSyntaxError, e:
+                self._save_object_error('Could not parse XML file: {0}'.format(str(e)), harvest_object, 'Import')
+                return False, None, []
 
         valid, profile, errors = validator.is_valid(xml)
         if not valid:
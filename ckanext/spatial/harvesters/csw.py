@@ -4,16 +4,21 @@ import urlparse
 
 import logging
 
+from pylons import config
+from sqlalchemy import and_
+from sqlalchemy.orm import aliased
+
 from ckan import model
 
 from ckan.plugins.core import SingletonPlugin, implements
 
 from ckanext.harvest.interfaces import IHarvester
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestJob, HarvestObject
 from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
-from ckanext.spatial.lib.csw_client import CswService
+from ckanext.spatial.lib.csw_client import get_csw_service, DEFAULT_CLIENT_TTL
 from ckanext.spatial.harvesters.base import SpatialHarvester, text_traceback
+from ckanext.spatial.harvesters.writer import HarvestObjectWriter
 
 
 class CSWHarvester(SpatialHarvester, SingletonPlugin):
@@ -114,34 +119,101 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
         delete = guids_in_db - guids_in_harvest
         change = guids_in_db & guids_in_harvest
 
-        ids = []
+        if change and self.source_config.get('incremental', False):
+            change = self._get_modified_guids(harvest_job, change, cql)
+
+        writer = HarvestObjectWriter(harvest_job)
         for guid in new:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                extras=[HOExtra(key='status', value='new')])
-            obj.save()
-            ids.append(obj.id)
+            writer.add(guid, 'new')
         for guid in change:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                package_id=guid_to_package_id[guid],
-                                extras=[HOExtra(key='status', value='change')])
-            obj.save()
-            ids.append(obj.id)
+            writer.add(guid, 'change', package_id=guid_to_package_id[guid])
         for guid in delete:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                package_id=guid_to_package_id[guid],
-                                extras=[HOExtra(key='status', value='delete')])
-            model.Session.query(HarvestObject).\
-                  filter_by(guid=guid).\
-                  update({'current': False}, False)
-            obj.save()
-            ids.append(obj.id)
+            writer.add(guid, 'delete', package_id=guid_to_package_id[guid])
+        ids = writer.finish()
 
         if len(ids) == 0:
+            if guids_in_harvest:
+                log.info('No new, modified or deleted records on the CSW server')
+                return []
             self._save_gather_error('No records received from the CSW server', harvest_job)
             return None
 
         return ids
 
+    def _get_modified_guids(self, harvest_job, guids, cql=None):
+        '''
+        Returns the subset of the provided (already harvested) guids that
+        need to be fetched again on an incremental harvest.
+
+        These are the ones modified on the server since the start of the
+        last successful job for the source, according to their
+        `apiso:Modified` queryable, plus the ones that failed on any job
+        since they were last imported successfully.
+        If there is no previous successful job or the server does not
+        support the query, all guids are returned.
+        '''
+        log = logging.getLogger(__name__ + '.CSW.gather')
+
+        last_job = self._get_last_successful_job(harvest_job)
+        if not last_job:
+            log.debug('No previous successful job, harvesting all records')
+            return guids
+
+        modified_cql = "apiso:Modified >= '%s'" % \
+            last_job.gather_started.strftime('%Y-%m-%dT%H:%M:%SZ')
+        if cql:
+            modified_cql = '(%s) AND %s' % (cql, modified_cql)
+
+        modified = set()
+        try:
+            for identifier in self.csw.getidentifiers(page=10,
+                    outputschema=self.output_schema(), cql=modified_cql):
+                if identifier is not None:
+                    modified.add(identifier)
+        except Exception, e:
+            log.warning('Could not get the modified records from the CSW '
+                        'server, harvesting all records [%r]', e)
+            return guids
+
+        failed = self._get_failed_guids(harvest_job)
+
+        log.info('%s records modified since %s, %s failed since their last '
+                 'successful import', len(modified), last_job.gather_started,
+                 len(failed))
+
+        return guids & (modified | failed)
+
+    def _get_failed_guids(self, harvest_job):
+        '''
+        Returns the guids of the source of the job with a harvest object in
+        the ERROR state gathered after the current one, ie that failed on
+        any job (including the ones with gather errors) since they were
+        last imported successfully.
+        '''
+        current = aliased(HarvestObject)
+        query = model.Session.query(HarvestObject.guid) \
+            .join(current, and_(current.guid==HarvestObject.guid,
+                                current.harvest_source_id==HarvestObject.harvest_source_id,
+                                current.current==True)) \
+            .filter(HarvestObject.harvest_source_id==harvest_job.source_id) \
+            .filter(HarvestObject.state==u'ERROR') \
+            .filter(HarvestObject.gathered > current.gathered)
+        return set(guid for guid, in query)
+
+    def _get_last_successful_job(self, harvest_job):
+        '''
+        Returns the most recent finished job for the same source as the
+        provided one that did not have any gather errors, or None.
+        '''
+        return model.Session.query(HarvestJob) \
+            .filter(HarvestJob.source_id==harvest_job.source_id) \
+            .filter(HarvestJob.id!=harvest_job.id) \
+            .filter(HarvestJob.status==u'Finished') \
+            .filter(HarvestJob.gather_started!=None) \
+            .filter(~HarvestJob.gather_errors.any()) \
+            .order_by(HarvestJob.gather_started.desc()) \
+            .first()
+
     def fetch_stage(self,harvest_object):
 
         # Check harvest object status
@@ -154,32 +226,32 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
         log = logging.getLogger(__name__ + '.CSW.fetch')
         log.debug('CswHarvester fetch_stage for object: %s', harvest_object.id)
 
+        self._set_source_config(harvest_object.source.config)
+        batch_size = int(self.source_config.get('fetch_batch_size', 1))
+
+        if batch_size > 1 and harvest_object.content is not None:
+            # Already fetched along with another object of the same batch
+            log.debug('Object %s already fetched in a batch', harvest_object.id)
+            return True
+
         url = harvest_object.source.url
         try:
-            self._setup_csw_client(url)
+            # Only a GetRecordById request is needed here, so there is no
+            # need to request the capabilities of the server
+            self._setup_csw_client(url, skip_caps=True)
         except Exception, e:
             self._save_object_error('Error contacting the CSW server: %s' % e,
                                     harvest_object)
             return False
 
+        if batch_size > 1:
+            return self._fetch_batch(harvest_object, batch_size)
+
         identifier = harvest_object.guid
         try:
             record = self.csw.getrecordbyid([identifier], outputschema=self.output_schema())
 
-            from owslib.util import bind_url
-            from owslib import csw
-
-            data = {
-                'service': 'CSW', # self.csw.service,
-                'version': '2.0.2', #self.csw.version,
-                'request': 'GetRecordById',
-                'outputFormat': 'application/xml',
-                'outputSchema': csw.get_namespaces()[self.output_schema()],
-                'elementsetname': "full",
-                'id': '',
-                }
-
-            original_request = '%s%s%s' % (bind_url(url), urllib.urlencode(data), identifier)
+            original_request = self._get_original_request(url, identifier)
         except Exception, e:
             self._save_object_error('Error getting the CSW record with GUID %s' % identifier, harvest_object)
             return False
@@ -197,6 +269,7 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
 
             harvest_object.content = content.strip()
             harvest_object.raw_metadata_request = original_request
+            self._get_content_hash(harvest_object)
             harvest_object.save()
         except Exception,e:
             self._save_object_error('Error saving the harvest object for GUID %s [%r]' % \
@@ -206,6 +279,142 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
         log.debug('XML content saved (len %s)', len(record['xml']))
         return True
 
-    def _setup_csw_client(self, url):
-        self.csw = CswService(url)
+    def _fetch_batch(self, harvest_object, batch_size):
+        '''
+        Fetches the record for the harvest object together with the ones for
+        other objects of the same job still waiting to be fetched, up to
+        `batch_size` records per GetRecordById request.
+
+        The contents are stored on all the objects of the batch, so when the
+        fetch stage runs for the other objects it just passes them on to the
+        import stage.
+        '''
+        log = logging.getLogger(__name__ + '.CSW.fetch')
+
+        others = self._claim_objects(harvest_object, batch_size - 1)
+        objects = [harvest_object] + others
+
+        identifiers = [obj.guid for obj in objects]
+        try:
+            records = self.csw.getrecordsbyid(identifiers, outputschema=self.output_schema())
+        except Exception, e:
+            self._release_objects(others)
+            self._save_object_error('Error getting the CSW records with GUIDs %s [%r]' % \
+                                    (', '.join(identifiers), e), harvest_object)
+            return False
+
+        # The ones not returned will be requested again on their own fetch
+        # stage, or as part of another batch
+        self._release_objects([obj for obj in others if obj.guid not in records])
+
+        if harvest_object.guid not in records:
+            self._save_object_error('Empty record for GUID %s' % harvest_object.guid,
+                                    harvest_object)
+            return False
+
+        try:
+            for obj in objects:
+                if obj.guid not in records:
+                    continue
+                # Remove original XML declaration
+                content = re.sub('<\?xml(.*)\?>', '', records[obj.guid])
+                obj.content = content.strip()
+                obj.raw_metadata_request = self._get_original_request(
+                    harvest_object.source.url, obj.guid)
+                self._get_content_hash(obj)
+                obj.add()
+            model.Session.commit()
+        except Exception, e:
+            model.Session.rollback()
+            self._release_objects(others)
+            self._save_object_error('Error saving the harvest objects for GUIDs %s [%r]' % \
+                                    (', '.join(identifiers), e), harvest_object)
+            return False
+
+        log.debug('XML content saved for %s of %s objects in the batch',
+                  len([obj for obj in objects if obj.guid in records]),
+                  len(objects))
+        return True
+
+    def _claim_objects(self, harvest_object, limit):
+        '''
+        Claims up to `limit` other objects of the same job still waiting to
+        be fetched, setting their state to FETCH, so they are not fetched as
+        part of the batches of concurrent fetch consumers. Their own fetch
+        stage will then just pass them on to the import stage.
+
+        If another consumer claims the same rows at the same time, the
+        `state = 'WAITING'` condition is checked again once its update is
+        committed, so each object is only claimed once.
+        '''
+        sql = '''UPDATE harvest_object SET state = 'FETCH'
+                 WHERE id IN (
+                     SELECT id FROM harvest_object
+                     WHERE harvest_job_id = :job_id
+                         AND id != :object_id
+                         AND state = 'WAITING'
+                         AND content IS NULL
+                         AND NOT EXISTS (
+                             SELECT 1 FROM harvest_object_extra
+                             WHERE harvest_object_extra.harvest_object_id = harvest_object.id
+                                 AND harvest_object_extra.key = 'status'
+                                 AND harvest_object_extra.value = 'delete')
+                     LIMIT :limit)
+                     AND state = 'WAITING'
+                 RETURNING id'''
+        claimed_ids = [row[0] for row in model.Session.execute(sql, {
+            'job_id': harvest_object.harvest_job_id,
+            'object_id': harvest_object.id,
+            'limit': limit})]
+        model.Session.commit()
+
+        if not claimed_ids:
+            return []
+        return model.Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_(claimed_ids)) \
+            .all()
+
+    def _release_objects(self, objects):
+        '''
+        Sets the objects claimed for a batch that were not fetched back to
+        WAITING, so they can be claimed again.
+        '''
+        if not objects:
+            return
+        model.Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_([obj.id for obj in objects])) \
+            .filter(HarvestObject.content==None) \
+            .update({'state': u'WAITING'}, synchronize_session=False)
+        model.Session.commit()
+
+    def _get_original_request(self, url, identifier):
+        '''
+        Returns the GetRecordById URL for a single record, stored on the
+        harvest object as the original metadata request.
+        '''
+        from owslib.util import bind_url
+        from owslib import csw
+
+        data = {
+            'service': 'CSW', # self.csw.service,
+            'version': '2.0.2', #self.csw.version,
+            'request': 'GetRecordById',
+            'outputFormat': 'application/xml',
+            'outputSchema': csw.get_namespaces()[self.output_schema()],
+            'elementsetname': "full",
+            'id': '',
+            }
+
+        return '%s%s%s' % (bind_url(url), urllib.urlencode(data), identifier)
+
+    def _setup_csw_client(self, url, skip_caps=False):
+        '''
+        Sets up the CSW client for the given endpoint. Clients are cached
+        per process and endpoint for the number of seconds defined in
+        `ckanext.spatial.harvest.csw_client_ttl`, so consecutive stages for
+        the same source reuse the same client and HTTP connections.
+        '''
+        ttl = int(config.get('ckanext.spatial.harvest.csw_client_ttl',
+                             DEFAULT_CLIENT_TTL))
+        self.csw = get_csw_service(url, ttl=ttl, skip_caps=skip_caps)
 
@@ -49,15 +49,7 @@ class DocHarvester(SpatialHarvester, SingletonPlugin):
 
         self._set_source_config(harvest_job.source.config)
 
-        # Get contents
-        try:
-            content = self._get_content_as_unicode(url)
-        except Exception,e:
-            self._save_gather_error('Unable to get content for URL: %s: %r' % \
-                                        (url, e),harvest_job)
-            return None
-
-        existing_object = model.Session.query(HarvestObject.guid, HarvestObject.package_id).\
+        existing_object = model.Session.query(HarvestObject).\
                                     filter(HarvestObject.current==True).\
                                     filter(HarvestObject.harvest_source_id==harvest_job.source.id).\
                                     first()
@@ -66,39 +58,41 @@ class DocHarvester(SpatialHarvester, SingletonPlugin):
             return [HOExtra(key='doc_location', value=url),
                     HOExtra(key='status', value=status)]
 
+        # The job is assigned once the content has been retrieved, so the
+        # object does not get saved along with the errors if it fails
         if not existing_object:
             guid=hashlib.md5(url.encode('utf8', 'ignore')).hexdigest()
-            harvest_object = HarvestObject(job=harvest_job,
-                                extras=create_extras(url,
-                                                     'new'),
-                                guid=guid
-                               )
+            harvest_object = HarvestObject(extras=create_extras(url,
+                                                                'new'),
+                                           guid=guid
+                                          )
         else:
-            harvest_object = HarvestObject(job=harvest_job,
-                                extras=create_extras(url,
-                                                     'change'),
-                                guid=existing_object.guid,
-                                package_id=existing_object.package_id
-                               )
+            harvest_object = HarvestObject(extras=create_extras(url,
+                                                                'change'),
+                                           guid=existing_object.guid,
+                                           package_id=existing_object.package_id
+                                          )
 
+        # Get contents
+        try:
+            content = self._get_content_if_modified(url, harvest_object,
+                                                    existing_object)
+        except Exception,e:
+            self._save_gather_error('Unable to get content for URL: %s: %r' % \
+                                        (url, e),harvest_job)
+            return None
+
+        harvest_object.job = harvest_job
         harvest_object.add()
 
-        # Check if it is an ISO document
-        document_format = guess_standard(content)
-        if document_format == 'iso':
-            harvest_object.content = content
-        else:
-            extra = HOExtra(
-                    object=harvest_object,
-                    key='original_document',
-                    value=content)
-            extra.save()
-
-            extra = HOExtra(
-                    object=harvest_object,
-                    key='original_format',
-                    value=document_format)
-            extra.save()
+        if content is not None:
+            # Check if it is an ISO document
+            document_format = guess_standard(content)
+            if document_format == 'iso':
+                harvest_object.content = content
+            else:
+                self._set_object_extra(harvest_object, 'original_document', content)
+                self._set_object_extra(harvest_object, 'original_format', document_format)
 
         harvest_object.save()
 
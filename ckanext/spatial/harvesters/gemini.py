@@ -36,6 +36,7 @@ from ckanext.spatial.model import GeminiDocument
 from ckanext.spatial.lib.csw_client import CswService
 
 from ckanext.spatial.harvesters.base import SpatialHarvester, text_traceback
+from ckanext.spatial.harvesters.writer import HarvestObjectWriter
 
 
 log = logging.getLogger(__name__)
@@ -546,7 +547,7 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
 
         log.debug('Starting gathering for %s' % url)
         used_identifiers = []
-        ids = []
+        writer = HarvestObjectWriter(harvest_job)
         try:
             for identifier in self.csw.getidentifiers(page=10):
                 try:
@@ -560,10 +561,8 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
                         continue
 
                     # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid=identifier, job=harvest_job)
-                    obj.save()
+                    writer.add(identifier)
 
-                    ids.append(obj.id)
                     used_identifiers.append(identifier)
                 except Exception, e:
                     self._save_gather_error('Error for the identifier %s [%r]' % (identifier,e), harvest_job)
@@ -574,6 +573,7 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
             self._save_gather_error('Error gathering the identifiers from the CSW server [%s]' % str(e), harvest_job)
             return None
 
+        ids = writer.finish()
         if len(ids) == 0:
             self._save_gather_error('No records received from the CSW server', harvest_job)
             return None
@@ -711,7 +711,7 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
                                         (url, e),harvest_job)
             return None
-        ids = []
+        writer = HarvestObjectWriter(harvest_job)
         try:
             for url in self._extract_urls(content,url):
                 try:
@@ -729,12 +729,7 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
                             # Create a new HarvestObject for this identifier
                             # Generally the content will be set in the fetch stage, but as we alredy
                             # have it, we might as well save a request
-                            obj = HarvestObject(guid=gemini_guid,
-                                                job=harvest_job,
-                                                content=gemini_string)
-                            obj.save()
-
-                            ids.append(obj.id)
+                            writer.add(gemini_guid, content=gemini_string)
 
 
                     except Exception,e:
@@ -746,6 +741,7 @@ class GeminiWafHarvester(GeminiHarvester, SingletonPlugin):
             self._save_gather_error(msg,harvest_job)
             return None
 
+        ids = writer.finish()
         if len(ids) > 0:
             return ids
         else:
@@ -1,9 +1,13 @@
 import logging
 import hashlib
-from urlparse import urljoin
+import re
+import datetime
+import threading
+import Queue
+from urlparse import urljoin, urlparse
 import dateutil.parser
-import pyparsing as parse
 import requests
+from pylons import config
 from sqlalchemy.orm import aliased
 from sqlalchemy.exc import DataError
 
@@ -17,6 +21,7 @@ from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 import ckanext.harvest.queue as queue
 
 from ckanext.spatial.harvesters.base import SpatialHarvester, guess_standard
+from ckanext.spatial.harvesters.writer import HarvestObjectWriter
 
 log = logging.getLogger(__name__)
 
@@ -57,10 +62,14 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
 
         self._set_source_config(harvest_job.source.config)
 
+        crawler = WAFCrawler(
+            max_workers=int(config.get('ckanext.spatial.harvest.waf_crawler_workers', 4)),
+            max_per_host=int(config.get('ckanext.spatial.harvest.waf_crawler_per_host', 2)),
+            timeout=int(config.get('ckanext.spatial.harvest.waf_timeout', 60)))
+
         # Get contents
         try:
-            response = requests.get(source_url, timeout=60)
-            response.raise_for_status()
+            response = crawler.get(source_url)
         except requests.exceptions.RequestException, e:
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
                                         (source_url, e),harvest_job)
@@ -94,7 +103,7 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
 
         url_to_modified_harvest = {} ## mapping of url to last_modified in harvest
         try:
-            for url, modified_date in _extract_waf(content,source_url,scraper):
+            for url, modified_date in crawler.crawl(content,source_url,scraper):
                 url_to_modified_harvest[url] = modified_date
         except Exception,e:
             msg = 'Error extracting URLs from %s, error was %s' % (source_url, e)
@@ -116,53 +125,33 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
                 or url_to_modified_harvest[item] > url_to_modified_db[item]):
                 change.append(item)
 
-        def create_extras(url, date, status):
-            extras = [HOExtra(key='waf_modified_date', value=date),
-                      HOExtra(key='waf_location', value=url),
-                      HOExtra(key='status', value=status)]
+        def create_extras(url, date):
+            extras = {'waf_modified_date': date,
+                      'waf_location': url}
             if collection_package_id:
-                extras.append(
-                    HOExtra(key='collection_package_id',
-                            value=collection_package_id)
-                )
+                extras['collection_package_id'] = collection_package_id
             return extras
 
 
-        ids = []
+        writer = HarvestObjectWriter(harvest_job)
         for location in new:
             guid=hashlib.md5(location.encode('utf8','ignore')).hexdigest()
-            obj = HarvestObject(job=harvest_job,
-                                extras=create_extras(location,
-                                                     url_to_modified_harvest[location],
-                                                     'new'),
-                                guid=guid
-                               )
-            obj.save()
-            ids.append(obj.id)
+            writer.add(guid, 'new',
+                       extras=create_extras(location,
+                                            url_to_modified_harvest[location]))
 
         for location in change:
-            obj = HarvestObject(job=harvest_job,
-                                extras=create_extras(location,
-                                                     url_to_modified_harvest[location],
-                                                     'change'),
-                                guid=url_to_ids[location][0],
-                                package_id=url_to_ids[location][1],
-                               )
-            obj.save()
-            ids.append(obj.id)
+            writer.add(url_to_ids[location][0], 'change',
+                       package_id=url_to_ids[location][1],
+                       extras=create_extras(location,
+                                            url_to_modified_harvest[location]))
 
         for location in delete:
-            obj = HarvestObject(job=harvest_job,
-                                extras=create_extras('','', 'delete'),
-                                guid=url_to_ids[location][0],
-                                package_id=url_to_ids[location][1],
-                               )
-            model.Session.query(HarvestObject).\
-                  filter_by(guid=url_to_ids[location][0]).\
-                  update({'current': False}, False)
-
-            obj.save()
-            ids.append(obj.id)
+            writer.add(url_to_ids[location][0], 'delete',
+                       package_id=url_to_ids[location][1],
+                       extras=create_extras('', ''))
+
+        ids = writer.finish()
 
         if len(ids) > 0:
             log.debug('{0} objects sent to the next stage: {1} new, {2} change, {3} delete'.format(
@@ -192,64 +181,60 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
                     harvest_object)
             return False
 
+        previous_object = None
+        if status == 'change':
+            previous_object = self._get_previous_object(harvest_object)
+
         # Get contents
         try:
-            content = self._get_content_as_unicode(url)
+            content = self._get_content_if_modified(url, harvest_object,
+                                                    previous_object)
         except Exception, e:
             msg = 'Could not harvest WAF link {0}: {1}'.format(url, e)
             self._save_object_error(msg, harvest_object)
             return False
 
+        if content is None:
+            # Not modified, the previous document was copied
+            harvest_object.save()
+            return True
+
         # Check if it is an ISO document
         document_format = guess_standard(content)
         if document_format == 'iso':
             harvest_object.content = content
-            harvest_object.save()
         else:
-            extra = HOExtra(
-                    object=harvest_object,
-                    key='original_document',
-                    value=content)
-            extra.save()
-
-            extra = HOExtra(
-                    object=harvest_object,
-                    key='original_format',
-                    value=document_format)
-            extra.save()
+            self._set_object_extra(harvest_object, 'original_document', content)
+            self._set_object_extra(harvest_object, 'original_format', document_format)
+        harvest_object.save()
 
         return True
 
 
-apache  = parse.SkipTo(parse.CaselessLiteral("<a href="), include=True).suppress() \
-        + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url') \
-        + parse.SkipTo("</a>", include=True).suppress() \
-        + parse.Optional(parse.Literal('</td><td align="right">')).suppress() \
-        + parse.Optional(parse.Combine(
-            parse.Word(parse.alphanums+'-') +
-            parse.Word(parse.alphanums+':')
-        ,adjacent=False, joinString=' ').setResultsName('date')
-        )
-
-iis =      parse.SkipTo("<br>").suppress() \
-         + parse.OneOrMore("<br>").suppress() \
-         + parse.Optional(parse.Combine(
-           parse.Word(parse.alphanums+'/') +
-           parse.Word(parse.alphanums+':') +
-           parse.Word(parse.alphas)
-         , adjacent=False, joinString=' ').setResultsName('date')
-         ) \
-         + parse.Word(parse.nums).suppress() \
-         + parse.Literal('<A HREF=').suppress() \
-         + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url')
-
-other = parse.SkipTo(parse.CaselessLiteral("<a href="), include=True).suppress() \
-        + parse.quotedString.setParseAction(parse.removeQuotes).setResultsName('url')
-
-
-scrapers = {'apache': parse.OneOrMore(parse.Group(apache)),
-            'other': parse.OneOrMore(parse.Group(other)),
-            'iis': parse.OneOrMore(parse.Group(iis))}
+# Regular expressions used to extract the links (and modification dates if
+# available) from the different WAF listings. They are applied with
+# `finditer` over the whole page, so entries that don't match (eg
+# directories on IIS listings) are just skipped.
+
+_quoted_url = r"""(?:"(?P<url>[^"\r\n]*)"|'(?P<url_single>[^'\r\n]*)')"""
+
+scrapers = {
+    # <a href="dataset1.xml">dataset1.xml</a></td><td align="right">2014-01-10 10:23
+    # <a href="dataset1.xml">dataset1.xml</a>     10-Jan-2014 10:23
+    'apache': re.compile(
+        r'<a href=' + _quoted_url + r'.*?</a>'
+        r'(?:\s*</td><td align="right">)?'
+        r'(?:\s*(?P<date>[a-z0-9-]+(?![a-z0-9-])\s*[a-z0-9:]+))?',
+        re.IGNORECASE | re.DOTALL),
+    # <br> 1/10/2014 10:23 AM        12288 <A HREF="/waf/dataset1.xml">
+    'iis': re.compile(
+        r'(?:<br>\s*)+'
+        r'(?:(?P<date>[a-z0-9/]+\s+[a-z0-9:]+\s+[a-z]+)\s+)?'
+        r'\d+\s*<A HREF=' + _quoted_url,
+        re.IGNORECASE),
+    # <a href="dataset1.xml">
+    'other': re.compile(r'<a href=' + _quoted_url, re.IGNORECASE),
+}
 
 def _get_scraper(server):
     if not server or 'apache' in server.lower():
@@ -260,59 +245,187 @@ def _get_scraper(server):
         return 'other'
 
 def _extract_waf(content, base_url, scraper, results = None, depth=0):
+    '''
+    Returns a list of (url, date) tuples for all the metadata documents
+    linked from a WAF listing page and its subfolders, using a crawler with
+    the default settings.
+    '''
     if results is None:
         results = []
+    results.extend(WAFCrawler().crawl(content, base_url, scraper, depth))
+    return results
 
-    base_url = base_url.rstrip('/').split('/')
-    if 'index' in base_url[-1]:
-        base_url.pop()
-    base_url = '/'.join(base_url)
-    base_url += '/'
+def _base_url(url):
+    url = url.rstrip('/').split('/')
+    if 'index' in url[-1]:
+        url.pop()
+    return '/'.join(url) + '/'
 
-    try:
-        parsed = scrapers[scraper].parseString(content)
-    except parse.ParseException:
-        parsed = scrapers['other'].parseString(content)
 
-    for record in parsed:
-        url = record.url
-        if not url:
-            continue
-        if url.startswith('_'):
-            continue
-        if '?' in url:
-            continue
-        if '#' in url:
-            continue
-        if 'mailto:' in url:
-            continue
-        if '..' not in url and url[0] != '/' and url[-1] == '/':
-            new_depth = depth + 1
-            if depth > 10:
-                log.info('Max WAF depth reached')
+class WAFCrawler(object):
+    '''
+    Crawls a WAF listing and its subfolders, returning the links to the
+    metadata documents found and their modification dates.
+
+    Subfolders are requested concurrently by a bounded pool of threads,
+    sharing a requests session so connections are reused. Each folder is
+    only requested once, requests time out after `timeout` seconds, and no
+    more than `max_per_host` requests are sent to the same host at a time.
+    Folders deeper than `max_depth` levels are not followed.
+    '''
+
+    def __init__(self, max_workers=4, max_per_host=2, timeout=60,
+                 max_depth=10):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.max_depth = max_depth
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        '''
+        Requests a URL with the crawler session, respecting the per host
+        concurrency limit. Returns the response object.
+        '''
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = \
+                    threading.BoundedSemaphore(self.max_per_host)
+            semaphore = self._host_semaphores[host]
+        with semaphore:
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            return response
+
+    def crawl(self, content, base_url, scraper, depth=0):
+        '''
+        Returns a list of (url, date) tuples for all the metadata documents
+        linked from the provided listing page content and its subfolders.
+        '''
+        results = []
+        seen = set([_base_url(base_url)])
+        folders = Queue.Queue()
+        errors = []
+
+        def process(content, base_url, depth):
+            documents, subfolders = self._parse_listing(content, base_url,
+                                                        scraper, depth)
+            with self._lock:
+                results.extend(documents)
+                for url in subfolders:
+                    if url not in seen:
+                        seen.add(url)
+                        folders.put((url, depth + 1))
+
+        def worker():
+            while True:
+                url, depth = folders.get()
+                try:
+                    if url is None:
+                        return
+                    log.debug('WAF new_url: %s', url)
+                    try:
+                        response = self.get(url)
+                    except requests.exceptions.RequestException, e:
+                        log.warning('Could not get WAF folder %s: %r', url, e)
+                        continue
+                    process(response.content, url, depth)
+                except Exception, e:
+                    errors.append(e)
+                finally:
+                    folders.task_done()
+
+        process(content, base_url, depth)
+        if folders.empty():
+            return results
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(self.max_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        folders.join()
+        for thread in threads:
+            folders.put((None, None))
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        return results
+
+    def _parse_listing(self, content, base_url, scraper, depth):
+        '''
+        Returns the (url, date) tuples for the documents on a listing page
+        and the URLs of the subfolders that need to be crawled.
+        '''
+        base_url = _base_url(base_url)
+        documents = []
+        subfolders = []
+
+        for url, date in _extract_links(content, scraper):
+            if not url:
                 continue
-            new_url = urljoin(base_url, url)
-            if not new_url.startswith(base_url):
+            if url.startswith('_'):
                 continue
-            log.debug('WAF new_url: %s', new_url)
-            try:
-                response = requests.get(new_url)
-                content = response.content
-            except Exception, e:
-                print str(e)
+            if '?' in url:
                 continue
-            _extract_waf(content, new_url, scraper, results, new_depth)
-            continue
-        if not url.endswith('.xml'):
+            if '#' in url:
+                continue
+            if 'mailto:' in url:
+                continue
+            if '..' not in url and url[0] != '/' and url[-1] == '/':
+                if depth > self.max_depth:
+                    log.info('Max WAF depth reached')
+                    continue
+                new_url = urljoin(base_url, url)
+                if not new_url.startswith(base_url):
+                    continue
+                subfolders.append(new_url)
+                continue
+            if not url.endswith('.xml'):
+                continue
+            if date:
+                date = _parse_date(date)
+            documents.append((urljoin(base_url, url), date))
+
+        return documents, subfolders
+
+# Date formats used by the default Apache and IIS listings, which are much
+# faster to parse with strptime than with dateutil
+_listing_date_formats = ('%Y-%m-%d %H:%M', '%d-%b-%Y %H:%M', '%m/%d/%Y %I:%M %p')
+
+def _parse_date(date):
+    for date_format in _listing_date_formats:
+        try:
+            return str(datetime.datetime.strptime(date, date_format))
+        except ValueError:
             continue
-        date = record.date
-        if date:
-            try:
-                date = str(dateutil.parser.parse(date))
-            except Exception, e:
-                raise
-                date = None
-        results.append((urljoin(base_url, record.url), date))
+    return str(dateutil.parser.parse(date))
 
-    return results
+def _extract_links(content, scraper):
+    '''
+    Returns a list of (url, date) tuples for all the links found on a WAF
+    listing, using the expression for the provided scraper. If it does not
+    find any links, the generic one is used. Dates are returned as found
+    on the listing, or as an empty string if not available.
+    '''
+    for name in (scraper, 'other'):
+        links = [(match.group('url') if match.group('url') is not None
+                  else match.group('url_single'),
+                  match.groupdict().get('date') or '')
+                 for match in scrapers[name].finditer(content)]
+        if links:
+            return links
+    return []
 
@@ -0,0 +1,129 @@
+import datetime
+import logging
+
+from sqlalchemy.orm import class_mapper
+
+from ckan import model
+from ckan.model.types import make_uuid
+
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObjectExtra as HOExtra
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class HarvestObjectWriter(object):
+    '''
+    Bulk writer for the harvest objects created on the gather stage
+
+    Instead of saving each object (and its extras) individually, which
+    means one commit per record, objects are accumulated and written in
+    chunks, with a batched insert for the objects, another one for their
+    extras and a single update to unset the `current` flag of the previous
+    objects for all deleted guids, followed by a single commit.
+
+    Usage::
+
+        writer = HarvestObjectWriter(harvest_job)
+        writer.add(guid, 'new', extras={'waf_location': url})
+        writer.add(guid, 'delete', package_id=package_id)
+        ids = writer.finish()
+
+    '''
+
+    def __init__(self, harvest_job, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.harvest_job = harvest_job
+        self.chunk_size = chunk_size
+
+        self.ids = []
+
+        self._objects = []
+        self._extras = []
+        self._deleted_guids = []
+
+        self._object_table = class_mapper(HarvestObject).local_table
+        self._extra_table = class_mapper(HOExtra).local_table
+
+    def add(self, guid, status=None, package_id=None, content=None,
+            extras=None):
+        '''
+        Queues a new harvest object for the job and returns its id
+
+        If `status` is provided, it is stored as the `status` extra. For
+        objects with `delete` status, the `current` flag of the existing
+        objects with the same guid will be unset.
+
+        :param extras: Additional object extras, as a dict
+        '''
+        object_id = make_uuid()
+
+        self._objects.append({
+            'id': object_id,
+            'guid': guid,
+            'harvest_job_id': self.harvest_job.id,
+            'harvest_source_id': self.harvest_job.source_id,
+            'package_id': package_id,
+            'content': content,
+            'current': False,
+            'state': u'WAITING',
+            'gathered': datetime.datetime.utcnow(),
+        })
+
+        extras = dict(extras or {})
+        if status:
+            extras['status'] = status
+        for key, value in extras.iteritems():
+            self._extras.append({
+                'id': make_uuid(),
+                'harvest_object_id': object_id,
+                'key': key,
+                'value': value,
+            })
+
+        if status == 'delete':
+            self._deleted_guids.append(guid)
+
+        self.ids.append(object_id)
+
+        if len(self._objects) >= self.chunk_size:
+            self.flush()
+
+        return object_id
+
+    def flush(self):
+        '''
+        Writes and commits all the queued objects
+        '''
+        if not self._objects:
+            return
+
+        if self._deleted_guids:
+            model.Session.execute(
+                self._object_table.update()
+                .where(self._object_table.c.guid.in_(self._deleted_guids))
+                .values(current=False))
+
+        # Passing the rows as parameters (executemany) rather than a
+        # multi-row VALUES clause, which requires SQLAlchemy 0.8
+        model.Session.execute(self._object_table.insert(), self._objects)
+        if self._extras:
+            model.Session.execute(self._extra_table.insert(), self._extras)
+
+        model.Session.commit()
+
+        log.debug('Saved %s harvest objects (%s extras)',
+                  len(self._objects), len(self._extras))
+
+        self._objects = []
+        self._extras = []
+        self._deleted_guids = []
+
+    def finish(self):
+        '''
+        Writes any pending objects and returns the ids of all the objects
+        added, in the same order.
+        '''
+        self.flush()
+        return self.ids
@@ -1,18 +1,24 @@
 import logging
+import hashlib
 from string import Template
 
+from sqlalchemy import text as sql_text
+
 from ckan.model import Session, Package
 from ckan.lib.base import config
+from ckan.plugins import toolkit
 
 from ckanext.spatial.model import PackageExtent
 from shapely.geometry import asShape
 
-from ckanext.spatial.geoalchemy_common import (WKTElement, ST_Transform,
-                                               compare_geometry_fields,
-                                               )
+from ckanext.spatial.geoalchemy_common import WKTElement, ST_Transform
+from ckanext.spatial.lib.query_cache import (cached_bbox_query, extents_changed,
+                                             get_cache)
 
 log = logging.getLogger(__name__)
 
+DEFAULT_SIMPLIFY_TOLERANCE = 0.01
+
 
 def get_srid(crs):
     """Returns the SRID for the provided CRS definition
@@ -44,40 +50,238 @@ def save_package_extent(package_id, geometry = None, srid = None):
        The responsibility for calling model.Session.commit() is left to the
        caller.
     '''
-    db_srid = int(config.get('ckan.spatial.srid', '4326'))
+    save_package_extents([(package_id, geometry, srid)])
 
+def save_package_extents(extents, chunk_size=1000, force=False):
+    '''Adds, updates or deletes the extent geometries of several packages.
 
-    existing_package_extent = Session.query(PackageExtent).filter(PackageExtent.package_id==package_id).first()
+       extents: an iterable of (package_id, geometry, srid) tuples, with the
+                same values as the `save_package_extent` parameters. If
+                there are several tuples for the same package, the last
+                one is used.
+       chunk_size: number of packages written on each set of statements
 
-    if geometry:
-        shape = asShape(geometry)
+       force: write the extents even if their fingerprint is the same as
+              the stored one
 
-        if not srid:
-            srid = db_srid
+       The extents for each chunk of packages are written with a single
+       statement that updates the existing extents and inserts the new
+       ones, skipping the ones with the same fingerprint as the stored one
+       (see `geometry_fingerprint`), plus another one that deletes the
+       extents for the packages with no geometry. Geometries changed on the
+       database directly are not detected, use `force` to rewrite them.
 
-        package_extent = PackageExtent(package_id=package_id,
-                                       the_geom=WKTElement(shape.wkt, srid))
+       Will throw ValueError if a geometry object does not provide a geo
+       interface.
 
-    # Check if extent exists
-    if existing_package_extent:
-
-        # If extent exists but we received no geometry, we'll delete the existing one
-        if not geometry:
-            existing_package_extent.delete()
-            log.debug('Deleted extent for package %s' % package_id)
+       The responsibility for calling model.Session.commit() is left to the
+       caller.
+    '''
+    chunk = {}
+    for package_id, geometry, srid in extents:
+        if geometry:
+            chunk[package_id] = parse_package_extent(geometry, srid)
         else:
-            # Check if extent changed
-            if not compare_geometry_fields(package_extent.the_geom, existing_package_extent.the_geom):
-                # Update extent
-                existing_package_extent.the_geom = package_extent.the_geom
-                existing_package_extent.save()
-                log.debug('Updated extent for package %s' % package_id)
-            else:
-                log.debug('Extent for package %s unchanged' % package_id)
-    elif geometry:
-        # Insert extent
-        Session.add(package_extent)
-        log.debug('Created new extent for package %s' % package_id)
+            chunk[package_id] = None
+
+        if len(chunk) >= chunk_size:
+            save_parsed_package_extents(chunk, force)
+            chunk = {}
+
+    if chunk:
+        save_parsed_package_extents(chunk, force)
+
+def parse_package_extent(geometry, srid=None, db_srid=None):
+    '''Returns the values needed to store an extent geometry.
+
+       geometry: a Python object implementing the Python Geo Interface
+                (i.e a loaded GeoJSON object)
+       srid: The spatial reference in which the geometry is provided.
+             If None, it defaults to the DB srid.
+
+       Returns a (wkt, srid, fingerprint) tuple. It does not access the
+       database, so it can be called from other processes.
+
+       Will throw ValueError if the geometry object does not provide a geo interface.
+    '''
+    if not srid:
+        srid = db_srid or int(config.get('ckan.spatial.srid', '4326'))
+    srid = int(srid)
+
+    shape = asShape(geometry)
+    return (shape.wkt, srid, geometry_fingerprint(shape, srid))
+
+def geometry_fingerprint(shape, srid):
+    '''
+    Returns a fingerprint of a shapely geometry in the provided SRID, to
+    check if an extent has changed without comparing the geometries on the
+    database.
+
+    It is a hash of the WKB representation of the geometry, so any change
+    in the coordinates (or their order) gives a different fingerprint.
+    '''
+    return hashlib.sha1('%s:%s' % (srid, shape.wkb)).hexdigest()
+
+def save_parsed_package_extents(chunk, force=False):
+    '''Writes a dict of package_id: (wkt, srid, fingerprint) (as returned
+       by `parse_package_extent`) or None (to delete the extent) to the
+       package_extent table. See `save_package_extents`.
+
+       Returns the number of extents written or deleted, and notifies the
+       changes (see `ckanext.spatial.lib.query_cache`) if there were any.
+
+       The responsibility for calling model.Session.commit() is left to the
+       caller.
+    '''
+    db_srid = int(config.get('ckan.spatial.srid', '4326'))
+    tolerance = get_simplify_tolerance()
+
+    to_delete = [package_id for package_id, value in chunk.iteritems()
+                 if value is None]
+    to_save = [(package_id, value) for package_id, value in chunk.iteritems()
+               if value is not None]
+
+    deleted = 0
+    if to_delete:
+        params = dict(('package_id_%i' % i, package_id)
+                      for i, package_id in enumerate(to_delete))
+        sql = 'DELETE FROM package_extent WHERE package_id IN (%s)' % \
+              ', '.join(':%s' % key for key in params)
+        deleted = Session.execute(sql, params).rowcount
+        log.debug('Deleted %i extents', deleted)
+
+    updated = inserted = 0
+    if to_save:
+        params = {'db_srid': db_srid, 'tolerance': tolerance, 'force': force}
+        values = []
+        for i, (package_id, (wkt, srid, fingerprint)) in enumerate(to_save):
+            params['package_id_%i' % i] = package_id
+            params['wkt_%i' % i] = wkt
+            params['srid_%i' % i] = srid
+            params['fingerprint_%i' % i] = fingerprint
+            values.append('(:package_id_{0}, :wkt_{0}, CAST(:srid_{0} AS integer), '
+                          ':fingerprint_{0})'.format(i))
+
+        # Extents with the same fingerprint as the stored one are skipped
+        # before transforming them. The insert only sees the extents that
+        # existed before the statement, so new packages are inserted and
+        # existing ones updated
+        sql = '''
+            WITH input (package_id, wkt, srid, geom_fingerprint) AS (VALUES {values}),
+            changed AS (
+                SELECT input.package_id, input.wkt, input.srid,
+                       input.geom_fingerprint
+                FROM input LEFT OUTER JOIN package_extent
+                    ON package_extent.package_id = input.package_id
+                WHERE :force
+                    OR package_extent.geom_fingerprint IS DISTINCT FROM input.geom_fingerprint
+            ),
+            transformed AS (
+                SELECT package_id,
+                       ST_Transform(ST_GeomFromText(wkt, srid), :db_srid) AS the_geom,
+                       geom_fingerprint
+                FROM changed
+            ),
+            geometries AS (
+                SELECT package_id, the_geom, geom_fingerprint,
+                       ST_XMin(the_geom) AS minx, ST_YMin(the_geom) AS miny,
+                       ST_XMax(the_geom) AS maxx, ST_YMax(the_geom) AS maxy,
+                       (ST_XMax(the_geom) - ST_XMin(the_geom)) *
+                       (ST_YMax(the_geom) - ST_YMin(the_geom)) AS area,
+                       {simplified} AS the_geom_simplified,
+                       {simplify_tolerance} AS simplify_tolerance
+                FROM transformed
+            ),
+            updated AS (
+                UPDATE package_extent SET the_geom = geometries.the_geom,
+                    geom_fingerprint = geometries.geom_fingerprint,
+                    minx = geometries.minx, miny = geometries.miny,
+                    maxx = geometries.maxx, maxy = geometries.maxy,
+                    area = geometries.area,
+                    the_geom_simplified = geometries.the_geom_simplified,
+                    simplify_tolerance = geometries.simplify_tolerance
+                FROM geometries
+                WHERE package_extent.package_id = geometries.package_id
+                RETURNING package_extent.package_id
+            ),
+            inserted AS (
+                INSERT INTO package_extent (package_id, the_geom, geom_fingerprint,
+                                            minx, miny, maxx, maxy, area,
+                                            the_geom_simplified, simplify_tolerance)
+                SELECT package_id, the_geom, geom_fingerprint,
+                       minx, miny, maxx, maxy, area,
+                       the_geom_simplified, simplify_tolerance
+                FROM geometries
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM package_extent
+                    WHERE package_extent.package_id = geometries.package_id)
+                RETURNING package_id
+            )
+            SELECT (SELECT count(*) FROM updated), (SELECT count(*) FROM inserted)
+            '''.format(values=', '.join(values),
+                       simplified=_simplified_geometry_sql('the_geom'),
+                       simplify_tolerance=_simplify_tolerance_sql())
+        updated, inserted = Session.execute(sql, params).first()
+        log.debug('Saved %i extents (%i new, %i unchanged)', updated + inserted,
+                  inserted, len(to_save) - updated - inserted)
+
+    if deleted or updated or inserted:
+        extents_changed()
+    return deleted + updated + inserted
+
+def get_simplify_tolerance():
+    '''
+    Returns the tolerance used to simplify the extent geometries, in the
+    units of the database SRID, from the
+    `ckanext.spatial.simplify_tolerance` config option (0.01 by default).
+    0 means that extents are not simplified.
+    '''
+    return float(config.get('ckanext.spatial.simplify_tolerance',
+                            DEFAULT_SIMPLIFY_TOLERANCE))
+
+def _simplified_geometry_sql(column):
+    # The simplified geometry is only stored if it actually has less
+    # points than the full one, otherwise queries just use the latter
+    return '''CASE WHEN CAST(:tolerance AS double precision) > 0 AND
+                        ST_NPoints(ST_SimplifyPreserveTopology({0}, :tolerance)) < ST_NPoints({0})
+                   THEN ST_SimplifyPreserveTopology({0}, :tolerance) END'''.format(column)
+
+def _simplify_tolerance_sql():
+    return '''CASE WHEN CAST(:tolerance AS double precision) > 0
+                   THEN CAST(:tolerance AS double precision) END'''
+
+def simplify_package_extents(package_ids, tolerance=None):
+    '''Updates the simplified geometries of the extents of the provided
+       packages, eg after changing `ckanext.spatial.simplify_tolerance`.
+
+       package_ids: list of package unique identifiers
+       tolerance: Tolerance used to simplify the geometries. If None, it
+                  defaults to the `ckanext.spatial.simplify_tolerance`
+                  config option.
+
+       Returns the number of extents simplified.
+
+       The responsibility for calling model.Session.commit() is left to the
+       caller.
+    '''
+    if not package_ids:
+        return 0
+    if tolerance is None:
+        tolerance = get_simplify_tolerance()
+
+    params = dict(('package_id_%i' % i, package_id)
+                  for i, package_id in enumerate(package_ids))
+    params['tolerance'] = tolerance
+    sql = '''UPDATE package_extent
+             SET the_geom_simplified = {simplified},
+                 simplify_tolerance = {simplify_tolerance}
+             WHERE package_id IN ({package_ids})
+             RETURNING the_geom_simplified IS NOT NULL'''.format(
+        simplified=_simplified_geometry_sql('the_geom'),
+        simplify_tolerance=_simplify_tolerance_sql(),
+        package_ids=', '.join(':package_id_%i' % i
+                              for i in range(len(package_ids))))
+    return len([row for row in Session.execute(sql, params) if row[0]])
 
 def validate_bbox(bbox_values):
     '''
@@ -113,6 +317,8 @@ def validate_bbox(bbox_values):
 
     return bbox
 
+_bbox_template = Template('POLYGON (($minx $miny, $minx $maxy, $maxx $maxy, $maxx $miny, $minx $miny))')
+
 def _bbox_2_wkt(bbox, srid):
     '''
     Given a bbox dictionary, return a WKTSpatialElement, transformed
@@ -122,12 +328,10 @@ def _bbox_2_wkt(bbox, srid):
     '''
     db_srid = int(config.get('ckan.spatial.srid', '4326'))
 
-    bbox_template = Template('POLYGON (($minx $miny, $minx $maxy, $maxx $maxy, $maxx $miny, $minx $miny))')
-
-    wkt = bbox_template.substitute(minx=bbox['minx'],
-                                        miny=bbox['miny'],
-                                        maxx=bbox['maxx'],
-                                        maxy=bbox['maxy'])
+    wkt = _bbox_template.substitute(minx=bbox['minx'],
+                                    miny=bbox['miny'],
+                                    maxx=bbox['maxx'],
+                                    maxy=bbox['maxy'])
 
     if srid and srid != db_srid:
         # Input geometry needs to be transformed to the one used on the database
@@ -136,6 +340,50 @@ def _bbox_2_wkt(bbox, srid):
         input_geometry = WKTElement(wkt,db_srid)
     return input_geometry
 
+# The query box, in the database SRID
+_query_geometry_sql = 'ST_Transform(ST_GeomFromText(:query_bbox, :query_srid), :db_srid)'
+
+def _bbox_query_params(bbox, srid=None):
+    db_srid = int(config.get('ckan.spatial.srid', '4326'))
+    return {
+        'query_bbox': _bbox_template.substitute(minx=bbox['minx'],
+                                                miny=bbox['miny'],
+                                                maxx=bbox['maxx'],
+                                                maxy=bbox['maxy']),
+        'query_srid': int(srid) if srid else db_srid,
+        'db_srid': db_srid,
+    }
+
+def _bbox_intersects_sql():
+    '''
+    Returns the SQL condition that checks if an extent intersects the query
+    box (see `_bbox_query_params`).
+
+    After the index based filter on the bounding boxes, extents with a
+    bounding box inside the query box match straight away (only if the query
+    box is in the database SRID, otherwise once transformed it is no longer
+    a rectangle and the shortcut does not hold). For the rest,
+    the simplified geometry is used if there is one: as all the points of
+    the full geometry are within the simplification tolerance of it,
+    extents further than that from the query box do not match, and extents
+    that intersect the query box shrunk by the tolerance do. Only the
+    extents on the boundary of the query box (or with no simplified
+    geometry) are checked against the full geometry.
+    '''
+    return '''package_extent.the_geom && {query_geom}
+        AND CASE
+            WHEN :query_srid = :db_srid
+                AND package_extent.the_geom @ {query_geom} THEN true
+            WHEN package_extent.the_geom_simplified IS NULL
+                THEN ST_Intersects(package_extent.the_geom, {query_geom})
+            WHEN NOT ST_DWithin(package_extent.the_geom_simplified, {query_geom},
+                                package_extent.simplify_tolerance) THEN false
+            WHEN ST_Intersects(package_extent.the_geom_simplified,
+                               ST_Buffer({query_geom}, -package_extent.simplify_tolerance))
+                THEN true
+            ELSE ST_Intersects(package_extent.the_geom, {query_geom})
+        END'''.format(query_geom=_query_geometry_sql)
+
 def bbox_query(bbox,srid=None):
     '''
     Performs a spatial query of a bounding box.
@@ -146,44 +394,201 @@ def bbox_query(bbox,srid=None):
     by ID.
     '''
 
-    input_geometry = _bbox_2_wkt(bbox, srid)
-
     extents = Session.query(PackageExtent) \
               .filter(PackageExtent.package_id==Package.id) \
-              .filter(PackageExtent.the_geom.intersects(input_geometry)) \
-              .filter(Package.state==u'active')
+              .filter(sql_text(_bbox_intersects_sql())) \
+              .filter(Package.state==u'active') \
+              .params(**_bbox_query_params(bbox, srid))
     return extents
 
+# Columns returned by the functions decorated with `cached_bbox_query`. The
+# extent is the same as its envelope for points and for rectangles (the
+# only polygons with 5 points and the same area as their envelope)
+_extent_rows_sql = '''package_extent.package_id, package_extent.minx,
+    package_extent.miny, package_extent.maxx, package_extent.maxy,
+    (GeometryType(package_extent.the_geom) = 'POINT'
+     OR (ST_NPoints(package_extent.the_geom) = 5
+         AND ST_Area(package_extent.the_geom) = package_extent.area))'''
+
+@cached_bbox_query()
+def bbox_query_ids(bbox, srid=None):
+    '''
+    Performs the same query as `bbox_query`, but only returns the ids of
+    the matching packages, as a list.
+
+    Results are cached, see `ckanext.spatial.lib.query_cache`.
+    '''
+    sql = '''SELECT {columns}
+             FROM package_extent, package
+             WHERE package_extent.package_id = package.id
+                AND {intersects}
+                AND package.state = 'active'
+          '''.format(columns=_extent_rows_sql, intersects=_bbox_intersects_sql())
+    return Session.execute(sql, _bbox_query_params(bbox, srid)).fetchall()
+
+@cached_bbox_query(exclude=True)
+def bbox_query_excluded_ids(bbox, srid=None):
+    '''
+    Returns the ids of the packages with an extent that does not intersect
+    the bounding box, as a list.
+
+    Results are cached, see `ckanext.spatial.lib.query_cache`.
+    '''
+    sql = '''SELECT {columns} FROM package_extent
+             WHERE NOT ({intersects})'''.format(columns=_extent_rows_sql,
+                                                intersects=_bbox_intersects_sql())
+    return Session.execute(sql, _bbox_query_params(bbox, srid)).fetchall()
+
+def extentless_package_ids():
+    '''
+    Returns the ids of the active packages with a spatial extra but no
+    stored extent (eg because their geometry is not valid), as a list.
+
+    They have to be excluded explicitly when filtering the search results
+    by the spatial extra. Results are cached along with the bounding box
+    queries, see `ckanext.spatial.lib.query_cache`.
+    '''
+    cache = get_cache()
+    key = ('extentless_package_ids',)
+    if cache is not None:
+        package_ids = cache.get(key)
+        if package_ids is not None:
+            return package_ids
+        generation = cache.generation
+
+    sql = '''SELECT package.id
+             FROM package
+             JOIN package_extra ON package_extra.package_id = package.id
+             LEFT OUTER JOIN package_extent
+                ON package_extent.package_id = package.id
+             WHERE package.state = 'active'
+                AND package_extra.key = 'spatial'
+                AND package_extra.state = 'active'
+                AND package_extent.package_id IS NULL'''
+    package_ids = [row[0] for row in Session.execute(sql)]
+
+    if cache is not None:
+        cache.set(key, package_ids, generation)
+    return package_ids
+
+def _bbox_filter_ids(package_ids, bbox, srid=None):
+    '''
+    Returns the ids, out of the provided ones, of the packages with an
+    extent that intersects the bounding box.
+    '''
+    params = _bbox_query_params(bbox, srid)
+    keys = []
+    for i, package_id in enumerate(package_ids):
+        params['package_id_%i' % i] = package_id
+        keys.append(':package_id_%i' % i)
+    sql = '''SELECT package_extent.package_id FROM package_extent
+             WHERE package_extent.package_id IN ({package_ids})
+                AND {intersects}'''.format(package_ids=', '.join(keys),
+                                            intersects=_bbox_intersects_sql())
+    return [row[0] for row in Session.execute(sql, params)]
+
+def _spatial_ranking_sql(bbox, params):
+    '''
+    Returns the SQL expression for the spatial ranking of the extents, adding
+    the parameters it needs to `params` (see `_bbox_query_params`).
+
+    The ranking method is the one from "USGS - 2006-1279" (Lanfear). By
+    default it is computed from the envelopes of the extents stored on the
+    package_extent table. Set `ckanext.spatial.use_exact_geometry_ranking`
+    to True to compute it from the simplified geometries (or the full ones
+    if they were not simplified), which is much slower for complex
+    geometries.
+    '''
+    # The envelopes are stored in the database SRID
+    exact_ranking = toolkit.asbool(
+        config.get('ckanext.spatial.use_exact_geometry_ranking', False)) or \
+        params['query_srid'] != params['db_srid']
+
+    if exact_ranking:
+        geom = 'COALESCE(package_extent.the_geom_simplified, package_extent.the_geom)'
+        return '''POWER(ST_Area(ST_Intersection({geom}, {query_geom})), 2)
+                   / NULLIF(ST_Area({geom}), 0) / NULLIF(ST_Area({query_geom}), 0)'''.format(
+            geom=geom, query_geom=_query_geometry_sql)
+
+    params.update(bbox)
+    params['search_area'] = (bbox['maxx'] - bbox['minx']) * \
+                            (bbox['maxy'] - bbox['miny'])
+
+    # Same ranking, using the intersection of the stored envelope with
+    # the query box. Extents with no area (points and lines) are ranked
+    # last
+    return '''POWER(GREATEST(0, LEAST(package_extent.maxx, :maxx) - GREATEST(package_extent.minx, :minx)) *
+                     GREATEST(0, LEAST(package_extent.maxy, :maxy) - GREATEST(package_extent.miny, :miny)), 2)
+               / NULLIF(package_extent.area, 0) / NULLIF(:search_area, 0)'''
+
+_ranked_extents_sql = '''
+    SELECT package_extent.package_id AS package_id,
+           {ranking} AS spatial_ranking
+    FROM package_extent, package
+    WHERE package_extent.package_id = package.id
+        AND {intersects}
+        AND package.state = 'active'
+'''
+
 def bbox_query_ordered(bbox, srid=None):
     '''
     Performs a spatial query of a bounding box. Returns packages in order
     of how similar the data\'s bounding box is to the search box (best first).
+    See `_spatial_ranking_sql` for the details of the ranking.
 
     bbox - bounding box dict
 
-    Returns a query object of PackageExtents, which each reference a package
-    by ID.
+    Returns a list of rows with the package_id and spatial_ranking of all
+    the matching extents.
     '''
 
-    input_geometry = _bbox_2_wkt(bbox, srid)
-
-    params = {'query_bbox': str(input_geometry),
-              'query_srid': input_geometry.srid}
-
-    # First get the area of the query box
-    sql = "SELECT ST_Area(ST_GeomFromText(:query_bbox, :query_srid));"
-    params['search_area'] = Session.execute(sql, params).fetchone()[0]
-
-    # Uses spatial ranking method from "USGS - 2006-1279" (Lanfear)
-    sql = """SELECT ST_AsBinary(package_extent.the_geom) AS package_extent_the_geom,
-                    POWER(ST_Area(ST_Intersection(package_extent.the_geom, ST_GeomFromText(:query_bbox, :query_srid))),2)/ST_Area(package_extent.the_geom)/:search_area as spatial_ranking,
-                    package_extent.package_id AS package_id
-             FROM package_extent, package
-             WHERE package_extent.package_id = package.id
-                AND ST_Intersects(package_extent.the_geom, ST_GeomFromText(:query_bbox, :query_srid))
-                AND package.state = 'active'
-             ORDER BY spatial_ranking desc"""
+    params = _bbox_query_params(bbox, srid)
+    sql = (_ranked_extents_sql + '''
+        ORDER BY spatial_ranking DESC NULLS LAST''').format(
+        ranking=_spatial_ranking_sql(bbox, params),
+        intersects=_bbox_intersects_sql())
     extents = Session.execute(sql, params).fetchall()
     log.debug('Spatial results: %r',
-              [('%.2f' % extent.spatial_ranking, extent.package_id) for extent in extents[:20]])
+              [('%.2f' % (extent.spatial_ranking or 0), extent.package_id) for extent in extents[:20]])
     return extents
+
+def bbox_query_ordered_page(bbox, start=0, rows=20, srid=None):
+    '''
+    Performs the same query as `bbox_query_ordered`, but only returns a
+    page of the results, with a single query.
+
+    bbox - bounding box dict
+    start - offset of the first result returned
+    rows - maximum number of results returned
+
+    Returns a tuple with the total number of matching extents and a list
+    of (package_id, spatial_ranking) tuples for the requested page.
+    '''
+
+    params = _bbox_query_params(bbox, srid)
+    params.update({'start': start, 'rows': rows})
+    # The count is returned even if the page is empty
+    sql = ('''
+        WITH ranked AS (''' + _ranked_extents_sql + '''
+        ),
+        page AS (
+            SELECT package_id, spatial_ranking FROM ranked
+            ORDER BY spatial_ranking DESC NULLS LAST, package_id
+            LIMIT :rows OFFSET :start
+        )
+        SELECT total.count, page.package_id, page.spatial_ranking
+        FROM (SELECT count(*) FROM ranked) AS total
+            LEFT JOIN page ON true
+        ORDER BY page.spatial_ranking DESC NULLS LAST, page.package_id''').format(
+        ranking=_spatial_ranking_sql(bbox, params),
+        intersects=_bbox_intersects_sql())
+    results = Session.execute(sql, params).fetchall()
+
+    count = results[0][0]
+    page = [(package_id, spatial_ranking)
+            for total, package_id, spatial_ranking in results
+            if package_id is not None]
+    log.debug('Spatial results: %i, page: %r', count,
+              [('%.2f' % (spatial_ranking or 0), package_id)
+               for package_id, spatial_ranking in page])
+    return count, page
@@ -4,15 +4,81 @@ for convenience.
 """
 
 import logging
+import threading
+import time
+from StringIO import StringIO
+
+import requests
 
 from owslib.etree import etree
 from owslib.fes import PropertyIsEqualTo, SortBy, SortProperty
+from owslib.csw import CatalogueServiceWeb, namespaces
+from owslib import ows
+from owslib import util as ows_util
 
 log = logging.getLogger(__name__)
 
+# Default number of seconds a client returned by get_csw_service is reused
+DEFAULT_CLIENT_TTL = 300
+
 class CswError(Exception):
     pass
 
+
+class PooledCatalogueServiceWeb(CatalogueServiceWeb):
+    """
+    OWSLib CatalogueServiceWeb that sends its requests through a requests
+    Session, so the connections to the server are kept alive and reused
+    between requests instead of opening a new one each time.
+
+    OWSLib has no way of passing a session, so `_invoke` mirrors the one of
+    the OWSLib version in pip-requirements.txt. TestPooledCswClient checks
+    that both give the same results, run it when upgrading OWSLib.
+    """
+    def __init__(self, url, session=None, **kw):
+        self.session = session or requests.Session()
+        CatalogueServiceWeb.__init__(self, url, **kw)
+
+    def _invoke(self):
+        # Same as CatalogueServiceWeb._invoke, but using the session
+        if isinstance(self.request, basestring):  # GET KVP
+            response = self.session.get(self.request, timeout=self.timeout)
+        else:
+            self.request = ows_util.cleanup_namespaces(self.request)
+            self.request = ows_util.xml2string(etree.tostring(self.request))
+            headers = {
+                'Content-type': 'text/xml',
+                'Accept': 'text/xml',
+                'Accept-Language': self.lang,
+            }
+            response = self.session.post(self.url, data=self.request,
+                                         headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        self.response = response.content
+
+        self._exml = etree.parse(StringIO(self.response))
+
+        # Check that the response is a CSW document
+        valid_tags = [ows_util.nspath_eval(tag, namespaces) for tag in (
+            'ows:ExceptionReport',
+            'csw:Capabilities',
+            'csw:DescribeRecordResponse',
+            'csw:GetDomainResponse',
+            'csw:GetRecordsResponse',
+            'csw:GetRecordByIdResponse',
+            'csw:HarvestResponse',
+            'csw:TransactionResponse',
+        )]
+        if self._exml.getroot().tag not in valid_tags:
+            raise RuntimeError('Document is XML, but not CSW-ish')
+
+        exception = self._exml.find(
+            ows_util.nspath_eval('ows:Exception', namespaces))
+        if exception is not None:
+            raise ows.ExceptionReport(self._exml, self.owscommon.namespace)
+        else:
+            self.exceptionreport = None
+
 class OwsService(object):
     def __init__(self, endpoint=None):
         if endpoint is not None:
@@ -49,8 +115,11 @@ class OwsService(object):
         if not hasattr(self, "__ows_obj__"):
             if endpoint is None:
                 raise ValueError("Must specify a service endpoint")
-            self.__ows_obj__ = self._Implementation(endpoint)
+            self.__ows_obj__ = self._create_implementation(endpoint)
         return self.__ows_obj__
+
+    def _create_implementation(self, endpoint):
+        return self._Implementation(endpoint)
     
     def getcapabilities(self, debug=False, **kw):
         ows = self._ows(**kw)
@@ -65,12 +134,24 @@ class CswService(OwsService):
     """
     Perform various operations on a CSW service
     """
-    from owslib.csw import CatalogueServiceWeb as _Implementation
+    _Implementation = PooledCatalogueServiceWeb
 
-    def __init__(self, endpoint=None):
+    def __init__(self, endpoint=None, skip_caps=False, session=None):
+        """
+        skip_caps - don't send a GetCapabilities request when connecting,
+                    for clients that only need GetRecordById/GetRecords
+        session - requests Session to use for the HTTP requests (a new
+                  one is created if not provided)
+        """
+        self.skip_caps = skip_caps
+        self.session = session
         super(CswService, self).__init__(endpoint)
         self.sortby = SortBy([SortProperty('dc:identifier')])
 
+    def _create_implementation(self, endpoint):
+        return self._Implementation(endpoint, session=self.session,
+                                    skip_caps=self.skip_caps)
+
     def getrecords(self, qtype=None, keywords=[],
                    typenames="csw:Record", esn="brief",
                    skip=0, count=10, outputschema="gmd", **kw):
@@ -189,3 +270,70 @@ class CswService(OwsService):
         record["xml"] = '<?xml version="1.0" encoding="UTF-8"?>\n' + record["xml"]
         record["tree"] = mdtree
         return record
+
+    def getrecordsbyid(self, ids=[], esn="full", outputschema="gmd", **kw):
+        """
+        Gets several records with a single GetRecordById request (CSW 2.0.2
+        accepts a comma-separated list of ids).
+
+        Returns a dict mapping each returned record identifier to its
+        metadata XML, serialized as in `getrecordbyid`. Ids not returned by
+        the server are not present in the dict.
+        """
+        from owslib.csw import namespaces
+        csw = self._ows(**kw)
+        kwa = {
+            "esn": esn,
+            "outputschema": namespaces[outputschema],
+            }
+        log.info('Making CSW request: getrecordbyid %r %r', ids, kwa)
+        csw.getrecordbyid(ids, **kwa)
+        if csw.exceptionreport:
+            err = 'Error getting records by id: %r' % \
+                  csw.exceptionreport.exceptions
+            raise CswError(err)
+
+        records = {}
+        # ignore namespace -- Hack to support some CSWs with wrong namespaces
+        for md in csw._exml.iterfind(".//{*}MD_Metadata"):
+            identifier = md.findtext("{*}fileIdentifier/{*}CharacterString")
+            if not identifier:
+                log.warning('Record without identifier in CSW response, ignoring')
+                continue
+            xml = etree.tostring(md, pretty_print=True, encoding=unicode)
+            records[identifier.strip()] = \
+                '<?xml version="1.0" encoding="UTF-8"?>\n' + xml
+        return records
+
+
+# The OWSLib objects keep the state of the last request and requests
+# Sessions are not meant to be shared between threads, so the cached
+# clients are kept per thread (ie per process for the harvest consumers)
+_local = threading.local()
+
+
+def get_csw_service(endpoint, ttl=DEFAULT_CLIENT_TTL, skip_caps=False):
+    """
+    Returns a CswService for the endpoint, reusing the one returned by a
+    previous call if it was created less than `ttl` seconds ago.
+
+    All clients share a pooled HTTP session, so connections to the same
+    server are kept alive between requests. If `skip_caps` is True and no
+    client is cached, the new one will not send a GetCapabilities request.
+    A cached client is reused regardless of how it was created, so cache
+    hits never issue a GetCapabilities request.
+    """
+    if not hasattr(_local, 'services'):
+        _local.services = {}
+        _local.session = requests.Session()
+
+    cached = _local.services.get(endpoint)
+    if cached:
+        created, service = cached
+        if time.time() - created < ttl and (skip_caps or not service.skip_caps):
+            log.debug('Reusing CSW client for %s', endpoint)
+            return service
+
+    service = CswService(endpoint, skip_caps=skip_caps, session=_local.session)
+    _local.services[endpoint] = (time.time(), service)
+    return service
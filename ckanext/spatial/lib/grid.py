@@ -0,0 +1,102 @@
+'''
+Quantization of the query bounding boxes for the Solr search backends
+
+Map based searches send slightly different coordinates on every pan or
+zoom, so the spatial filters sent to Solr are almost never the same, and
+Solr's filterCache fills up with entries that are only used once. If
+`ckanext.spatial.solr_grid_size` is set (in degrees), the bounding box used
+on the cached spatial filters is expanded outwards to the closest lines of
+a grid of that size, so nearby views share the same filter. The exact
+bounding box is then applied with an additional filter that is not cached,
+only when it differs from the snapped one.
+
+The reuse of the snapped filters is estimated on each process by
+simulating Solr's filterCache with an LRU of the same size
+(`ckanext.spatial.solr_grid.filter_cache_size`, 512 by default), and its
+simulated hit ratio is logged every 1000 searches. It does not query Solr,
+so it only accounts for the spatial filters sent by this process.
+'''
+import logging
+import sys
+import threading
+
+from ckan.lib.base import config
+
+from ckanext.spatial.lib import query_cache
+from ckanext.spatial.lib.query_cache import QueryCache
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FILTER_CACHE_SIZE = 512
+LOG_INTERVAL = 1000
+
+
+def snap_bbox(bbox, grid_size):
+    '''
+    Returns the bounding box (a dict like the ones returned by
+    `validate_bbox`) expanded outwards to the closest lines of a grid with
+    cells of `grid_size` degrees. The snapped coordinates are kept within
+    -180 and 180 and -90 and 90. Boxes crossing the dateline (with a maxx
+    over 180) are snapped too, but never span more than 360 degrees.
+    '''
+    snapped = query_cache.snap_bbox(bbox, grid_size)
+    minx = max(snapped['minx'], min(-180, bbox['minx']))
+    if bbox['maxx'] <= 180:
+        maxx = min(snapped['maxx'], 180)
+    else:
+        maxx = min(snapped['maxx'], minx + 360)
+    return {
+        'minx': minx,
+        'miny': max(snapped['miny'], min(-90, bbox['miny'])),
+        'maxx': maxx,
+        'maxy': min(snapped['maxy'], max(90, bbox['maxy'])),
+    }
+
+
+_filters = None
+_lock = threading.Lock()
+
+
+def record_filter(key):
+    '''
+    Records the use of a snapped spatial filter, returning True if it was
+    used recently enough to be probably on Solr's filterCache.
+    '''
+    global _filters
+    with _lock:
+        if _filters is None:
+            size = int(config.get('ckanext.spatial.solr_grid.filter_cache_size',
+                                  DEFAULT_FILTER_CACHE_SIZE))
+            _filters = QueryCache(size, ttl=sys.maxint)
+
+    hit = _filters.get(key) is not None
+    if not hit:
+        _filters.set(key, True)
+
+    stats = get_stats()
+    if not stats['searches'] % LOG_INTERVAL:
+        log.info('Spatial filters reused on %.1f%% of %i searches, simulating '
+                 'a filterCache of %i entries (%i distinct filters)',
+                 stats['simulated_hit_ratio'] * 100, stats['searches'],
+                 stats['simulated_cache_size'], stats['distinct_filters'])
+    return hit
+
+
+def get_stats():
+    '''
+    Returns the statistics of the snapped filters used by this process: the
+    number of `searches`, the `distinct_filters` on the simulated
+    filterCache and its `simulated_cache_size`, and the
+    `simulated_hit_ratio`. They are not the
+    statistics of Solr's filterCache, which can be checked on the Solr
+    admin interface.
+    '''
+    if _filters is None:
+        return {}
+    stats = _filters.stats()
+    return {
+        'searches': stats['hits'] + stats['misses'],
+        'distinct_filters': stats['size'],
+        'simulated_cache_size': stats['max_size'],
+        'simulated_hit_ratio': stats['hit_ratio'],
+    }
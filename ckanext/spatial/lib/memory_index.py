@@ -0,0 +1,253 @@
+'''
+In-memory spatial index for the `memory` search backend
+
+The extents of all active datasets are loaded from the package_extent table
+into an R-tree (shapely's STRtree) on the first search of each process, and
+bounding box searches are answered from it, using prepared geometries for
+the exact intersection check, without querying the database.
+
+The index is kept up to date with the changes made on the same process by
+the `spatial_metadata` plugin, once they are committed (see
+`update_extent`). The index is checked against the package_extent table
+when the extents change on any process (see
+`ckanext.spatial.lib.query_cache`), or every
+`ckanext.spatial.memory_index.refresh_interval` seconds (300 by default),
+and reloaded if the stored extents differ from the ones in memory.
+'''
+import hashlib
+import logging
+import threading
+import time
+
+from shapely import wkb
+from shapely.geometry import shape as to_shape, box
+from shapely.prepared import prep
+
+from ckan.model import Session
+from ckan.lib.base import config
+
+from ckanext.spatial.lib import geometry_fingerprint
+from ckanext.spatial.lib import query_cache
+
+log = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 300
+
+# Number of changed extents after which the R-tree is rebuilt. Until then
+# they are checked one by one
+REBUILD_THRESHOLD = 100
+
+
+class MemoryIndex(object):
+    '''
+    Spatial index of the dataset extents
+
+    STRtrees can not be modified once built, so the extents added, changed
+    or removed afterwards are kept apart and checked individually until the
+    tree is rebuilt, which happens on the next query once there are more
+    than `REBUILD_THRESHOLD` of them.
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # package_id -> (geometry, prepared geometry, fingerprint)
+        self.extents = {}
+        self.loaded = None
+
+        self._tree = None
+        self._tree_package_ids = []
+        self._tree_geometry_ids = {}
+        self._pending = set()
+
+    def load(self):
+        '''
+        Loads the extents of all the active datasets from the database and
+        builds the tree.
+        '''
+        t0 = time.time()
+        rows = Session.execute(
+            '''SELECT package_extent.package_id, ST_AsBinary(package_extent.the_geom),
+                      package_extent.geom_fingerprint
+               FROM package_extent, package
+               WHERE package_extent.package_id = package.id
+                   AND package.state = 'active' ''')
+        extents = {}
+        for package_id, geom, fingerprint in rows:
+            shape = wkb.loads(str(geom))
+            extents[package_id] = (shape, prep(shape), fingerprint or '')
+
+        with self.lock:
+            self.extents = extents
+            self.loaded = time.time()
+            self._build()
+        log.info('Loaded %i extents in the spatial index in %.2fs',
+                 len(extents), time.time() - t0)
+
+    def _build(self):
+        # Requires Shapely >= 1.4, only imported when the backend is used
+        from shapely.strtree import STRtree
+
+        package_ids = self.extents.keys()
+        geometries = [self.extents[package_id][0] for package_id in package_ids]
+        # Depending on the shapely version, queries return the geometries
+        # or their positions
+        self._tree_package_ids = package_ids
+        self._tree_geometry_ids = dict(
+            (id(geometry), package_id)
+            for geometry, package_id in zip(geometries, package_ids))
+        self._tree = STRtree(geometries) if geometries else None
+        self._pending = set()
+
+    def update(self, package_id, shape=None, fingerprint=''):
+        '''
+        Adds, updates or (if `shape` is None) removes the extent of a
+        dataset.
+        '''
+        with self.lock:
+            if shape is None:
+                self.extents.pop(package_id, None)
+            else:
+                self.extents[package_id] = (shape, prep(shape), fingerprint)
+            self._pending.add(package_id)
+
+    def query(self, bbox):
+        '''
+        Returns the ids of the datasets with an extent that intersects the
+        provided bounding box (a dict like the ones returned by
+        `validate_bbox`).
+        '''
+        query_box = box(bbox['minx'], bbox['miny'], bbox['maxx'], bbox['maxy'])
+
+        with self.lock:
+            if len(self._pending) > REBUILD_THRESHOLD:
+                self._build()
+            candidates = set(self._pending)
+            if self._tree is not None:
+                for result in self._tree.query(query_box):
+                    if hasattr(result, 'geom_type'):
+                        package_id = self._tree_geometry_ids[id(result)]
+                    else:
+                        package_id = self._tree_package_ids[int(result)]
+                    if package_id not in self._pending:
+                        candidates.add(package_id)
+            extents = [(package_id, self.extents.get(package_id))
+                       for package_id in candidates]
+
+        return [package_id for package_id, extent in extents
+                if extent and extent[1].intersects(query_box)]
+
+    def digest(self):
+        '''
+        Returns a hash of the ids and fingerprints of the extents on the
+        index, to compare it with the one from the database.
+        '''
+        with self.lock:
+            items = sorted((package_id, extent[2])
+                           for package_id, extent in self.extents.iteritems())
+        return hashlib.md5(u','.join(package_id + fingerprint
+                                     for package_id, fingerprint in items)
+                           .encode('utf8')).hexdigest()
+
+    def check(self):
+        '''
+        Reloads the index if the extents on the database are different from
+        the ones in memory.
+        '''
+        self.loaded = time.time()
+        db_digest = Session.execute(
+            '''SELECT md5(COALESCE(string_agg(
+                   package_extent.package_id || COALESCE(package_extent.geom_fingerprint, ''),
+                   ',' ORDER BY package_extent.package_id COLLATE "C"), ''))
+               FROM package_extent, package
+               WHERE package_extent.package_id = package.id
+                   AND package.state = 'active' ''').scalar()
+        if db_digest != self.digest():
+            log.info('Spatial index out of date, reloading it')
+            self.load()
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    '''
+    Returns the spatial index of this process, loading it the first time and
+    checking it against the database if the refresh interval has passed.
+    '''
+    global _index
+
+    query_cache.poll()
+
+    with _index_lock:
+        if _index is None:
+            index = MemoryIndex()
+            index.load()
+            _index = index
+
+    refresh_interval = int(config.get(
+        'ckanext.spatial.memory_index.refresh_interval', DEFAULT_REFRESH_INTERVAL))
+    if time.time() - _index.loaded > refresh_interval:
+        _index.check()
+    return _index
+
+
+def check_index():
+    '''
+    Makes the next search check the spatial index of this process against
+    the database. It is called whenever the extents change, on this or any
+    other process.
+    '''
+    if _index is not None:
+        # As if it was last checked long ago
+        _index.loaded = 0
+
+query_cache.on_extents_changed(check_index)
+
+
+def update_extent(session, package_id, geometry=None):
+    '''
+    Queues an update of the extent of a dataset on the spatial index of
+    this process, if it has been loaded, which is applied once `session` is
+    committed (see `apply_updates`). `geometry` is a loaded GeoJSON object,
+    or None if the dataset has no extent or is not active.
+    '''
+    if _index is None:
+        return
+    if not hasattr(session, '_spatial_index_updates'):
+        session._spatial_index_updates = {}
+    session._spatial_index_updates[package_id] = geometry
+
+
+def apply_updates(session):
+    '''
+    Applies the updates queued with `update_extent` for `session` to the
+    spatial index of this process.
+    '''
+    updates = getattr(session, '_spatial_index_updates', None)
+    session._spatial_index_updates = {}
+    if not updates or _index is None:
+        return
+    srid = int(config.get('ckan.spatial.srid', '4326'))
+    for package_id, geometry in updates.iteritems():
+        if geometry:
+            shape = to_shape(geometry)
+            _index.update(package_id, shape, geometry_fingerprint(shape, srid))
+        else:
+            _index.update(package_id, None)
+
+
+def discard_updates(session):
+    '''
+    Discards the updates queued with `update_extent` for `session`, eg
+    because it was rolled back.
+    '''
+    session._spatial_index_updates = {}
+
+
+def bbox_query_ids(bbox):
+    '''
+    Returns the ids of the datasets with an extent that intersects the
+    provided bounding box, using the in-memory index.
+    '''
+    return get_index().query(bbox)
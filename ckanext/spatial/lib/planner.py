@@ -0,0 +1,228 @@
+'''
+Query planning for the postgis search backend
+
+Enumerating the ids of all the datasets matched by a big bounding box (eg
+the whole world) and sending them to Solr is the most expensive part of a
+spatial search on the postgis backend. Before running the query, the
+fraction of the extents matched by the bounding box is estimated with
+cheap statistics, and one of the following plans is chosen:
+
+* `all`: the bounding box contains the extents of all datasets, so the
+  spatial filter is replaced by a Solr filter on datasets with a `spatial`
+  extra, excluding the ones with no stored extent (eg because their
+  geometry is not valid).
+* `complement`: most of the extents are expected to match, so the ids of
+  the ones that don't are excluded too.
+* `ids`: the ids of the matching datasets are sent to Solr.
+
+'''
+import logging
+import time
+
+from sqlalchemy.exc import DBAPIError
+
+from ckan.model import Session
+from ckan.lib.base import config
+from ckan.lib.helpers import json
+from ckan.plugins import toolkit
+
+from ckanext.spatial.lib import _bbox_query_params, _query_geometry_sql
+from ckanext.spatial.lib import query_cache
+from ckanext.spatial.geoalchemy_common import postgis_version
+
+log = logging.getLogger(__name__)
+
+PLAN_ALL = 'all'
+PLAN_COMPLEMENT = 'complement'
+PLAN_IDS = 'ids'
+
+DEFAULT_COMPLEMENT_THRESHOLD = 0.5
+DEFAULT_EXTENT_CACHE_TTL = 60
+
+_data_extent = None
+
+
+def _estimated_extent():
+    '''
+    Returns the bounding box of the extents estimated from the PostGIS
+    statistics of the geometry column, or None if there are no statistics.
+
+    It is much cheaper than aggregating the envelopes of all the rows, but
+    it is only approximate, and can be outdated until the table is
+    analyzed again.
+    '''
+    version = postgis_version()
+    if version[:1] == '1' or version[:3] == '2.0':
+        function = 'ST_Estimated_Extent'
+    else:
+        function = 'ST_EstimatedExtent'
+
+    # Some PostGIS versions raise an error if there are no statistics
+    savepoint = Session.begin_nested()
+    try:
+        row = Session.execute(
+            '''SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent)
+               FROM (SELECT %s('package_extent', 'the_geom') AS extent) AS estimated'''
+            % function).first()
+        savepoint.commit()
+    except DBAPIError, e:
+        log.debug('Could not estimate the extent of package_extent: %s', e)
+        savepoint.rollback()
+        return None
+
+    if not row or row[0] is None:
+        return None
+    return dict(zip(('minx', 'miny', 'maxx', 'maxy'), row))
+
+
+def _get_data_extent_state():
+    global _data_extent
+
+    query_cache.poll()
+
+    ttl = int(config.get('ckanext.spatial.planner.extent_cache_ttl',
+                         DEFAULT_EXTENT_CACHE_TTL))
+    state = _data_extent
+    if state and time.time() - state['time'] < ttl:
+        return state
+
+    reltuples = Session.execute(
+        '''SELECT reltuples FROM pg_class
+           WHERE oid = CAST('package_extent' AS regclass)''').scalar()
+
+    bbox = None
+    exact = False
+    if reltuples and reltuples > 0:
+        bbox = _estimated_extent()
+    if bbox is None:
+        # Not analyzed yet, scan the envelope columns instead
+        row = Session.execute('''SELECT min(minx), min(miny), max(maxx), max(maxy)
+                                 FROM package_extent''').first()
+        if row and row[0] is not None:
+            bbox = dict(zip(('minx', 'miny', 'maxx', 'maxy'), row))
+        exact = True
+
+    # Replaced as a whole, so requests on other threads always see a
+    # consistent state
+    state = {
+        'bbox': bbox,
+        'exact': exact,
+        'reltuples': reltuples,
+        'estimates': query_cache.QueryCache(ttl=ttl),
+        'time': time.time(),
+    }
+    _data_extent = state
+    return state
+
+
+def get_data_extent():
+    '''
+    Returns the bounding box of all the stored extents, as a dict like the
+    ones returned by `validate_bbox`, or None if there are no extents.
+
+    Once the table has been analyzed, the bounding box is estimated from
+    the PostGIS statistics, so it can be approximate (see
+    `plan_bbox_query`).
+
+    It is cached, along with the selectivity estimates, until the extents
+    change on any process (see `ckanext.spatial.lib.query_cache`), or for
+    `ckanext.spatial.planner.extent_cache_ttl` seconds (60 by default).
+    '''
+    return _get_data_extent_state()['bbox']
+
+
+def reset_data_extent():
+    '''
+    Clears the cached data extent and selectivity estimates. It is called
+    whenever the extents change, on this or any other process.
+    '''
+    global _data_extent
+    _data_extent = None
+
+query_cache.on_extents_changed(reset_data_extent)
+
+
+def _estimated_rows(sql, params):
+    plan = Session.execute('EXPLAIN (FORMAT JSON) ' + sql, params).scalar()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+def estimate_selectivity(bbox, data_extent):
+    '''
+    Returns the estimated fraction (0 to 1) of the stored extents that
+    intersect the provided bounding box.
+
+    It uses the row estimates of the PostgreSQL planner for the index
+    based bounding box filter, which rely on the PostGIS statistics of the
+    geometry column. If the table has not been analyzed yet, the area of
+    the bounding box relative to the data extent is used instead.
+
+    Estimates are cached along with the data extent, for the bounding box
+    snapped to the grid of the query cache.
+    '''
+    state = _get_data_extent_state()
+    reltuples = state['reltuples']
+    estimates = state['estimates']
+
+    bbox = query_cache.cache_bbox(bbox)
+    key = (bbox['minx'], bbox['miny'], bbox['maxx'], bbox['maxy'])
+    selectivity = estimates.get(key)
+    if selectivity is not None:
+        return selectivity
+
+    if reltuples and reltuples > 0:
+        matched = _estimated_rows(
+            'SELECT 1 FROM package_extent WHERE the_geom && %s' % _query_geometry_sql,
+            _bbox_query_params(bbox))
+        selectivity = min(1.0, matched / reltuples)
+    else:
+        width = min(bbox['maxx'], data_extent['maxx']) - max(bbox['minx'], data_extent['minx'])
+        height = min(bbox['maxy'], data_extent['maxy']) - max(bbox['miny'], data_extent['miny'])
+        data_area = (data_extent['maxx'] - data_extent['minx']) * \
+                    (data_extent['maxy'] - data_extent['miny'])
+        if width < 0 or height < 0:
+            selectivity = 0.0
+        elif not data_area:
+            selectivity = 1.0
+        else:
+            selectivity = min(1.0, width * height / data_area)
+
+    estimates.set(key, selectivity)
+    return selectivity
+
+
+def plan_bbox_query(bbox):
+    '''
+    Chooses how to filter the search results by the provided bounding box
+    (see the module docstring), and returns a (plan, selectivity) tuple.
+
+    Queries with an estimated selectivity over
+    `ckanext.spatial.planner.complement_threshold` (0.5 by default) use the
+    `complement` plan. Set `ckanext.spatial.use_query_planner` to False to
+    always use the `ids` plan.
+    '''
+    if not toolkit.asbool(config.get('ckanext.spatial.use_query_planner', True)):
+        return PLAN_IDS, None
+
+    state = _get_data_extent_state()
+    data_extent = state['bbox']
+    if not data_extent:
+        return PLAN_IDS, 0.0
+
+    if (bbox['minx'] <= data_extent['minx'] and bbox['miny'] <= data_extent['miny'] and
+            bbox['maxx'] >= data_extent['maxx'] and bbox['maxy'] >= data_extent['maxy']):
+        # An estimated data extent may miss some extents, so the ones that
+        # don't match are still excluded
+        plan = PLAN_ALL if state['exact'] else PLAN_COMPLEMENT
+        selectivity = 1.0
+    else:
+        selectivity = estimate_selectivity(bbox, data_extent)
+        threshold = float(config.get('ckanext.spatial.planner.complement_threshold',
+                                     DEFAULT_COMPLEMENT_THRESHOLD))
+        plan = PLAN_COMPLEMENT if selectivity > threshold else PLAN_IDS
+
+    log.debug('Spatial query plan for %r: %s (estimated selectivity %.3f)',
+              bbox, plan, selectivity)
+    return plan, selectivity
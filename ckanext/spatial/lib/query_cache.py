@@ -0,0 +1,335 @@
+'''
+Cache of the results of the bounding box queries on PostGIS
+
+Map based search pages send the same (or almost the same) bounding box over
+and over. The results of the bounding box queries are kept on an LRU cache
+on each process, keyed by the query, the bounding box snapped outwards to a
+grid with cells of `ckanext.spatial.query_cache.grid_size` units of the
+database SRID (0.1 by default) and its SRID. The cached results for the
+snapped box include the envelope of each extent, so the exact results for
+the actual bounding box are then obtained without querying the database,
+except for the few extents that are not rectangles and cross its edges.
+
+All cached results are discarded when extents are saved or when datasets
+with an extent are updated (eg when their state changes). The cache keeps a
+generation counter, increased when this happens on the same process and
+when a notification is received on the `ckanext_spatial_extents` PostgreSQL
+channel, which is sent (on commit) every time it happens on any process.
+Entries also expire after `ckanext.spatial.query_cache.ttl` seconds (300 by
+default), in case notifications can't be received. Other modules caching
+data derived from the extents can be notified of these changes too (see
+`on_extents_changed`).
+'''
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from ckan.model import Session, meta
+from ckan.lib.base import config
+
+log = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'ckanext_spatial_extents'
+
+DEFAULT_SIZE = 1000
+DEFAULT_TTL = 300
+DEFAULT_GRID_SIZE = 0.1
+
+BBOX_KEYS = ('minx', 'miny', 'maxx', 'maxy')
+
+
+class QueryCache(object):
+    '''
+    LRU cache with a maximum number of entries and a time to live, which is
+    emptied when its generation changes.
+    '''
+
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Returns the cached value for `key`, or None if there is no valid
+        entry for it.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and time.time() - entry[0] < self.ttl:
+                # Move it to the end, as the most recently used
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, generation=None):
+        '''
+        Stores a value. If `generation` is provided and the cache has been
+        invalidated since, the value is discarded, as it might be outdated.
+        '''
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        '''
+        Discards all the entries, starting a new generation.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.size,
+            'generation': self.generation,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else None,
+        }
+
+
+class ExtentsListener(object):
+    '''
+    Listens to the notifications sent when the extents are saved, on a
+    dedicated database connection. Notifications are checked without
+    blocking or querying the database when `poll` is called.
+    '''
+
+    def __init__(self):
+        self.pid = os.getpid()
+        connection = meta.engine.raw_connection()
+        # Keep it out of the pool, it is only used by the listener
+        connection.detach()
+        self.connection = connection.connection
+        self.connection.set_isolation_level(0)  # Autocommit
+        self.connection.cursor().execute('LISTEN %s' % NOTIFY_CHANNEL)
+
+    def poll(self):
+        '''
+        Returns True if any notification has been received since the last
+        call.
+        '''
+        self.connection.poll()
+        if self.connection.notifies:
+            del self.connection.notifies[:]
+            return True
+        return False
+
+
+_cache = None
+_listener = None
+_callbacks = []
+_lock = threading.Lock()
+
+
+def on_extents_changed(callback):
+    '''
+    Registers a function (with no arguments) to be called on this process
+    whenever extents or datasets with an extent are changed, on this or any
+    other process (as long as `poll` or `get_cache` are called).
+    '''
+    _callbacks.append(callback)
+
+
+def _invalidate():
+    if _cache is not None:
+        _cache.invalidate()
+    for callback in _callbacks:
+        try:
+            callback()
+        except Exception, e:
+            log.error('Error invalidating data derived from the extents: %s', e)
+
+
+def poll():
+    '''
+    Checks if any notification has been received since the last call,
+    invalidating the cached data of this process if so.
+    '''
+    global _listener
+
+    changed = False
+    with _lock:
+        if _listener is None or _listener.pid != os.getpid():
+            try:
+                _listener = ExtentsListener()
+            except Exception, e:
+                log.warning('Could not listen to the extents notifications, '
+                            'cached results will be used until they expire: %s', e)
+                _listener = False
+            # Changes might have been missed while not listening
+            changed = True
+        elif _listener:
+            try:
+                changed = _listener.poll()
+            except Exception, e:
+                log.warning('Error checking the extents notifications: %s', e)
+                _listener = None
+                changed = True
+
+    if changed:
+        _invalidate()
+
+
+def get_cache():
+    '''
+    Returns the cache of this process, or None if it is disabled (setting
+    `ckanext.spatial.query_cache.size` to 0).
+
+    Any notification received since the last call invalidates the cache.
+    '''
+    global _cache
+
+    with _lock:
+        if _cache is None:
+            size = int(config.get('ckanext.spatial.query_cache.size', DEFAULT_SIZE))
+            ttl = int(config.get('ckanext.spatial.query_cache.ttl', DEFAULT_TTL))
+            _cache = QueryCache(size, ttl)
+    poll()
+
+    return _cache if _cache.size else None
+
+
+def extents_changed():
+    '''
+    Invalidates the cached data of this process and notifies the other
+    ones. The notification is only delivered if the current transaction is
+    committed.
+    '''
+    _invalidate()
+    Session.execute('NOTIFY %s' % NOTIFY_CHANNEL)
+
+
+def snap_bbox(bbox, grid_size, inward=False):
+    '''
+    Returns the bounding box (a dict like the ones returned by
+    `validate_bbox`) expanded outwards to the closest lines of a grid with
+    cells of `grid_size` units, or shrunk inwards if `inward` is True. The
+    result always contains (or is contained in) the original one.
+    '''
+    def snap(value, rounding):
+        # Round to avoid float noise (eg 0.3 / 0.1 = 2.9999999999999996, or
+        # 3 * 0.1 = 0.30000000000000004) on the grid lines
+        return round(rounding(round(value / grid_size, 9)) * grid_size, 10)
+
+    if inward:
+        return {
+            'minx': max(bbox['minx'], snap(bbox['minx'], math.ceil)),
+            'miny': max(bbox['miny'], snap(bbox['miny'], math.ceil)),
+            'maxx': min(bbox['maxx'], snap(bbox['maxx'], math.floor)),
+            'maxy': min(bbox['maxy'], snap(bbox['maxy'], math.floor)),
+        }
+    return {
+        'minx': min(bbox['minx'], snap(bbox['minx'], math.floor)),
+        'miny': min(bbox['miny'], snap(bbox['miny'], math.floor)),
+        'maxx': max(bbox['maxx'], snap(bbox['maxx'], math.ceil)),
+        'maxy': max(bbox['maxy'], snap(bbox['maxy'], math.ceil)),
+    }
+
+
+def cache_bbox(bbox, srid=None, inward=False):
+    '''
+    Returns the bounding box used to cache the results of queries for the
+    provided one, snapped to the grid set on
+    `ckanext.spatial.query_cache.grid_size` (see `snap_bbox`).
+
+    The bounding box is returned unchanged if the grid is disabled, if
+    `srid` is not the database SRID, or if it would shrink to nothing.
+    '''
+    bbox = dict((key, bbox[key]) for key in BBOX_KEYS)
+    grid_size = float(config.get('ckanext.spatial.query_cache.grid_size',
+                                 DEFAULT_GRID_SIZE))
+    db_srid = int(config.get('ckan.spatial.srid', '4326'))
+    # The envelopes of the extents are in the database SRID
+    if not grid_size or (srid and int(srid) != db_srid):
+        return bbox
+
+    snapped = snap_bbox(bbox, grid_size, inward)
+    if snapped['minx'] >= snapped['maxx'] or snapped['miny'] >= snapped['maxy']:
+        # Shrunk inwards to nothing
+        return bbox
+    return snapped
+
+
+def refine_rows(rows, bbox, srid=None, exclude=False):
+    '''
+    Returns the ids of the rows (see `cached_bbox_query`) with an extent
+    that intersects the bounding box, or that doesn't if `exclude` is True.
+    Rows with no envelope are considered not to intersect it.
+
+    Extents with an envelope that doesn't intersect the bounding box, that
+    is inside it, or that are the same as their envelope are checked
+    straight away. The rest are checked on the database.
+    '''
+    intersecting = set()
+    to_check = []
+    for package_id, minx, miny, maxx, maxy, is_box in rows:
+        if minx is None or maxx < bbox['minx'] or minx > bbox['maxx'] \
+                or maxy < bbox['miny'] or miny > bbox['maxy']:
+            continue
+        if is_box or (minx >= bbox['minx'] and maxx <= bbox['maxx'] and
+                      miny >= bbox['miny'] and maxy <= bbox['maxy']):
+            intersecting.add(package_id)
+        else:
+            to_check.append(package_id)
+
+    if to_check:
+        from ckanext.spatial.lib import _bbox_filter_ids
+        intersecting.update(_bbox_filter_ids(to_check, bbox, srid))
+
+    return [row[0] for row in rows if (row[0] in intersecting) != exclude]
+
+
+def cached_bbox_query(exclude=False):
+    '''
+    Decorator for functions taking a bounding box dict and an optional
+    SRID and returning a list of (package_id, minx, miny, maxx, maxy,
+    is_box) rows, with the envelope of each extent (in the database SRID)
+    and whether the extent is the same as its envelope. The decorated
+    function returns the list of package ids.
+
+    Rows are cached for the bounding box snapped outwards to the grid, or
+    inwards if `exclude` is True (for functions that return the extents
+    that don't intersect the bounding box), and the ids for the actual
+    bounding box are then obtained with `refine_rows`.
+    '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(bbox, srid=None):
+            cache = get_cache()
+            if cache is None:
+                return [row[0] for row in function(bbox, srid)]
+
+            snapped = cache_bbox(bbox, srid, exclude)
+            key = (function.__name__, snapped['minx'], snapped['miny'],
+                   snapped['maxx'], snapped['maxy'], srid)
+            rows = cache.get(key)
+            if rows is None:
+                generation = cache.generation
+                rows = function(snapped, srid)
+                cache.set(key, rows, generation)
+
+            if all(snapped[key] == bbox[key] for key in BBOX_KEYS):
+                return [row[0] for row in rows]
+            return refine_rows(rows, bbox, srid, exclude)
+
+        return wrapper
+    return decorator
@@ -0,0 +1,279 @@
+'''
+Spatial ranking of datasets using NumPy
+
+The envelopes of the extents of all active datasets (as stored on the
+package_extent table) are written to a file of packed records (the dataset
+id followed by minx, miny, maxx and maxy as float64 values, and whether the
+extent is the same as its envelope), which every process maps in memory, so
+the operating system keeps a single copy of it shared by all of them.
+Ranking the datasets for a bounding box is then done in a single vectorized
+pass over the array. Only the extents that are not rectangles and cross the
+edges of the bounding box are checked on the database, so the results are
+the same as the ones of `bbox_query_ordered_page`.
+
+The file is written to the `ckanext.spatial.ranking.directory` directory
+(a `spatial_ranking` folder on `ckan.storage_path` or `cache_dir` by
+default). When the extents change on any process (see
+`ckanext.spatial.lib.query_cache`), rankings are computed on PostGIS until
+the file is rewritten, on a background thread of the first process that
+needs it. It is also rewritten once it is older than
+`ckanext.spatial.ranking.max_age` seconds (300 by default), in case
+notifications can't be received, and it can be rewritten at any moment
+running `paster spatial envelopes`. If
+`ckanext.spatial.ranking.write_in_background` is False, processes never
+write the file, and it is only rewritten by the command (eg from cron).
+
+It requires NumPy to be installed.
+'''
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from ckan.model import Session
+from ckan.lib.base import config
+from ckan.plugins import toolkit
+
+from ckanext.spatial.lib import query_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+FILE_NAME = 'envelopes.npy'
+DEFAULT_MAX_AGE = 300
+
+# Writers that crashed might leave the lock file behind
+LOCK_TIMEOUT = 600
+
+
+def get_directory():
+    '''
+    Returns the directory of the envelopes file, creating it if needed.
+    '''
+    directory = config.get('ckanext.spatial.ranking.directory')
+    if not directory:
+        base = config.get('ckan.storage_path') or config.get('cache_dir')
+        if not base:
+            raise ValueError('The directory of the spatial ranking file could '
+                             'not be determined. Please set '
+                             'ckanext.spatial.ranking.directory on the ini file.')
+        directory = os.path.join(base, 'spatial_ranking')
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another process
+            pass
+    return directory
+
+
+def write_envelopes(directory=None):
+    '''
+    Writes the envelopes of the extents of all active datasets to the
+    envelopes file, sorted by package id. The file is replaced atomically,
+    so processes using the previous one are not affected, and its
+    modification time is set to the time the extents were read.
+
+    Returns the number of envelopes written.
+    '''
+    from ckanext.spatial.lib import _extent_rows_sql
+
+    directory = directory or get_directory()
+    started = time.time()
+    rows = Session.execute(
+        '''SELECT {columns}
+           FROM package_extent, package
+           WHERE package_extent.package_id = package.id
+               AND package.state = 'active'
+               AND package_extent.minx IS NOT NULL
+           ORDER BY package_extent.package_id'''.format(
+            columns=_extent_rows_sql)).fetchall()
+
+    id_length = max([len(row[0]) for row in rows] or [1])
+    dtype = [('id', 'S%i' % id_length), ('minx', '<f8'), ('miny', '<f8'),
+             ('maxx', '<f8'), ('maxy', '<f8'), ('is_box', '?')]
+    envelopes = numpy.array([(row[0].encode('utf8'),) + tuple(row[1:5]) +
+                             (bool(row[5]),)
+                             for row in rows], dtype=dtype)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.npy.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        numpy.save(f, envelopes)
+    os.utime(tmp_path, (started, started))
+    os.rename(tmp_path, os.path.join(directory, FILE_NAME))
+
+    log.info('Wrote %i extent envelopes to %s', len(envelopes), directory)
+    return len(envelopes)
+
+
+class EnvelopeRanking(object):
+    '''
+    Ranks the datasets by how similar their extent envelopes are to a
+    bounding box, using the memory mapped envelopes file.
+    '''
+
+    def __init__(self, directory=None, max_age=DEFAULT_MAX_AGE,
+                 write_in_background=True):
+        self.directory = directory or get_directory()
+        self.path = os.path.join(self.directory, FILE_NAME)
+        self.max_age = max_age
+        self.write_in_background = write_in_background
+
+        self._envelopes = None
+        self._mtime = None
+        self._changed = None
+        self._writer = None
+        self._lock = threading.Lock()
+
+        # Start listening first, the initial check would mark the file
+        # as outdated
+        query_cache.poll()
+        query_cache.on_extents_changed(self.extents_changed)
+
+    def extents_changed(self):
+        '''
+        Marks the envelopes file as outdated if it was written before now.
+        '''
+        self._changed = time.time()
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+
+        outdated = mtime is None or \
+            (self._changed is not None and mtime < self._changed)
+        if outdated or time.time() - mtime > self.max_age:
+            self._start_writer()
+        if outdated:
+            return None
+
+        if mtime != self._mtime:
+            envelopes = numpy.load(self.path, mmap_mode='r')
+            if 'is_box' not in envelopes.dtype.names:
+                # Written by a previous version
+                self._changed = time.time()
+                return None
+            self._envelopes = envelopes
+            self._mtime = mtime
+        return self._envelopes
+
+    def _start_writer(self):
+        if not self.write_in_background:
+            return
+        if self._writer and self._writer.is_alive():
+            return
+        self._writer = threading.Thread(target=self._write,
+                                        name='spatial-envelopes-writer')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _write(self):
+        # Only one process writes the file, the rest keep using the current
+        # one (if any)
+        lock_path = self.path + '.lock'
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            try:
+                if time.time() - os.stat(lock_path).st_mtime > LOCK_TIMEOUT:
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            return
+        try:
+            os.close(fd)
+            write_envelopes(self.directory)
+        except Exception, e:
+            log.error('Error writing the extent envelopes: %s', e)
+        finally:
+            # The session of this thread
+            Session.remove()
+            os.remove(lock_path)
+
+    def rank(self, bbox, start=0, rows=20):
+        '''
+        Ranks the datasets with an extent that intersects the provided
+        bounding box, using the method from "USGS - 2006-1279" (Lanfear),
+        as `bbox_query_ordered_page` does, and in the same order (datasets
+        with the same ranking are sorted by id).
+
+        Returns a tuple with the total number of matching datasets and a
+        list of (package_id, spatial_ranking) tuples for the requested page,
+        or None if the envelopes file is not available or is outdated.
+        '''
+        from ckanext.spatial.lib import _bbox_filter_ids
+
+        query_cache.poll()
+        with self._lock:
+            envelopes = self._refresh()
+
+        if envelopes is None:
+            return None
+        if not len(envelopes):
+            return 0, []
+
+        minx, miny = envelopes['minx'], envelopes['miny']
+        maxx, maxy = envelopes['maxx'], envelopes['maxy']
+
+        width = numpy.minimum(maxx, bbox['maxx']) - numpy.maximum(minx, bbox['minx'])
+        height = numpy.minimum(maxy, bbox['maxy']) - numpy.maximum(miny, bbox['miny'])
+        matches = numpy.flatnonzero((width >= 0) & (height >= 0))
+
+        # The envelopes of the extents that are not rectangles might
+        # intersect the bounding box while the extents don't
+        inside = (minx[matches] >= bbox['minx']) & (maxx[matches] <= bbox['maxx']) & \
+                 (miny[matches] >= bbox['miny']) & (maxy[matches] <= bbox['maxy'])
+        to_check = matches[~(envelopes['is_box'][matches] | inside)]
+        if len(to_check):
+            ids = [package_id.decode('utf8') for package_id in envelopes['id'][to_check]]
+            intersecting = set(_bbox_filter_ids(ids, bbox))
+            discarded = [i for i, package_id in zip(to_check, ids)
+                         if package_id not in intersecting]
+            matches = numpy.setdiff1d(matches, discarded, assume_unique=True)
+        if not len(matches):
+            return 0, []
+
+        width, height = width[matches], height[matches]
+        area = (maxx[matches] - minx[matches]) * (maxy[matches] - miny[matches])
+        search_area = (bbox['maxx'] - bbox['minx']) * (bbox['maxy'] - bbox['miny'])
+
+        # Extents with no area (points and lines) are ranked last
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ranking = (width * height) ** 2 / area / search_area
+        ranking[~numpy.isfinite(ranking)] = -1
+
+        end = min(start + rows, len(matches))
+        if start >= end:
+            return len(matches), []
+        # Envelopes are sorted by package id, so ties are sorted as on
+        # PostGIS
+        top = numpy.lexsort((matches, -ranking))[start:end]
+
+        ids = envelopes['id'][matches[top]]
+        return len(matches), [
+            (package_id.decode('utf8'), float(value) if value >= 0 else None)
+            for package_id, value in zip(ids, ranking[top])]
+
+
+_ranking = None
+
+
+def get_ranking():
+    '''
+    Returns the ranking object of this process.
+    '''
+    global _ranking
+    if _ranking is None:
+        _ranking = EnvelopeRanking(
+            max_age=int(config.get('ckanext.spatial.ranking.max_age',
+                                   DEFAULT_MAX_AGE)),
+            write_in_background=toolkit.asbool(
+                config.get('ckanext.spatial.ranking.write_in_background', True)))
+    return _ranking
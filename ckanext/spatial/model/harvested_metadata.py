@@ -1,9 +1,27 @@
+import re
+
 from lxml import etree
 
 import logging
 log = logging.getLogger(__name__)
 
 
+def parse_xml_string(xml_str):
+    '''
+    Parses an XML document string into an etree Element.
+
+    Unicode strings are encoded to UTF-8 (removing any XML declaration, as
+    the encoding it declares no longer applies) so callers that already
+    have the document as unicode, eg harvest objects, get it encoded and
+    parsed just once.
+    '''
+    if isinstance(xml_str, unicode):
+        xml_str = re.sub(u'<\?xml(.*)\?>', u'', xml_str)
+        xml_str = xml_str.encode('utf8')
+    parser = etree.XMLParser(remove_blank_text=True)
+    return etree.fromstring(xml_str, parser=parser)
+
+
 class MappedXmlObject(object):
     elements = []
 
@@ -36,12 +54,7 @@ class MappedXmlDocument(MappedXmlObject):
 
     def get_xml_tree(self):
         if self.xml_tree is None:
-            parser = etree.XMLParser(remove_blank_text=True)
-            if type(self.xml_str) == unicode:
-                xml_str = self.xml_str.encode('utf8')
-            else:
-                xml_str = self.xml_str
-            self.xml_tree = etree.fromstring(xml_str, parser=parser)
+            self.xml_tree = parse_xml_string(self.xml_str)
         return self.xml_tree
 
     def infer_values(self, values):
@@ -56,6 +69,7 @@ class MappedXmlElement(MappedXmlObject):
         self.search_paths = search_paths
         self.multiplicity = multiplicity
         self.elements = elements or self.elements
+        self._compiled_xpaths = {}
 
     def read_value(self, tree):
         values = []
@@ -74,7 +88,22 @@ class MappedXmlElement(MappedXmlObject):
         return search_paths
 
     def get_elements(self, tree, xpath):
-        return tree.xpath(xpath, namespaces=self.namespaces)
+        return self.get_compiled_xpath(xpath)(tree)
+
+    def get_compiled_xpath(self, xpath):
+        '''
+        Returns the etree.XPath object for a search path, compiling it the
+        first time it is requested.
+
+        Elements are defined once at class level, so keeping the compiled
+        expressions on them means lxml does not need to recompile every
+        search path for every document read.
+        '''
+        compiled = self._compiled_xpaths.get(xpath)
+        if compiled is None:
+            compiled = etree.XPath(xpath, namespaces=self.namespaces)
+            self._compiled_xpaths[xpath] = compiled
+        return compiled
 
     def get_values(self, elements):
         values = []
@@ -8,7 +8,7 @@ from ckan.model import Session
 from ckan.model import meta
 from ckan.model.domain_object import DomainObject
 
-from ckanext.spatial.geoalchemy_common import setup_spatial_table
+from ckanext.spatial.geoalchemy_common import setup_spatial_table, postgis_version
 
 log = getLogger(__name__)
 
@@ -16,6 +16,10 @@ package_extent_table = None
 
 DEFAULT_SRID = 4326 #(WGS 84)
 
+# Set to False by `paster spatial migrate`, which sets up the model when
+# loading the configuration, before adding the missing columns
+check_columns = True
+
 def setup(srid=None):
 
     if package_extent_table is None:
@@ -45,16 +49,88 @@ def setup(srid=None):
             log.debug('Spatial tables created')
         else:
             log.debug('Spatial tables already exist')
-            # Future migrations go here
+            missing = _missing_columns() if check_columns else []
+            if missing:
+                # The mapper uses them, so the queries would fail
+                raise Exception('The package_extent table is missing the '
+                                'columns %s. Please run `paster '
+                                '--plugin=ckanext-spatial spatial migrate` to '
+                                'add them.' % ', '.join(missing))
 
     else:
         log.debug('Spatial tables creation deferred')
 
 
+# Columns added to the package_extent table after it was first released,
+# with their types (None for geometries, which are created as the_geom).
+# They are added by `paster spatial migrate`
+MIGRATED_COLUMNS = [
+    ('geom_fingerprint', 'text'),
+    ('minx', 'double precision'),
+    ('miny', 'double precision'),
+    ('maxx', 'double precision'),
+    ('maxy', 'double precision'),
+    ('area', 'double precision'),
+    ('the_geom_simplified', None),
+    ('simplify_tolerance', 'double precision'),
+]
+
+
+def _missing_columns():
+    existing = set(row[0] for row in Session.execute(
+        '''SELECT column_name FROM information_schema.columns
+           WHERE table_name = 'package_extent' '''))
+    return [column_name for column_name, column_type in MIGRATED_COLUMNS
+            if column_name not in existing]
+
+
+def migrate():
+    '''
+    Adds the missing columns to an existing package_extent table and fills
+    in the envelope ones, in a single transaction.
+
+    Returns the names of the columns added.
+    '''
+    db_srid = int(config.get('ckan.spatial.srid', DEFAULT_SRID))
+    missing = _missing_columns()
+    for column_name, column_type in MIGRATED_COLUMNS:
+        if column_name not in missing:
+            continue
+        if column_type:
+            Session.execute('ALTER TABLE package_extent ADD COLUMN %s %s' %
+                            (column_name, column_type))
+        elif postgis_version()[:1] == '1':
+            # No typmods on PostGIS 1.5, use the same constraints as
+            # when creating the table
+            Session.execute(
+                "SELECT AddGeometryColumn('package_extent', :column_name, "
+                "CAST(:srid AS integer), 'GEOMETRY', 2)",
+                {'column_name': column_name, 'srid': db_srid})
+        else:
+            Session.execute('ALTER TABLE package_extent ADD COLUMN %s '
+                            'geometry(Geometry, %i)' % (column_name, db_srid))
+        log.info('Added column %s to the package_extent table', column_name)
+
+    if 'minx' in missing:
+        # Simplified geometries are created with `paster spatial simplify`
+        Session.execute('''
+            UPDATE package_extent SET minx = ST_XMin(the_geom),
+                miny = ST_YMin(the_geom), maxx = ST_XMax(the_geom),
+                maxy = ST_YMax(the_geom),
+                area = (ST_XMax(the_geom) - ST_XMin(the_geom)) *
+                       (ST_YMax(the_geom) - ST_YMin(the_geom))
+            WHERE minx IS NULL''')
+        log.info('Updated the envelope columns of the package_extent table')
+
+    Session.commit()
+    return missing
+
+
 class PackageExtent(DomainObject):
-    def __init__(self, package_id=None, the_geom=None):
+    def __init__(self, package_id=None, the_geom=None, geom_fingerprint=None):
         self.package_id = package_id
         self.the_geom = the_geom
+        self.geom_fingerprint = geom_fingerprint
 
 
 def define_spatial_tables(db_srid=None):
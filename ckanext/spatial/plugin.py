@@ -37,6 +37,31 @@ check_geoalchemy_requirement()
 
 log = getLogger(__name__)
 
+# Maximum number of ids on each clause of the Solr filter built for the
+# postgis backend, below Solr's default maxBooleanClauses
+IDS_FILTER_CHUNK_SIZE = 1000
+
+# Solr filter for datasets with a spatial extra (ie with an extent)
+SPATIAL_EXTRA_FILTER = 'extras_spatial:[* TO *]'
+
+
+def _solr_envelope(bbox):
+    '''
+    Returns the Solr ENVELOPE(minX, maxX, maxY, minY) shape for a bounding
+    box. Longitudes are normalized to the -180 to 180 range, so boxes that
+    cross the antimeridian get a minX greater than maxX, as Solr expects.
+    '''
+    minx, maxx = bbox['minx'], bbox['maxx']
+    if maxx - minx >= 360:
+        minx, maxx = -180, 180
+    else:
+        if minx > 180:
+            minx -= 360
+        if maxx > 180:
+            maxx -= 360
+    return 'ENVELOPE({minx}, {maxx}, {maxy}, {miny})'.format(
+        minx=minx, maxx=maxx, maxy=bbox['maxy'], miny=bbox['miny'])
+
 
 def package_error_summary(error_dict):
     ''' Do some i18n stuff on the error_dict keys '''
@@ -65,6 +90,7 @@ class SpatialMetadata(p.SingletonPlugin):
     p.implements(p.IConfigurable, inherit=True)
     p.implements(p.IConfigurer, inherit=True)
     p.implements(p.ITemplateHelpers, inherit=True)
+    p.implements(p.ISession, inherit=True)
 
     def configure(self, config):
         from ckanext.spatial.model.package_extent import setup as setup_model
@@ -91,13 +117,31 @@ class SpatialMetadata(p.SingletonPlugin):
 
     def edit(self, package):
         self.check_spatial_extra(package)
+        self.notify_package_changed(package)
+
+    def notify_package_changed(self, package):
+        '''
+        The cached results of the spatial queries only include active
+        datasets, so they are invalidated when the state of a dataset with
+        an extent changes (eg from draft to active, or to deleted) while its
+        extent stays the same. Changes to the extents themselves are
+        notified when they are saved.
+        '''
+        from ckan.model import Session
+        from ckanext.spatial.lib.query_cache import extents_changed
+
+        if package.id in getattr(Session(), '_spatial_state_changed', ()) and \
+           any(extra.key == 'spatial' for extra in package.extras_list):
+            extents_changed()
 
     def check_spatial_extra(self,package):
         '''
         For a given package, looks at the spatial extent (as given in the
         extra "spatial" in GeoJSON format) and records it in PostGIS.
         '''
+        from ckan.model import Session
         from ckanext.spatial.lib import save_package_extent
+        from ckanext.spatial.lib.memory_index import update_extent
 
         if not package.id:
             log.warning('Couldn\'t store spatial extent because no id was provided for the package')
@@ -119,6 +163,9 @@ class SpatialMetadata(p.SingletonPlugin):
 
                     try:
                         save_package_extent(package.id,geometry)
+                        # The in-memory index only has active datasets
+                        update_extent(Session(), package.id,
+                                      geometry if package.state == 'active' else None)
 
                     except ValueError,e:
                         error_dict = {'spatial':[u'Error creating geometry: %s' % str(e)]}
@@ -132,13 +179,41 @@ class SpatialMetadata(p.SingletonPlugin):
                 elif (extra.state == 'active' and not extra.value) or extra.state == 'deleted':
                     # Delete extent from table
                     save_package_extent(package.id,None)
+                    update_extent(Session(), package.id, None)
 
                 break
 
 
     def delete(self, package):
+        from ckan.model import Session
         from ckanext.spatial.lib import save_package_extent
+        from ckanext.spatial.lib.memory_index import update_extent
         save_package_extent(package.id,None)
+        update_extent(Session(), package.id, None)
+
+    ## ISession
+
+    def before_flush(self, session, flush_context, instances):
+        # Keep track of the datasets whose state changes, as the flush
+        # resets the history before the package notifications are sent
+        from sqlalchemy.orm.attributes import get_history
+        from ckan.model import Package
+
+        for obj in session.dirty:
+            if isinstance(obj, Package) and get_history(obj, 'state').has_changes():
+                if not hasattr(session, '_spatial_state_changed'):
+                    session._spatial_state_changed = set()
+                session._spatial_state_changed.add(obj.id)
+
+    def after_commit(self, session):
+        from ckanext.spatial.lib.memory_index import apply_updates
+        session._spatial_state_changed = set()
+        apply_updates(session)
+
+    def after_rollback(self, session):
+        from ckanext.spatial.lib.memory_index import discard_updates
+        session._spatial_state_changed = set()
+        discard_updates(session)
 
     ## ITemplateHelpers
 
@@ -157,11 +232,33 @@ class SpatialQuery(p.SingletonPlugin):
     p.implements(p.IConfigurable, inherit=True)
 
     search_backend = None
+    solr_ids_filter = None
+    use_numpy_ranking = False
+    solr_grid_size = None
 
     def configure(self, config):
 
         self.search_backend = config.get('ckanext.spatial.search_backend', 'postgis')
-        if self.search_backend != 'postgis' and not p.toolkit.check_ckan_version('2.0.1'):
+        self.solr_ids_filter = config.get('ckanext.spatial.solr_ids_filter', 'boolean')
+        self.solr_grid_size = float(config.get('ckanext.spatial.solr_grid_size', 0))
+        self.use_numpy_ranking = p.toolkit.asbool(
+            config.get('ckanext.spatial.use_numpy_ranking', 'False'))
+        if self.use_numpy_ranking:
+            from ckanext.spatial.lib.ranking import numpy, get_directory
+            if numpy is None:
+                raise ImportError('ckanext.spatial.use_numpy_ranking requires '
+                                  'NumPy. Please install it by running '
+                                  '`pip install numpy`.')
+            # Fail early if the directory for the envelopes is not set
+            get_directory()
+        if self.search_backend == 'memory':
+            try:
+                from shapely.strtree import STRtree
+            except ImportError:
+                raise ImportError('The memory backend for the spatial search '
+                                  'requires Shapely 1.4 or higher. Please '
+                                  'upgrade it by running `pip install -U Shapely`.')
+        elif self.search_backend != 'postgis' and not p.toolkit.check_ckan_version('2.0.1'):
             msg = 'The Solr backends for the spatial search require CKAN 2.0.1 or higher. ' + \
                   'Please upgrade CKAN or select the \'postgis\' backend.'
             raise p.toolkit.CkanVersionException(msg)
@@ -171,13 +268,16 @@ class SpatialQuery(p.SingletonPlugin):
         map.connect('api_spatial_query', '/api/2/search/{register:dataset|package}/geo',
             controller='ckanext.spatial.controllers.api:ApiController',
             action='spatial_query')
+        map.connect('api_spatial_query_cache', '/api/2/search/{register:dataset|package}/geo/cache',
+            controller='ckanext.spatial.controllers.api:ApiController',
+            action='spatial_query_cache')
         return map
 
     def before_index(self, pkg_dict):
         import shapely
         import shapely.geometry
 
-        if pkg_dict.get('extras_spatial', None) and self.search_backend in ('solr', 'solr-spatial-field'):
+        if pkg_dict.get('extras_spatial', None) and self.search_backend in ('solr', 'solr-spatial-field', 'solr-bbox'):
             try:
                 geometry = json.loads(pkg_dict['extras_spatial'])
             except ValueError, e:
@@ -232,6 +332,16 @@ class SpatialQuery(p.SingletonPlugin):
 
                 pkg_dict['spatial_geom'] = wkt
 
+            elif self.search_backend == 'solr-bbox':
+                try:
+                    shape = shapely.geometry.asShape(geometry)
+                    minx, miny, maxx, maxy = shape.bounds
+                except (ValueError, KeyError, TypeError), e:
+                    log.error('Wrong geometry, not indexing: {0}'.format(e))
+                    return pkg_dict
+
+                pkg_dict['spatial_bbox'] = _solr_envelope(
+                    {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy})
 
         return pkg_dict
 
@@ -253,15 +363,26 @@ class SpatialQuery(p.SingletonPlugin):
                 bbox['minx'] -= 360
                 bbox['maxx'] -= 360
 
-            if self.search_backend == 'solr':
-                search_params = self._params_for_solr_search(bbox, search_params)
-            elif self.search_backend == 'solr-spatial-field':
-                search_params = self._params_for_solr_spatial_field_search(bbox, search_params)
-            elif self.search_backend == 'postgis':
-                search_params = self._params_for_postgis_search(bbox, search_params)
+            if search_params.get('sort') == 'spatial desc' and self.use_numpy_ranking:
+                search_params = self._params_for_ranked_search(bbox, search_params)
+            else:
+                search_params = self._params_for_backend_search(bbox, search_params)
 
         return search_params
 
+    def _params_for_backend_search(self, bbox, search_params):
+        if self.search_backend == 'solr':
+            search_params = self._params_for_solr_search(bbox, search_params)
+        elif self.search_backend == 'solr-spatial-field':
+            search_params = self._params_for_solr_spatial_field_search(bbox, search_params)
+        elif self.search_backend == 'solr-bbox':
+            search_params = self._params_for_solr_bbox_search(bbox, search_params)
+        elif self.search_backend == 'postgis':
+            search_params = self._params_for_postgis_search(bbox, search_params)
+        elif self.search_backend == 'memory':
+            search_params = self._params_for_memory_search(bbox, search_params)
+        return search_params
+
     def _params_for_solr_search(self, bbox, search_params):
         '''
         This will add the following parameters to the query:
@@ -276,9 +397,16 @@ class SpatialQuery(p.SingletonPlugin):
                  target geometry T. It gives a ratio from 0 to 1 where 0 means
                  no overlap at all and 1 a perfect fit
 
-             fq - Adds a filter that force the value returned by the previous
-                  function to be between 0 and 1, effectively applying the
-                  spatial filter.
+             fq - Adds range filters on the indexed bounding box values
+                  that only keep the extents whose envelopes can overlap the
+                  query, which are answered from the index and cached by Solr,
+                  followed by a filter that force the value returned by the
+                  previous function to be between 0 and 1, effectively
+                  applying the spatial filter. The latter is not cached and
+                  has a high cost, so Solr runs it as a post filter only on
+                  the documents matched by the rest of filters. If the
+                  bounding box is snapped to a grid (see `_filter_bbox`), the
+                  range filters use the snapped one.
 
         '''
 
@@ -303,7 +431,16 @@ class SpatialQuery(p.SingletonPlugin):
                    add({area_search}, mul(sub({y22}, {y21}), sub({x22}, {x21})))
                 )'''.format(**variables).replace('\n','').replace(' ','')
 
-        search_params['fq_list'] = ['{!frange incl=false l=0 u=1}%s' % bf]
+        filter_bbox = self._filter_bbox(bbox)
+
+        search_params['fq_list'] = search_params.get('fq_list', [])
+        search_params['fq_list'].extend([
+            'maxx:[{0} TO *]'.format(filter_bbox['minx']),
+            'minx:[* TO {0}]'.format(filter_bbox['maxx']),
+            'maxy:[{0} TO *]'.format(filter_bbox['miny']),
+            'miny:[* TO {0}]'.format(filter_bbox['maxy']),
+            '{!frange incl=false l=0 u=1 cache=false cost=200}%s' % bf,
+        ])
 
         search_params['bf'] = bf
         search_params['defType'] = 'edismax'
@@ -316,80 +453,210 @@ class SpatialQuery(p.SingletonPlugin):
 
             +spatial_geom:"Intersects(ENVELOPE({minx}, {miny}, {maxx}, {maxy}))
 
+        If the bounding box is snapped to a grid (see `_filter_bbox`), the
+        exact one is applied with an additional filter that is not cached.
+
+        '''
+        envelope = 'ENVELOPE({minx}, {maxx}, {maxy}, {miny})'
+        filter_bbox = self._filter_bbox(bbox)
+
+        search_params['fq_list'] = search_params.get('fq_list', [])
+        search_params['fq_list'].append(('+spatial_geom:"Intersects(%s)"' % envelope)
+                                        .format(**filter_bbox))
+        if filter_bbox != bbox:
+            search_params['fq_list'].append(
+                ('{{!field f=spatial_geom cache=false}}Intersects(%s)' % envelope)
+                .format(**bbox))
+
+        return search_params
+
+    def _params_for_solr_bbox_search(self, bbox, search_params):
         '''
+        This will add the following parameters to the query:
+
+            fq - {!field f=spatial_bbox}Intersects(ENVELOPE(...)) A filter
+                 on the BBoxField with the indexed extents, which Solr
+                 answers from the index (and caches as any other filter).
+
+            bq - {!field f=spatial_bbox score=overlapRatio}Intersects(ENVELOPE(...))
+                 A boost query that adds the overlap ratio between the query
+                 bounding box and the extent (from 0 to 1) to the score of
+                 the results, to sort them by relevance as the `solr` backend
+                 does. We need to define EDisMax to use bq.
+
+        If the bounding box is snapped to a grid (see `_filter_bbox`), the
+        exact one is applied with an additional filter that is not cached.
+
+        '''
+        envelope = _solr_envelope(bbox)
+        filter_bbox = self._filter_bbox(bbox)
+
         search_params['fq_list'] = search_params.get('fq_list', [])
-        search_params['fq_list'].append('+spatial_geom:"Intersects(ENVELOPE({minx}, {maxx}, {maxy}, {miny}))"'
-                                        .format(minx=bbox['minx'], miny=bbox['miny'], maxx=bbox['maxx'], maxy=bbox['maxy']))
+        search_params['fq_list'].append(
+            '{{!field f=spatial_bbox}}Intersects({0})'.format(_solr_envelope(filter_bbox)))
+        if filter_bbox != bbox:
+            search_params['fq_list'].append(
+                '{{!field f=spatial_bbox cache=false}}Intersects({0})'.format(envelope))
+
+        search_params['bq'] = \
+            '{{!field f=spatial_bbox score=overlapRatio}}Intersects({0})'.format(envelope)
+        search_params['defType'] = 'edismax'
 
         return search_params
 
+    def _filter_bbox(self, bbox):
+        '''
+        Returns the bounding box to use on the cached spatial filters sent to
+        Solr. If `ckanext.spatial.solr_grid_size` is set, it is the query one
+        expanded outwards to a grid of that size, so nearby map views reuse
+        the same filter from Solr's filterCache.
+        '''
+        if not self.solr_grid_size:
+            return bbox
+
+        from ckanext.spatial.lib.grid import snap_bbox, record_filter
+
+        filter_bbox = snap_bbox(bbox, self.solr_grid_size)
+        record_filter((self.search_backend, filter_bbox['minx'], filter_bbox['miny'],
+                       filter_bbox['maxx'], filter_bbox['maxy']))
+        return filter_bbox
+
     def _params_for_postgis_search(self, bbox, search_params):
-        from ckanext.spatial.lib import   bbox_query, bbox_query_ordered
-        from ckan.lib.search import SearchError
+        from ckanext.spatial.lib import (bbox_query_ids, bbox_query_excluded_ids,
+                                         extentless_package_ids)
+        from ckanext.spatial.lib.planner import (plan_bbox_query, PLAN_ALL,
+                                                 PLAN_COMPLEMENT)
 
         # Note: This will be deprecated at some point in favour of the
         # Solr 4 spatial sorting capabilities
         if search_params.get('sort') == 'spatial desc' and \
            p.toolkit.asbool(config.get('ckanext.spatial.use_postgis_sorting', 'False')):
-            if search_params['q'] or search_params['fq']:
-                raise SearchError('Spatial ranking cannot be mixed with other search parameters')
-                # ...because it is too inefficient to use SOLR to filter
-                # results and return the entire set to this class and
-                # after_search do the sorting and paging.
-            extents = bbox_query_ordered(bbox)
-            are_no_results = not extents
-            search_params['extras']['ext_rows'] = search_params['rows']
-            search_params['extras']['ext_start'] = search_params['start']
-            # this SOLR query needs to return no actual results since
-            # they are in the wrong order anyway. We just need this SOLR
-            # query to get the count and facet counts.
-            rows = 0
-            search_params['sort'] = None # SOLR should not sort.
-            # Store the rankings of the results for this page, so for
-            # after_search to construct the correctly sorted results
-            rows = search_params['extras']['ext_rows'] = search_params['rows']
-            start = search_params['extras']['ext_start'] = search_params['start']
-            search_params['extras']['ext_spatial'] = [
-                (extent.package_id, extent.spatial_ranking) \
-                for extent in extents[start:start+rows]]
+            return self._params_for_ranked_search(bbox, search_params)
         else:
-            extents = bbox_query(bbox)
-            are_no_results = extents.count() == 0
+            plan, selectivity = plan_bbox_query(bbox)
+            if plan in (PLAN_ALL, PLAN_COMPLEMENT):
+                # Most datasets with an extent match, so filter by the
+                # spatial extra and exclude the ones that don't, if any,
+                # and the ones with a spatial extra but no extent
+                search_params['fq_list'] = search_params.get('fq_list', [])
+                search_params['fq_list'].append(SPATIAL_EXTRA_FILTER)
+                excluded_ids = extentless_package_ids()
+                if plan == PLAN_COMPLEMENT:
+                    excluded_ids = excluded_ids + bbox_query_excluded_ids(bbox)
+                if excluded_ids:
+                    search_params['fq_list'].append(
+                        self._ids_filter(excluded_ids, exclude=True))
+                return search_params
+
+            package_ids = bbox_query_ids(bbox)
+
+        return self._filter_by_ids(package_ids, search_params)
+
+    def _params_for_ranked_search(self, bbox, search_params):
+        from ckanext.spatial.lib import bbox_query_ordered_page
+        from ckanext.spatial.lib.ranking import get_ranking
+        from ckan.lib.search import SearchError
 
-        if are_no_results:
+        if search_params['q'] or search_params['fq']:
+            raise SearchError('Spatial ranking cannot be mixed with other search parameters')
+            # ...because it is too inefficient to use SOLR to filter
+            # results and return the entire set to this class and
+            # after_search do the sorting and paging.
+
+        # Only the requested page is ranked. SOLR is filtered by all the
+        # matching datasets, to get the count and facet counts, but it
+        # does not need to sort or return them, the datasets on this page
+        # are requested in after_search
+        start, rows = int(search_params['start']), int(search_params['rows'])
+        results = None
+        if self.use_numpy_ranking:
+            results = get_ranking().rank(bbox, start, rows)
+        if results is None:
+            results = bbox_query_ordered_page(bbox, start, rows)
+        page = results[1]
+
+        search_params['sort'] = None
+        search_params['start'] = 0
+        search_params['rows'] = 0
+        # Store the rankings of the results for this page, so for
+        # after_search to construct the correctly sorted results
+        search_params['extras']['ext_spatial'] = page
+
+        return self._params_for_backend_search(bbox, search_params)
+
+    def _params_for_memory_search(self, bbox, search_params):
+        from ckanext.spatial.lib.memory_index import bbox_query_ids
+
+        return self._filter_by_ids(bbox_query_ids(bbox), search_params)
+
+    def _filter_by_ids(self, package_ids, search_params):
+        if not package_ids:
             # We don't need to perform the search
             search_params['abort_search'] = True
         else:
             # We'll perform the existing search but also filtering by the ids
             # of datasets within the bbox
-            bbox_query_ids = [extent.package_id for extent in extents]
+            search_params['fq_list'] = search_params.get('fq_list', [])
+            search_params['fq_list'].append(self._ids_filter(package_ids))
 
-            q = search_params.get('q','').strip() or '""'
-            new_q = '%s AND ' % q if q else ''
-            new_q += '(%s)' % ' OR '.join(['id:%s' % id for id in bbox_query_ids])
+        return search_params
 
-            search_params['q'] = new_q
+    def _ids_filter(self, package_ids, exclude=False):
+        '''
+        Returns a Solr filter query that restricts the results to the
+        provided dataset ids, or that excludes them if `exclude` is True.
 
-        return search_params
+        With `ckanext.spatial.solr_ids_filter = terms` the terms query
+        parser (Solr 4.10 or later) is used, which handles any number of ids.
+        Otherwise the ids are grouped in nested boolean clauses, so no
+        clause has more than the default maxBooleanClauses (1024).
+        '''
+        if self.solr_ids_filter == 'terms':
+            ids_filter = '{!terms f=id}%s' % ','.join(package_ids)
+            if exclude:
+                return '-_query_:"%s"' % ids_filter
+            return ids_filter
+
+        chunks = [package_ids[i:i + IDS_FILTER_CHUNK_SIZE]
+                  for i in xrange(0, len(package_ids), IDS_FILTER_CHUNK_SIZE)]
+        ids_filter = ' OR '.join('id:(%s)' % ' OR '.join(chunk) for chunk in chunks)
+        if exclude:
+            return '-(%s)' % ids_filter
+        return ids_filter
 
     def after_search(self, search_results, search_params):
-        from ckan.lib.search import PackageSearchQuery
 
         # Note: This will be deprecated at some point in favour of the
         # Solr 4 spatial sorting capabilities
 
-        if search_params.get('extras', {}).get('ext_spatial') and \
-           p.toolkit.asbool(config.get('ckanext.spatial.use_postgis_sorting', 'False')):
-            # Apply the spatial sort
-            querier = PackageSearchQuery()
-            pkgs = []
-            for package_id, spatial_ranking in search_params['extras']['ext_spatial']:
-                # get package from SOLR
-                pkg = querier.get_index(package_id)['data_dict']
-                pkgs.append(json.loads(pkg))
-            search_results['results'] = pkgs
+        if search_params.get('extras', {}).get('ext_spatial') is not None and \
+           (self.use_numpy_ranking or
+            p.toolkit.asbool(config.get('ckanext.spatial.use_postgis_sorting', 'False'))):
+            # Apply the spatial sort. SOLR returned the count and facets for
+            # all the matching datasets, get the ones on this page in order
+            page_ids = [package_id for package_id, spatial_ranking
+                        in search_params['extras']['ext_spatial']]
+            pkgs = self._get_indexed_packages(page_ids) if page_ids else {}
+            search_results['results'] = [pkgs[package_id] for package_id in page_ids
+                                         if package_id in pkgs]
         return search_results
 
+    def _get_indexed_packages(self, package_ids):
+        '''
+        Returns a dict with the indexed data_dict of each of the provided
+        dataset ids, fetched from SOLR with a single request.
+        '''
+        from ckan.lib.search import PackageSearchQuery
+
+        results = PackageSearchQuery().run({
+            'q': '*:*',
+            'fq': self._ids_filter(package_ids),
+            'fl': 'id data_dict',
+            'rows': len(package_ids),
+        })
+        return dict((result['id'], json.loads(result['data_dict']))
+                    for result in results['results'])
+
 class HarvestMetadataApi(p.SingletonPlugin):
     '''
     Harvest Metadata API
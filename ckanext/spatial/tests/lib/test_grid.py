@@ -0,0 +1,40 @@
+from nose.tools import assert_equal
+
+from ckanext.spatial.lib.grid import snap_bbox
+
+
+class TestSnapBbox(object):
+
+    def test_snap_outwards(self):
+        bbox = {'minx': -3.27, 'miny': 51.04, 'maxx': 1.49, 'maxy': 52.91}
+        assert_equal(snap_bbox(bbox, 0.5),
+                     {'minx': -3.5, 'miny': 51.0, 'maxx': 1.5, 'maxy': 53.0})
+
+    def test_nearby_boxes_share_the_grid(self):
+        bbox1 = {'minx': 10.01, 'miny': 20.02, 'maxx': 10.93, 'maxy': 20.97}
+        bbox2 = {'minx': 10.05, 'miny': 20.11, 'maxx': 10.88, 'maxy': 20.91}
+        assert_equal(snap_bbox(bbox1, 1), snap_bbox(bbox2, 1))
+
+    def test_aligned_box_unchanged(self):
+        bbox = {'minx': 0.3, 'miny': 0.1, 'maxx': 0.7, 'maxy': 0.9}
+        assert_equal(snap_bbox(bbox, 0.1), bbox)
+
+    def test_latitude_limits(self):
+        bbox = {'minx': -180.0, 'miny': -89.9, 'maxx': 180.0, 'maxy': 89.9}
+        assert_equal(snap_bbox(bbox, 1),
+                     {'minx': -180.0, 'miny': -90, 'maxx': 180.0, 'maxy': 90})
+
+    def test_longitude_limits(self):
+        bbox = {'minx': -179.9, 'miny': 0.5, 'maxx': 179.9, 'maxy': 1.5}
+        assert_equal(snap_bbox(bbox, 7),
+                     {'minx': -180, 'miny': 0, 'maxx': 180, 'maxy': 7})
+
+    def test_dateline(self):
+        bbox = {'minx': 170.5, 'miny': 0.5, 'maxx': 190.5, 'maxy': 1.5}
+        assert_equal(snap_bbox(bbox, 1),
+                     {'minx': 170, 'miny': 0, 'maxx': 191, 'maxy': 2})
+
+    def test_dateline_whole_world(self):
+        bbox = {'minx': 0.5, 'miny': 0.5, 'maxx': 359.8, 'maxy': 1.5}
+        assert_equal(snap_bbox(bbox, 1),
+                     {'minx': 0, 'miny': 0, 'maxx': 360, 'maxy': 2})
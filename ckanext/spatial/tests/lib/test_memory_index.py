@@ -0,0 +1,108 @@
+from nose.tools import assert_equal
+
+from shapely.geometry import box
+
+from ckan import model
+from ckan.lib.helpers import json
+try:
+    import ckan.new_tests.helpers as helpers
+    import ckan.new_tests.factories as factories
+except ImportError:
+    import ckan.tests.helpers as helpers
+    import ckan.tests.factories as factories
+
+from ckanext.spatial.lib import save_package_extents
+from ckanext.spatial.lib import memory_index
+from ckanext.spatial.lib.memory_index import MemoryIndex, REBUILD_THRESHOLD
+from ckanext.spatial.tests.base import SpatialTestBase
+
+
+def bbox(minx, miny, maxx, maxy):
+    return {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy}
+
+
+class TestMemoryIndex(object):
+
+    def test_query(self):
+        index = MemoryIndex()
+        for i in range(10):
+            index.update('package-%s' % i, box(i, 0, i + 0.5, 1))
+        index._build()
+
+        assert_equal(sorted(index.query(bbox(2.2, 0, 4.2, 1))),
+                     ['package-2', 'package-3', 'package-4'])
+        assert_equal(index.query(bbox(2.6, 0, 2.9, 1)), [])
+
+    def test_exact_intersection(self):
+        index = MemoryIndex()
+        # L shaped polygon, its bounding box covers both query boxes
+        index.update('l-shape', box(0, 0, 10, 10).difference(box(5, 5, 10, 10)))
+        index._build()
+
+        assert_equal(index.query(bbox(1, 1, 2, 2)), ['l-shape'])
+        assert_equal(index.query(bbox(7, 7, 9, 9)), [])
+
+    def test_updates(self):
+        index = MemoryIndex()
+        index.update('moved', box(0, 0, 1, 1))
+        index.update('deleted', box(0, 0, 1, 1))
+        index._build()
+
+        index.update('moved', box(5, 5, 6, 6))
+        index.update('deleted', None)
+        index.update('new', box(0, 0, 1, 1))
+
+        assert_equal(index.query(bbox(0, 0, 1, 1)), ['new'])
+        assert_equal(index.query(bbox(5, 5, 6, 6)), ['moved'])
+
+        # The tree is rebuilt after a number of changes
+        for i in range(REBUILD_THRESHOLD + 1):
+            index.update('package-%s' % i, box(10, 10, 11, 11))
+        assert_equal(len(index.query(bbox(10, 10, 11, 11))), REBUILD_THRESHOLD + 1)
+        assert_equal(index._pending, set())
+        assert_equal(index.query(bbox(5, 5, 6, 6)), ['moved'])
+
+
+class TestMemoryIndexDatabase(SpatialTestBase):
+
+    def setup(self):
+        helpers.reset_db()
+        memory_index._index = None
+
+    def teardown(self):
+        memory_index._index = None
+
+    def test_load_and_check(self):
+        package_ids = [factories.Dataset()['id'] for i in range(2)]
+        save_package_extents([
+            (package_ids[0], json.loads(self.geojson_examples['polygon']), None),
+            (package_ids[1], json.loads(self.geojson_examples['point_2']), None),
+        ])
+        model.Session.commit()
+
+        index = memory_index.get_index()
+        assert_equal(index.query(bbox(100.5, 0.5, 110, 10)), [package_ids[0]])
+        assert_equal(index.query(bbox(19, 9, 21, 11)), [package_ids[1]])
+
+        # Updates made on this process are only applied once committed
+        geometry = json.loads(self.geojson_examples['point'])
+        save_package_extents([(package_ids[1], geometry, None)])
+        memory_index.update_extent(model.Session(), package_ids[1], geometry)
+        model.Session.rollback()
+        assert_equal(index.query(bbox(99, -1, 101, 1)), [package_ids[0]])
+
+        # and keep the index in sync
+        save_package_extents([(package_ids[1], geometry, None)])
+        memory_index.update_extent(model.Session(), package_ids[1], geometry)
+        model.Session.commit()
+        index.check()
+        # Not reloaded, as the database has the same extents
+        assert package_ids[1] in index._pending
+        assert_equal(sorted(index.query(bbox(99, -1, 101, 1))), sorted(package_ids))
+
+        # Changes made elsewhere make the next search check the index, which
+        # reloads it as the database has different extents
+        save_package_extents([(package_ids[0], None, None)])
+        assert_equal(index.loaded, 0)
+        memory_index.get_index()
+        assert_equal(index.query(bbox(99, -1, 101, 1)), [package_ids[1]])
@@ -0,0 +1,91 @@
+from nose.tools import assert_equal
+
+from ckan.model import Session
+from ckan.lib.base import config
+from ckan.lib.helpers import json
+try:
+    import ckan.new_tests.helpers as helpers
+    import ckan.new_tests.factories as factories
+except ImportError:
+    import ckan.tests.helpers as helpers
+    import ckan.tests.factories as factories
+
+from ckanext.spatial.lib import save_package_extents, planner
+from ckanext.spatial.lib.planner import (plan_bbox_query, get_data_extent,
+                                         estimate_selectivity,
+                                         PLAN_ALL, PLAN_COMPLEMENT, PLAN_IDS)
+from ckanext.spatial.tests.base import SpatialTestBase
+
+
+class TestPlanner(SpatialTestBase):
+
+    def setup(self):
+        helpers.reset_db()
+        self.package_ids = [factories.Dataset()['id'] for i in range(2)]
+        save_package_extents([
+            (self.package_ids[0], json.loads(self.geojson_examples['polygon']), None),
+            (self.package_ids[1], json.loads(self.geojson_examples['point_2']), None),
+        ])
+
+    def teardown(self):
+        config.pop('ckanext.spatial.planner.complement_threshold', None)
+        config.pop('ckanext.spatial.use_query_planner', None)
+
+    def test_data_extent(self):
+        assert_equal(get_data_extent(),
+                     {'minx': 20, 'miny': 0, 'maxx': 101, 'maxy': 10})
+
+    def test_data_extent_reset_on_change(self):
+        get_data_extent()
+        dataset = factories.Dataset()
+        save_package_extents([
+            (dataset['id'], json.loads(self.geojson_examples['multiline']), None),
+        ])
+
+        assert_equal(get_data_extent(),
+                     {'minx': 20, 'miny': 0, 'maxx': 103, 'maxy': 10})
+
+    def test_data_extent_unchanged(self):
+        get_data_extent()
+        state = planner._data_extent
+        # Saving the same extents again doesn't discard the cached one
+        save_package_extents([
+            (self.package_ids[0], json.loads(self.geojson_examples['polygon']), None),
+        ])
+
+        assert planner._data_extent is state
+
+    def test_estimate_cached(self):
+        bbox = {'minx': 19, 'miny': 9, 'maxx': 21, 'maxy': 11}
+        selectivity = estimate_selectivity(bbox, get_data_extent())
+        Session.execute('DELETE FROM package_extent')
+
+        assert_equal(estimate_selectivity(bbox, get_data_extent()), selectivity)
+
+    def test_plan_all(self):
+        bbox = {'minx': -180, 'miny': -90, 'maxx': 180, 'maxy': 90}
+        assert_equal(plan_bbox_query(bbox), (PLAN_ALL, 1.0))
+
+    def test_plan_all_estimated(self):
+        # Once analyzed, the data extent is estimated, so the extents that
+        # don't match are still excluded
+        Session.execute('ANALYZE package_extent')
+        planner.reset_data_extent()
+        bbox = {'minx': -180, 'miny': -90, 'maxx': 180, 'maxy': 90}
+
+        assert_equal(plan_bbox_query(bbox), (PLAN_COMPLEMENT, 1.0))
+        assert not planner._data_extent['exact']
+
+    def test_plan_ids(self):
+        bbox = {'minx': 19, 'miny': 9, 'maxx': 21, 'maxy': 11}
+        assert_equal(plan_bbox_query(bbox)[0], PLAN_IDS)
+
+    def test_plan_complement(self):
+        config['ckanext.spatial.planner.complement_threshold'] = '0'
+        bbox = {'minx': 19, 'miny': 9, 'maxx': 21, 'maxy': 11}
+        assert_equal(plan_bbox_query(bbox)[0], PLAN_COMPLEMENT)
+
+    def test_planner_disabled(self):
+        config['ckanext.spatial.use_query_planner'] = 'false'
+        bbox = {'minx': -180, 'miny': -90, 'maxx': 180, 'maxy': 90}
+        assert_equal(plan_bbox_query(bbox), (PLAN_IDS, None))
@@ -0,0 +1,138 @@
+import time
+
+from nose.tools import assert_equal
+
+from ckan import model
+from ckan.lib.helpers import json
+try:
+    import ckan.new_tests.helpers as helpers
+    import ckan.new_tests.factories as factories
+except ImportError:
+    import ckan.tests.helpers as helpers
+    import ckan.tests.factories as factories
+
+from ckanext.spatial.lib import save_package_extents, bbox_query_ids
+from ckanext.spatial.lib import query_cache
+from ckanext.spatial.lib.query_cache import (QueryCache, ExtentsListener,
+                                             snap_bbox, refine_rows)
+from ckanext.spatial.tests.base import SpatialTestBase
+
+
+class TestQueryCache(object):
+
+    def test_lru(self):
+        cache = QueryCache(size=2)
+        cache.set('a', [1])
+        cache.set('b', [2])
+        assert_equal(cache.get('a'), [1])
+        cache.set('c', [3])
+
+        assert_equal(cache.get('b'), None)
+        assert_equal(cache.get('a'), [1])
+        assert_equal(cache.get('c'), [3])
+
+        stats = cache.stats()
+        assert_equal((stats['hits'], stats['misses'], stats['size']), (3, 1, 2))
+        assert_equal(stats['hit_ratio'], 0.75)
+
+    def test_ttl(self):
+        cache = QueryCache(ttl=0.01)
+        cache.set('a', [1])
+        time.sleep(0.02)
+        assert_equal(cache.get('a'), None)
+
+    def test_invalidate(self):
+        cache = QueryCache()
+        cache.set('a', [1])
+        generation = cache.generation
+
+        cache.invalidate()
+        assert_equal(cache.get('a'), None)
+
+        # Results computed before invalidating the cache are not stored
+        cache.set('a', [1], generation)
+        assert_equal(cache.get('a'), None)
+
+    def test_snap_bbox(self):
+        bbox = {'minx': 1.04, 'miny': -2.01, 'maxx': 3.11, 'maxy': 4.0}
+        assert_equal(snap_bbox(bbox, 0.1),
+                     {'minx': 1.0, 'miny': -2.1, 'maxx': 3.2, 'maxy': 4.0})
+        assert_equal(snap_bbox(bbox, 0.1, inward=True),
+                     {'minx': 1.1, 'miny': -2.0, 'maxx': 3.1, 'maxy': 4.0})
+
+    def test_refine_rows(self):
+        bbox = {'minx': 0, 'miny': 0, 'maxx': 10, 'maxy': 10}
+        rows = [
+            ('inside', 1, 1, 2, 2, False),
+            ('box-crossing', 9, 9, 12, 12, True),
+            ('outside', 11, 11, 12, 12, True),
+            ('touching', 10, 5, 12, 6, True),
+            ('no-extent', None, None, None, None, None),
+        ]
+        assert_equal(refine_rows(rows, bbox),
+                     ['inside', 'box-crossing', 'touching'])
+        assert_equal(refine_rows(rows, bbox, exclude=True),
+                     ['outside', 'no-extent'])
+
+
+class TestQueryCacheDatabase(SpatialTestBase):
+
+    bbox = {'minx': 99, 'miny': -1, 'maxx': 102, 'maxy': 2}
+
+    def setup(self):
+        helpers.reset_db()
+
+    def test_cached_results(self):
+        package_ids = [factories.Dataset()['id'] for i in range(2)]
+        save_package_extents([
+            (package_ids[0], json.loads(self.geojson_examples['polygon']), None)])
+        model.Session.commit()
+
+        assert_equal(bbox_query_ids(self.bbox), [package_ids[0]])
+        hits = query_cache.get_cache().hits
+        assert_equal(bbox_query_ids(self.bbox), [package_ids[0]])
+        assert_equal(query_cache.get_cache().hits, hits + 1)
+
+        # Saving extents invalidates the cache
+        save_package_extents([
+            (package_ids[1], json.loads(self.geojson_examples['point']), None)])
+        model.Session.commit()
+        assert_equal(sorted(bbox_query_ids(self.bbox)), sorted(package_ids))
+
+    def test_snapped_results(self):
+        package_ids = [factories.Dataset()['id'] for i in range(2)]
+        save_package_extents([
+            (package_ids[0], json.loads(self.geojson_examples['polygon']), None),
+            (package_ids[1], json.loads(self.geojson_examples['point']), None)])
+        model.Session.commit()
+
+        # Both boxes are snapped to the same grid cells
+        bbox = {'minx': 100.51, 'miny': 0.51, 'maxx': 101.55, 'maxy': 1.52}
+        nearby_bbox = {'minx': 100.52, 'miny': 0.53, 'maxx': 101.58, 'maxy': 1.56}
+        assert_equal(bbox_query_ids(bbox), [package_ids[0]])
+        hits = query_cache.get_cache().hits
+        assert_equal(bbox_query_ids(nearby_bbox), [package_ids[0]])
+        assert_equal(query_cache.get_cache().hits, hits + 1)
+
+    def test_state_change_invalidates(self):
+        dataset = factories.Dataset(
+            state='draft',
+            extras=[{'key': 'spatial', 'value': self.geojson_examples['polygon']}])
+        assert_equal(bbox_query_ids(self.bbox), [])
+
+        dataset['state'] = 'active'
+        helpers.call_action('package_update', **dataset)
+        assert_equal(bbox_query_ids(self.bbox), [dataset['id']])
+
+    def test_notifications(self):
+        listener = ExtentsListener()
+        package_id = factories.Dataset()['id']
+
+        save_package_extents([
+            (package_id, json.loads(self.geojson_examples['polygon']), None)])
+        # Only delivered on commit
+        assert not listener.poll()
+        model.Session.commit()
+        time.sleep(0.1)
+        assert listener.poll()
+        assert not listener.poll()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+
+from ckan import model
+
+from ckanext.spatial.lib import bbox_query_ordered_page
+from ckanext.spatial.lib.query_cache import extents_changed
+from ckanext.spatial.lib.ranking import (numpy, EnvelopeRanking, FILE_NAME,
+                                         write_envelopes)
+from ckanext.spatial.tests.lib.test_spatial import SpatialQueryTestBase
+
+
+class TestEnvelopeRanking(SpatialQueryTestBase):
+    # x values for the fixtures
+    fixtures_x = [(0, 9), (1, 8), (2, 7), (3, 6), (4, 5),
+                  (8, 9)]
+
+    @classmethod
+    def setup_class(cls):
+        if numpy is None:
+            raise SkipTest('NumPy is required for this test')
+        super(TestEnvelopeRanking, cls).setup_class()
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        write_envelopes(self.directory)
+        self.ranking = EnvelopeRanking(self.directory)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _titles(self, page):
+        return [model.Package.get(package_id).title for package_id, ranking in page]
+
+    def test_rank(self):
+        bbox = self.x_values_to_bbox((2, 7))
+        count, page = self.ranking.rank(bbox)
+
+        assert_equal(count, 5)
+        assert_equal(self._titles(page),
+                     ['(2, 7)', '(1, 8)', '(3, 6)', '(0, 9)', '(4, 5)'])
+
+    def test_same_results_as_postgis(self):
+        bbox = self.x_values_to_bbox((2, 7))
+        count, page = self.ranking.rank(bbox, start=1, rows=2)
+        postgis_count, postgis_page = bbox_query_ordered_page(bbox, start=1, rows=2)
+
+        assert_equal(count, postgis_count)
+        assert_equal([package_id for package_id, ranking in page],
+                     [package_id for package_id, ranking in postgis_page])
+        for (package_id, ranking), (_, postgis_ranking) in zip(page, postgis_page):
+            assert abs(ranking - postgis_ranking) < 1e-9
+
+    def test_past_last_page(self):
+        bbox = self.x_values_to_bbox((2, 7))
+        assert_equal(self.ranking.rank(bbox, start=10, rows=2), (5, []))
+
+    def test_no_results(self):
+        bbox = self.x_values_to_bbox((20, 27))
+        assert_equal(self.ranking.rank(bbox), (0, []))
+
+    def test_missing_file(self):
+        os.remove(os.path.join(self.directory, FILE_NAME))
+        bbox = self.x_values_to_bbox((2, 7))
+
+        # Written on the background, PostGIS is used meanwhile
+        assert_equal(self.ranking.rank(bbox), None)
+        self.ranking._writer.join()
+
+        assert os.path.exists(os.path.join(self.directory, FILE_NAME))
+        assert_equal(self.ranking.rank(bbox)[0], 5)
+
+    def test_outdated_file(self):
+        bbox = self.x_values_to_bbox((2, 7))
+        assert_equal(self.ranking.rank(bbox)[0], 5)
+
+        extents_changed()
+
+        assert_equal(self.ranking.rank(bbox), None)
+        self.ranking._writer.join()
+        assert_equal(self.ranking.rank(bbox)[0], 5)
+
+    def test_no_background_writes(self):
+        ranking = EnvelopeRanking(self.directory, write_in_background=False)
+        bbox = self.x_values_to_bbox((2, 7))
+        assert_equal(ranking.rank(bbox)[0], 5)
+
+        extents_changed()
+
+        # PostGIS is used until the file is written by the command
+        assert_equal(ranking.rank(bbox), None)
+        assert ranking._writer is None
+        write_envelopes(self.directory)
+        assert_equal(ranking.rank(bbox)[0], 5)
@@ -7,12 +7,21 @@ from shapely.geometry import asShape
 
 from ckan import model
 from ckan import plugins
+from ckan.lib.base import config
 from ckan.lib.helpers import json
 from ckan.logic.action.create import package_create
 from ckan.lib.munge import munge_title_to_name
+try:
+    import ckan.new_tests.factories as factories
+except ImportError:
+    import ckan.tests.factories as factories
 
 from ckanext.spatial.model import PackageExtent
-from ckanext.spatial.lib import validate_bbox, bbox_query, bbox_query_ordered
+from ckanext.spatial.lib import (validate_bbox, bbox_query, bbox_query_ordered,
+                                 bbox_query_ordered_page,
+                                 save_package_extents, geometry_fingerprint,
+                                 simplify_package_extents)
+from ckanext.spatial.lib.query_cache import get_cache
 from ckanext.spatial.geoalchemy_common import WKTElement, compare_geometry_fields
 from ckanext.spatial.tests.base import SpatialTestBase
 
@@ -42,6 +51,82 @@ class TestCompareGeometries(SpatialTestBase):
 
 
 
+class TestSavePackageExtents(SpatialTestBase):
+
+    def _get_geometry_type(self, package_id):
+        return model.Session.execute(
+            'SELECT ST_GeometryType(the_geom) FROM package_extent WHERE package_id = :id',
+            {'id': package_id}).scalar()
+
+    def test_insert_update_and_delete(self):
+        package_ids = [factories.Dataset()['id'] for i in range(3)]
+
+        save_package_extents([
+            (package_ids[0], json.loads(self.geojson_examples['point']), None),
+            (package_ids[1], json.loads(self.geojson_examples['polygon']), None),
+            (package_ids[2], json.loads(self.geojson_examples['line']), None),
+        ], chunk_size=2)
+
+        assert_equal(self._get_geometry_type(package_ids[0]), 'ST_Point')
+        assert_equal(self._get_geometry_type(package_ids[1]), 'ST_Polygon')
+        assert_equal(self._get_geometry_type(package_ids[2]), 'ST_LineString')
+
+        save_package_extents([
+            (package_ids[0], json.loads(self.geojson_examples['polygon']), None),
+            (package_ids[1], json.loads(self.geojson_examples['polygon']), None),
+            (package_ids[2], None, None),
+        ])
+
+        assert_equal(self._get_geometry_type(package_ids[0]), 'ST_Polygon')
+        assert_equal(self._get_geometry_type(package_ids[1]), 'ST_Polygon')
+        assert_equal(self._get_geometry_type(package_ids[2]), None)
+
+    def test_envelope_columns(self):
+        package_id = factories.Dataset()['id']
+
+        save_package_extents([
+            (package_id, json.loads(self.geojson_examples['multipolygon']), None)])
+
+        envelope = model.Session.execute(
+            '''SELECT minx, miny, maxx, maxy, area FROM package_extent
+               WHERE package_id = :id''', {'id': package_id}).first()
+        assert_equal(tuple(envelope), (100.0, 0.0, 103.0, 3.0, 9.0))
+
+    def test_unchanged_extents_are_skipped(self):
+        package_id = factories.Dataset()['id']
+        geometry = json.loads(self.geojson_examples['point'])
+
+        save_package_extents([(package_id, geometry, None)])
+
+        fingerprint = model.Session.execute(
+            'SELECT geom_fingerprint FROM package_extent WHERE package_id = :id',
+            {'id': package_id}).scalar()
+        assert_equal(fingerprint,
+                     geometry_fingerprint(asShape(geometry), self.db_srid))
+
+        # Saving the same geometry again doesn't change anything
+        generation = get_cache().generation
+        save_package_extents([(package_id, geometry, None)])
+        assert_equal(get_cache().generation, generation)
+
+        # Geometries changed on the database directly are rewritten when
+        # forcing it
+        model.Session.execute(
+            "UPDATE package_extent SET the_geom = ST_GeomFromText('POINT(1 1)', 4326) "
+            "WHERE package_id = :id", {'id': package_id})
+        save_package_extents([(package_id, geometry, None)], force=True)
+        assert_equal(model.Session.execute(
+            'SELECT ST_X(the_geom) FROM package_extent WHERE package_id = :id',
+            {'id': package_id}).scalar(), geometry['coordinates'][0])
+
+        # Any change in the geometry is written
+        geometry['coordinates'][1] += 0.000001
+        save_package_extents([(package_id, geometry, None)])
+        assert_equal(model.Session.execute(
+            'SELECT ST_Y(the_geom) FROM package_extent WHERE package_id = :id',
+            {'id': package_id}).scalar(), geometry['coordinates'][1])
+
+
 class TestValidateBbox:
     bbox_dict = {'minx': -4.96,
                  'miny': 55.70,
@@ -129,6 +214,31 @@ class TestBboxQueryOrdered(SpatialQueryTestBase):
         assert_equal(package_titles,
                      ['(2, 7)', '(1, 8)', '(3, 6)', '(0, 9)', '(4, 5)'])
 
+    def test_query_exact_geometry_ranking(self):
+        config['ckanext.spatial.use_exact_geometry_ranking'] = 'true'
+        try:
+            bbox_dict = self.x_values_to_bbox((2, 7))
+            q = bbox_query_ordered(bbox_dict)
+        finally:
+            del config['ckanext.spatial.use_exact_geometry_ranking']
+        package_titles = [model.Package.get(res.package_id).title for res in q]
+        assert_equal(package_titles,
+                     ['(2, 7)', '(1, 8)', '(3, 6)', '(0, 9)', '(4, 5)'])
+
+    def test_query_page(self):
+        bbox_dict = self.x_values_to_bbox((2, 7))
+
+        count, page = bbox_query_ordered_page(bbox_dict, start=1, rows=2)
+        assert_equal(count, 5)
+        assert_equal([model.Package.get(package_id).title
+                      for package_id, spatial_ranking in page],
+                     ['(1, 8)', '(3, 6)'])
+        assert page[0][1] > page[1][1]
+
+        # The count is returned past the last page
+        assert_equal(bbox_query_ordered_page(bbox_dict, start=10, rows=2),
+                     (5, []))
+
 
 class TestBboxQueryPerformance(SpatialQueryTestBase):
     # x values for the fixtures
@@ -147,3 +257,111 @@ class TestBboxQueryPerformance(SpatialQueryTestBase):
         q = bbox_query_ordered(bbox_dict)
         t1 = time.time()
         print 'bbox_query_ordered took: ', t1-t0
+
+
+def complex_polygon(miny, num_points, amplitude):
+    '''
+    Returns a 10x10 square polygon starting at (0, miny), with a right edge
+    made of `num_points` points zigzagging `amplitude` units to the right.
+    '''
+    right_edge = [[10 + (amplitude if i % 2 else 0), miny + 10.0 * i / num_points]
+                  for i in xrange(num_points)]
+    return {'type': 'Polygon',
+            'coordinates': [[[0, miny]] + right_edge +
+                            [[10, miny + 10], [0, miny + 10], [0, miny]]]}
+
+
+class TestSimplifiedExtents(SpatialTestBase):
+
+    def _get_simplified(self, package_id):
+        return model.Session.execute(
+            '''SELECT ST_NPoints(the_geom), ST_NPoints(the_geom_simplified),
+                      simplify_tolerance
+               FROM package_extent WHERE package_id = :id''',
+            {'id': package_id}).first()
+
+    def _query(self, minx):
+        bbox = {'minx': minx, 'maxx': minx + 1, 'miny': 2, 'maxy': 3}
+        return [extent.package_id for extent in bbox_query(bbox)]
+
+    def test_simplified_geometries(self):
+        package_ids = [factories.Dataset()['id'] for i in range(2)]
+
+        save_package_extents([
+            (package_ids[0], complex_polygon(0, 1000, 0.005), None),
+            (package_ids[1], json.loads(self.geojson_examples['polygon']), None),
+        ])
+
+        points, simplified_points, tolerance = self._get_simplified(package_ids[0])
+        assert_equal(points, 1004)
+        assert_equal(simplified_points, 5)
+        assert_equal(tolerance, 0.01)
+
+        # Geometries that can't be simplified are not stored twice
+        points, simplified_points, tolerance = self._get_simplified(package_ids[1])
+        assert_equal(simplified_points, None)
+
+    def test_boundary_cases(self):
+        package_id = factories.Dataset()['id']
+        save_package_extents([(package_id, complex_polygon(0, 1000, 0.005), None)])
+        assert_equal(self._get_simplified(package_id)[1], 5)
+
+        # Contains the extent bounding box
+        bbox = {'minx': -1, 'maxx': 11, 'miny': -1, 'maxy': 11}
+        assert_equal([e.package_id for e in bbox_query(bbox)], [package_id])
+        # Intersects the simplified geometry
+        assert_equal(self._query(9.9), [package_id])
+        # Only intersects the zigzag of the full geometry
+        assert_equal(self._query(10.003), [package_id])
+        # Within the tolerance, but does not intersect the full geometry
+        assert_equal(self._query(10.007), [])
+        # Further than the tolerance
+        assert_equal(self._query(10.1), [])
+
+    def test_simplify_package_extents(self):
+        package_id = factories.Dataset()['id']
+        save_package_extents([(package_id, complex_polygon(0, 1000, 0.005), None)])
+
+        assert_equal(simplify_package_extents([package_id], 0), 0)
+        assert_equal(self._get_simplified(package_id)[1:], (None, None))
+        assert_equal(self._query(10.003), [package_id])
+
+        assert_equal(simplify_package_extents([package_id], 0.02), 1)
+        assert_equal(self._get_simplified(package_id)[2], 0.02)
+        assert_equal(self._query(10.003), [package_id])
+        assert_equal(self._query(10.007), [])
+
+
+class TestSimplifiedExtentsSameResults(SpatialTestBase):
+
+    num_packages = 5
+    num_points = 500
+
+    @classmethod
+    def setup_class(cls):
+        SpatialTestBase.setup_class()
+        cls.package_ids = [factories.Dataset()['id']
+                           for i in xrange(cls.num_packages)]
+        save_package_extents(
+            [(package_id, complex_polygon(i * 0.1, cls.num_points, 0.005), None)
+             for i, package_id in enumerate(cls.package_ids)])
+
+    def _query(self, bbox):
+        return sorted(extent.package_id for extent in bbox_query(bbox))
+
+    def test_query(self):
+        # Boxes crossing the complex edge of all the polygons, on their
+        # boundary and outside them
+        bboxes = [{'minx': 9, 'maxx': 11, 'miny': 0, 'maxy': 10},
+                  {'minx': 10.003, 'maxx': 11, 'miny': 0, 'maxy': 10},
+                  {'minx': 10.007, 'maxx': 11, 'miny': 0, 'maxy': 10},
+                  {'minx': 2, 'maxx': 3, 'miny': 10.25, 'maxy': 11}]
+
+        simplified = [self._query(bbox) for bbox in bboxes]
+        simplify_package_extents(self.package_ids, 0)
+        full = [self._query(bbox) for bbox in bboxes]
+        simplify_package_extents(self.package_ids)
+
+        assert_equal(simplified, full)
+        assert_equal(full[0], sorted(self.package_ids))
+        assert_equal(full[2], [])
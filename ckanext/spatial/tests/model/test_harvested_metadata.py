@@ -2,7 +2,7 @@ import os
 
 from nose.tools import assert_equal
 
-from ckanext.spatial.model import ISODocument
+from ckanext.spatial.model import ISODocument, parse_xml_string
 
 def open_xml_fixture(xml_filename):
     xml_filepath = os.path.join(os.path.dirname(__file__),
@@ -32,3 +32,24 @@ def test_multiplicity_warning():
     iso_document = ISODocument(xml_string)
     iso_values = iso_document.read_values()
     assert_equal(iso_values['guid'], 'B8A22DF4-B0DC-4F0B-A713-0CF5F8784A28')
+
+def test_shared_xml_tree():
+    xml_string = open_xml_fixture('gemini_dataset.xml')
+    # Harvest objects content is unicode, with the original declaration
+    xml_tree = parse_xml_string(xml_string.decode('utf8'))
+    iso_document = ISODocument(xml_string, xml_tree=xml_tree)
+    iso_values = iso_document.read_values()
+    assert iso_document.xml_tree is xml_tree
+    assert_equal(iso_values, ISODocument(xml_string).read_values())
+
+def test_compiled_xpaths_are_reused():
+    xml_string = open_xml_fixture('gemini_dataset.xml')
+    ISODocument(xml_string).read_values()
+
+    guid_element = [e for e in ISODocument.elements if e.name == 'guid'][0]
+    xpath = guid_element.get_search_paths()[0]
+    compiled = guid_element.get_compiled_xpath(xpath)
+
+    iso_values = ISODocument(xml_string).read_values()
+    assert guid_element.get_compiled_xpath(xpath) is compiled
+    assert_equal(iso_values['guid'], 'test-dataset-1')
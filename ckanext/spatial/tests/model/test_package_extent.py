@@ -1,4 +1,4 @@
-from nose.tools import assert_equals
+from nose.tools import assert_equals, assert_raises
 from shapely.geometry import asShape
 
 from ckan.model import Session
@@ -9,6 +9,7 @@ except ImportError:
     import ckan.tests.factories as factories
 
 from ckanext.spatial.model import PackageExtent
+from ckanext.spatial.model.package_extent import setup, migrate
 from ckanext.spatial.geoalchemy_common import WKTElement, legacy_geoalchemy
 from ckanext.spatial.tests.base import SpatialTestBase
 
@@ -88,3 +89,23 @@ class TestPackageExtent(SpatialTestBase):
                     func.ST_GeometryType(package_extent.the_geom)).first()[0],
                 'ST_Polygon')
             assert_equals(package_extent.the_geom.srid, self.db_srid)
+
+
+class TestMigrate(SpatialTestBase):
+
+    def test_migrate(self):
+        Session.execute('''ALTER TABLE package_extent
+                           DROP COLUMN minx, DROP COLUMN the_geom_simplified''')
+        Session.commit()
+        try:
+            # The model can not be used until the columns are added
+            assert_raises(Exception, setup)
+
+            assert_equals(sorted(migrate()), ['minx', 'the_geom_simplified'])
+            setup()
+        finally:
+            migrate()
+
+        assert_equals(Session.execute(
+            "SELECT Find_SRID('public', 'package_extent', 'the_geom_simplified')"
+        ).scalar(), self.db_srid)
@@ -1,7 +1,9 @@
 from nose.plugins.skip import SkipTest
 from nose.tools import assert_equals, assert_raises
 
+from ckan import plugins
 from ckan.model import Session
+from ckan.lib.base import config
 from ckan.lib.search import SearchError
 try:
     import ckan.new_tests.helpers as helpers
@@ -10,6 +12,7 @@ except ImportError:
     import ckan.tests.helpers as helpers
     import ckan.tests.factories as factories
 
+from ckanext.spatial.lib.query_cache import extents_changed, get_cache
 from ckanext.spatial.tests.base import SpatialTestBase
 
 extents = {
@@ -169,6 +172,124 @@ class TestAction(SpatialTestBase):
         assert_equals(result['count'], 1)
         assert_equals(result['results'][0]['id'], dataset['id'])
 
+    def test_spatial_query_many_datasets(self):
+        # More than the ids on each clause of the Solr filter
+        plugin = plugins.get_plugin('spatial_query')
+        ids = [str(i) for i in range(2500)]
+
+        ids_filter = plugin._ids_filter(ids)
+        assert_equals(ids_filter.count('id:('), 3)
+        assert_equals(ids_filter.count(' OR '), 2499)
+
+        datasets = [factories.Dataset(
+            extras=[{'key': 'spatial',
+                     'value': self.geojson_examples['point']}])
+            for i in range(3)]
+
+        result = helpers.call_action(
+            'package_search',
+            extras={'ext_bbox': '-180,-90,180,90'})
+
+        assert_equals(result['count'], 3)
+        assert_equals(set(r['id'] for r in result['results']),
+                      set(d['id'] for d in datasets))
+
+    def test_spatial_query_complement_plan(self):
+        config['ckanext.spatial.planner.complement_threshold'] = '0'
+        try:
+            dataset = factories.Dataset(
+                extras=[{'key': 'spatial',
+                         'value': extents['nz']}]
+            )
+            factories.Dataset(
+                extras=[{'key': 'spatial',
+                         'value': extents['ohio']}]
+            )
+            factories.Dataset()
+
+            result = helpers.call_action(
+                'package_search',
+                extras={'ext_bbox': '56,-54,189,-28'})
+        finally:
+            del config['ckanext.spatial.planner.complement_threshold']
+
+        assert_equals(result['count'], 1)
+        assert_equals(result['results'][0]['id'], dataset['id'])
+
+    def test_spatial_query_all_plan(self):
+        datasets = [factories.Dataset(
+            extras=[{'key': 'spatial',
+                     'value': extents[key]}])
+            for key in ('nz', 'ohio')]
+        factories.Dataset()
+
+        result = helpers.call_action(
+            'package_search',
+            extras={'ext_bbox': '-180,-90,180,90'})
+
+        assert_equals(result['count'], 2)
+        assert_equals(set(r['id'] for r in result['results']),
+                      set(d['id'] for d in datasets))
+
+    def test_spatial_query_all_plan_without_extent(self):
+        datasets = [factories.Dataset(
+            extras=[{'key': 'spatial',
+                     'value': extents[key]}])
+            for key in ('nz', 'ohio')]
+
+        # Eg the geometry could not be stored when harvesting
+        Session.execute('DELETE FROM package_extent WHERE package_id = :id',
+                        {'id': datasets[1]['id']})
+        extents_changed()
+        Session.commit()
+
+        result = helpers.call_action(
+            'package_search',
+            extras={'ext_bbox': '-180,-90,180,90'})
+
+        assert_equals(result['count'], 1)
+        assert_equals(result['results'][0]['id'], datasets[0]['id'])
+
+    def test_query_cache_reset_on_state_change(self):
+        dataset = factories.Dataset(
+            extras=[{'key': 'spatial', 'value': extents['nz']}])
+        generation = get_cache().generation
+
+        # Updates that keep the extent and the state keep the cached results
+        dataset['title'] = 'Updated'
+        dataset = helpers.call_action('package_update', **dataset)
+        assert_equals(get_cache().generation, generation)
+
+        dataset['state'] = 'draft'
+        helpers.call_action('package_update', **dataset)
+        assert get_cache().generation > generation
+
+    def test_spatial_sort_facets_cover_all_results(self):
+        # Solr is filtered by all the matching datasets, so the count and
+        # facets cover the whole result set, not just the requested page
+        def bbox_geojson(minx, miny, maxx, maxy):
+            return ('{"type":"Polygon","coordinates":[[[%s,%s],[%s,%s],[%s,%s],'
+                    '[%s,%s],[%s,%s]]]}' % (minx, miny, maxx, miny, maxx, maxy,
+                                           minx, maxy, minx, miny))
+
+        datasets = [factories.Dataset(
+            tags=[{'name': 'shared'}],
+            extras=[{'key': 'spatial',
+                     'value': bbox_geojson(174 - i, -40 - i, 176 + i, -38 + i)}])
+            for i in range(3)]
+
+        config['ckanext.spatial.use_postgis_sorting'] = 'true'
+        try:
+            result = helpers.call_action(
+                'package_search', q='', fq='', sort='spatial desc', rows=1,
+                extras={'ext_bbox': '174,-40,176,-38'},
+                **{'facet.field': ['tags']})
+        finally:
+            del config['ckanext.spatial.use_postgis_sorting']
+
+        assert_equals(result['count'], 3)
+        assert_equals([r['id'] for r in result['results']], [datasets[0]['id']])
+        assert_equals(result['facets']['tags'], {'shared': 3})
 
 
 class TestHarvestedMetadataAPI(SpatialTestBase, helpers.FunctionalTestBase):
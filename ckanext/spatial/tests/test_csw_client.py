@@ -1,12 +1,21 @@
 import time
 from urllib2 import urlopen
 import os
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from threading import Thread
 
 from pylons import config
 from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+from owslib.csw import CatalogueServiceWeb
 
 from ckan.model import engine_is_sqlite
 
+from ckanext.spatial.lib.csw_client import (PooledCatalogueServiceWeb,
+                                            get_csw_service)
+
 # copied from ckan/tests/__init__ to save importing it and therefore
 # setting up Pylons.
 class CkanServerCase:
@@ -64,3 +73,119 @@ class CkanProcess(CkanServerCase):
     def teardown_class(cls):
         cls._stop_ckan_server(cls.pid)
 
+
+def _md_metadata(identifier):
+    return ('''<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd"
+                 xmlns:gco="http://www.isotc211.org/2005/gco">
+      <gmd:fileIdentifier>
+        <gco:CharacterString>%s</gco:CharacterString>
+      </gmd:fileIdentifier>
+    </gmd:MD_Metadata>''' % identifier)
+
+CSW_RESPONSES = {
+    'GetRecords': '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" version="2.0.2">
+  <csw:SearchStatus timestamp="2014-01-01T00:00:00Z"/>
+  <csw:SearchResults numberOfRecordsMatched="2" numberOfRecordsReturned="2"
+                     nextRecord="0" recordSchema="http://www.isotc211.org/2005/gmd"
+                     elementSet="brief">
+    %s
+    %s
+  </csw:SearchResults>
+</csw:GetRecordsResponse>''' % (_md_metadata('record-1'), _md_metadata('record-2')),
+    'GetRecordById': '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordByIdResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2">
+  %s
+</csw:GetRecordByIdResponse>''' % _md_metadata('record-1'),
+}
+
+
+class StubCswHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Answers GetRecords (POST) and GetRecordById (GET) requests with fixed
+    responses, logging the requests and the client port they came from.
+    '''
+    # Allow keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, operation):
+        self.server.requests.append((operation, self.client_address[1]))
+        body = CSW_RESPONSES[operation]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        self._respond(query['request'][0])
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self._respond('GetRecords')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPooledCswClient(object):
+    '''
+    PooledCatalogueServiceWeb reimplements the request handling of the
+    OWSLib client, so check that it gives the same results.
+    '''
+
+    @classmethod
+    def setup_class(cls):
+        class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        cls.server = StubServer(('127.0.0.1', 0), StubCswHandler)
+        cls.server.requests = []
+        cls.url = 'http://127.0.0.1:%i/csw' % cls.server.server_address[1]
+        thread = Thread(target=cls.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+
+    def setup(self):
+        del self.server.requests[:]
+
+    def test_getrecords2(self):
+        kwargs = {'esn': 'brief', 'startposition': 0, 'maxrecords': 10,
+                  'outputschema': 'http://www.isotc211.org/2005/gmd'}
+        pooled = PooledCatalogueServiceWeb(self.url, skip_caps=True)
+        pooled.getrecords2(**kwargs)
+        owslib = CatalogueServiceWeb(self.url, skip_caps=True)
+        owslib.getrecords2(**kwargs)
+
+        assert_equal(sorted(pooled.records.keys()), ['record-1', 'record-2'])
+        assert_equal(sorted(pooled.records.keys()), sorted(owslib.records.keys()))
+        assert_equal(pooled.results, owslib.results)
+        assert_equal(pooled.exceptionreport, owslib.exceptionreport)
+
+    def test_getrecordbyid(self):
+        outputschema = 'http://www.isotc211.org/2005/gmd'
+        pooled = PooledCatalogueServiceWeb(self.url, skip_caps=True)
+        pooled.getrecordbyid(['record-1'], outputschema=outputschema)
+        owslib = CatalogueServiceWeb(self.url, skip_caps=True)
+        owslib.getrecordbyid(['record-1'], outputschema=outputschema)
+
+        assert_equal(pooled.records.keys(), ['record-1'])
+        assert_equal(pooled.records.keys(), owslib.records.keys())
+        assert_equal(pooled.response, owslib.response)
+
+    def test_connections_reused(self):
+        service = get_csw_service(self.url, skip_caps=True)
+        assert_equal(list(service.getidentifiers(page=10)), ['record-1', 'record-2'])
+        record = get_csw_service(self.url, skip_caps=True).getrecordbyid(['record-1'])
+
+        assert 'record-1' in record['xml']
+        operations = [operation for operation, port in self.server.requests]
+        assert_equal(operations, ['GetRecords', 'GetRecordById'])
+        # Both requests were sent on the same connection
+        assert_equal(len(set(port for operation, port in self.server.requests)), 1)
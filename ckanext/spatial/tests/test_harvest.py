@@ -4,6 +4,7 @@ from nose.plugins.skip import SkipTest
 from nose.tools import assert_equal, assert_in, assert_raises
 
 from ckan.lib.base import config
+from ckan.lib.helpers import json
 from ckan import model
 from ckan.model import Session, Package
 from ckan.logic.schema import default_update_package_schema
@@ -14,6 +15,8 @@ from ckanext.spatial.harvesters.gemini import (GeminiDocHarvester,
                                                GeminiWafHarvester,
                                                GeminiHarvester)
 from ckanext.spatial.harvesters.base import SpatialHarvester
+from ckanext.spatial.harvesters.csw import CSWHarvester
+from ckanext.spatial.harvesters.writer import HarvestObjectWriter
 from ckanext.spatial.tests.base import SpatialTestBase
 
 from xml_file_server import serve
@@ -845,6 +848,125 @@ class TestGatherMethods(HarvestFixtureBase):
         content = ''
         assert_raises(lxml.etree.XMLSyntaxError, self.harvester.get_gemini_string_and_guid, content)
 
+class HarvestSourceFixtureBase(HarvestFixtureBase):
+    '''
+    Creates a harvest source and a job for it (`self.source` and
+    `self.job`) for each test.
+    '''
+    def setup(self):
+        HarvestFixtureBase.setup(self)
+        source_fixture = {
+            'title': 'Test Source',
+            'name': 'test-source',
+            'url': u'http://127.0.0.1:8999/gemini2.1/dataset1.xml',
+            'source_type': u'gemini-single'
+        }
+        self.source, self.job = self._create_source_and_job(source_fixture)
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+
+class TestHarvestObjectWriter(HarvestSourceFixtureBase):
+
+    def test_objects_and_extras(self):
+        writer = HarvestObjectWriter(self.job, chunk_size=2)
+        added = [writer.add(u'guid-%s' % i, 'new', extras={'waf_location': u'url-%s' % i})
+                 for i in range(5)]
+        ids = writer.finish()
+
+        assert_equal(ids, added)
+        for i, id in enumerate(ids):
+            obj = HarvestObject.get(id)
+            assert_equal(obj.guid, u'guid-%s' % i)
+            assert_equal(obj.harvest_job_id, self.job.id)
+            assert_equal(obj.harvest_source_id, self.source.id)
+            assert_equal(obj.state, u'WAITING')
+            extras = dict((e.key, e.value) for e in obj.extras)
+            assert_equal(extras, {'status': u'new', 'waf_location': u'url-%s' % i})
+
+    def test_delete_unsets_current(self):
+        previous = HarvestObject(guid=u'guid-1', job=self.job, current=True)
+        previous.save()
+
+        writer = HarvestObjectWriter(self.job)
+        id = writer.add(u'guid-1', 'delete')
+        writer.finish()
+
+        Session.remove()
+        assert not HarvestObject.get(previous.id).current
+        assert not HarvestObject.get(id).current
+
+class TestCswBatchClaim(HarvestSourceFixtureBase):
+    def setup(self):
+        HarvestSourceFixtureBase.setup(self)
+
+        writer = HarvestObjectWriter(self.job)
+        self.ids = [writer.add(u'guid-%s' % i, 'new') for i in range(6)]
+        writer.add(u'guid-deleted', 'delete')
+        writer.finish()
+
+    def test_objects_claimed_once(self):
+        harvester = CSWHarvester()
+        first = HarvestObject.get(self.ids[0])
+
+        claimed = harvester._claim_objects(first, 3)
+        claimed_again = harvester._claim_objects(first, 10)
+
+        claimed_ids = [obj.id for obj in claimed]
+        claimed_again_ids = [obj.id for obj in claimed_again]
+        assert_equal(len(claimed_ids), 3)
+        assert_equal(len(claimed_again_ids), 2)
+        assert_equal(sorted(claimed_ids + claimed_again_ids), sorted(self.ids[1:]))
+        for obj in claimed + claimed_again:
+            assert_equal(obj.state, u'FETCH')
+
+    def test_release_objects(self):
+        harvester = CSWHarvester()
+        first = HarvestObject.get(self.ids[0])
+        claimed = harvester._claim_objects(first, 5)
+
+        harvester._release_objects(claimed)
+
+        Session.remove()
+        for id in self.ids[1:]:
+            assert_equal(HarvestObject.get(id).state, u'WAITING')
+
+class TestCswIncremental(HarvestSourceFixtureBase):
+
+    def _add_object(self, guid, gathered, **kwargs):
+        HarvestObject(guid=guid, job=self.job, gathered=gathered, **kwargs).save()
+
+    def test_failed_guids(self):
+        # Failed after the current object, on any job
+        self._add_object(u'guid-1', datetime(2014, 1, 1), current=True)
+        self._add_object(u'guid-1', datetime(2014, 2, 1), state=u'ERROR')
+        self._add_object(u'guid-1', datetime(2014, 3, 1), state=u'COMPLETE')
+        # Imported successfully after failing
+        self._add_object(u'guid-2', datetime(2014, 1, 1), state=u'ERROR')
+        self._add_object(u'guid-2', datetime(2014, 2, 1), current=True)
+        # Never failed
+        self._add_object(u'guid-3', datetime(2014, 1, 1), current=True)
+
+        assert_equal(CSWHarvester()._get_failed_guids(self.job), set([u'guid-1']))
+
+class TestSourceHash(HarvestSourceFixtureBase):
+
+    def test_source_hash_changes_with_config(self):
+        harvester = SpatialHarvester()
+        obj = HarvestObject(guid=u'guid-1', job=self.job, source=self.source)
+        obj.save()
+
+        source_hash = harvester._get_source_hash(obj)
+        assert_equal(harvester._get_source_hash(obj), source_hash)
+        assert_equal(harvester._get_object_extra(obj, 'source_hash'), source_hash)
+
+        self.source.config = json.dumps({'default_tags': ['new-tag']})
+        self.source.save()
+
+        assert harvester._get_source_hash(obj) != source_hash
+
+
 class TestImportStageTools:
     def test_licence_url_normal(self):
         assert_equal(GeminiHarvester._extract_first_licence_url(
@@ -151,3 +151,17 @@ class TestValidation:
         message, line = errors[1]
         assert 'This element is not expected' in message
         assert line == 3
+
+    def test_compiled_schemas_are_reused(self):
+        xsd_filepath = validation.ISO19139Schema.get_xsd_filepaths()[0]
+
+        validation.ISO19139Schema.warm_up()
+        schema = validation.get_schema(xsd_filepath)
+
+        assert schema is validation.get_schema(xsd_filepath)
+
+        # Validation keeps working with the cached schema
+        errors = self.get_validation_errors(validation.ISO19139Schema,
+                                            'iso19139/dataset.xml')
+        assert_equal(errors, '')
+        assert schema is validation.get_schema(xsd_filepath)
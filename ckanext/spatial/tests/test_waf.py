@@ -0,0 +1,128 @@
+import os
+
+from nose.tools import assert_equal
+
+from ckanext.spatial.harvesters.waf import (_extract_waf, _get_scraper,
+                                            WAFCrawler)
+
+from xml_file_server import serve
+
+# Start simple HTTP server that serves XML test files
+serve()
+
+BASE_URL = 'http://waf.example.com/waf/'
+
+EXPECTED_DATES = [
+    (BASE_URL + 'dataset1.xml', '2014-01-10 10:23:00'),
+    (BASE_URL + 'dataset2.xml', '2014-02-21 17:05:00'),
+    (BASE_URL + 'service1.xml', '2014-03-01 08:45:00'),
+]
+
+EXPECTED_NO_DATES = [(url, '') for url, date in EXPECTED_DATES]
+
+
+def open_listing_fixture(file_name):
+    file_path = os.path.join(os.path.dirname(__file__), 'xml', 'waf',
+                             file_name)
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def test_get_scraper():
+    assert_equal(_get_scraper(None), 'apache')
+    assert_equal(_get_scraper('Apache/2.2.22 (Ubuntu)'), 'apache')
+    assert_equal(_get_scraper('Microsoft-IIS/7.5'), 'iis')
+    assert_equal(_get_scraper('nginx/1.4.6'), 'other')
+
+
+def test_extract_apache():
+    content = open_listing_fixture('apache.html')
+    assert_equal(_extract_waf(content, BASE_URL, 'apache'), EXPECTED_DATES)
+
+
+def test_extract_apache_pre():
+    content = open_listing_fixture('apache-pre.html')
+    assert_equal(_extract_waf(content, BASE_URL, 'apache'), EXPECTED_DATES)
+
+
+def test_extract_iis():
+    content = open_listing_fixture('iis.html')
+    assert_equal(_extract_waf(content, BASE_URL, 'iis'), EXPECTED_DATES)
+
+
+def test_extract_other():
+    content = open_listing_fixture('other.html')
+    assert_equal(_extract_waf(content, BASE_URL, 'other'), EXPECTED_NO_DATES)
+
+
+def test_extract_falls_back_to_other():
+    # Apache listing served by a server reported as IIS
+    content = open_listing_fixture('apache.html')
+    assert_equal(_extract_waf(content, BASE_URL, 'iis'), EXPECTED_NO_DATES)
+
+
+def test_extract_index_page_url():
+    content = open_listing_fixture('apache.html')
+    assert_equal(_extract_waf(content, BASE_URL + 'index.html', 'apache'),
+                 EXPECTED_DATES)
+
+
+def _large_listing(scraper, num_files):
+    if scraper == 'apache':
+        row = ('<tr><td valign="top"><img src="/icons/text.gif" alt="[TXT]"></td>'
+               '<td><a href="dataset{0}.xml">dataset{0}.xml</a></td>'
+               '<td align="right">2014-01-10 10:23  </td>'
+               '<td align="right"> 12K</td><td>&nbsp;</td></tr>\n')
+        return '<html><body><table>{0}</table></body></html>'.format(
+            ''.join(row.format(i) for i in xrange(num_files)))
+    elif scraper == 'iis':
+        row = (' 1/10/2014 10:23 AM        12288 '
+               '<A HREF="/waf/dataset{0}.xml">dataset{0}.xml</A><br>')
+        return '<pre><A HREF="/">[To Parent Directory]</A><br><br>{0}</pre>'.format(
+            ''.join(row.format(i) for i in xrange(num_files)))
+    else:
+        row = ('<a href="dataset{0}.xml">dataset{0}.xml</a>'
+               '      10-Jan-2014 10:23    12288\n')
+        return '<pre><a href="../">../</a>\n{0}</pre>'.format(
+            ''.join(row.format(i) for i in xrange(num_files)))
+
+
+def test_extract_large_listings():
+    num_files = 3000
+    for scraper in ('apache', 'iis', 'other'):
+        content = _large_listing(scraper, num_files)
+
+        results = _extract_waf(content, BASE_URL, scraper)
+
+        assert_equal(len(results), num_files)
+        assert_equal(results[0][0], BASE_URL + 'dataset0.xml')
+        assert_equal(results[-1][0], BASE_URL + 'dataset%s.xml' % (num_files - 1))
+
+
+def test_crawl_subfolders():
+    url = 'http://127.0.0.1:8999/waf-tree/'
+    crawler = WAFCrawler(max_workers=2)
+    content = crawler.get(url).content
+
+    results = crawler.crawl(content, url, 'other')
+
+    assert_equal(sorted(results), [
+        (url + 'dataset1.xml', ''),
+        (url + 'sub1/dataset2.xml', ''),
+        (url + 'sub1/sub2/dataset3.xml', ''),
+        (url + 'sub3/dataset4.xml', ''),
+    ])
+
+
+def test_crawl_max_depth():
+    url = 'http://127.0.0.1:8999/waf-tree/'
+    crawler = WAFCrawler(max_depth=0)
+    content = crawler.get(url).content
+
+    results = crawler.crawl(content, url, 'other')
+
+    assert_equal(sorted(results), [
+        (url + 'dataset1.xml', ''),
+        (url + 'sub1/dataset2.xml', ''),
+        (url + 'sub3/dataset4.xml', ''),
+    ])
@@ -7,9 +7,15 @@ from threading import Thread
 
 PORT = 8999
 
+_servers = {}
+
 def serve(port=PORT):
     '''Serves test XML files over HTTP'''
-    
+
+    # Several test modules may start the server
+    if port in _servers:
+        return
+
     # Make sure we serve from the tests' XML directory
     os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                           'xml'))
@@ -19,9 +25,10 @@ def serve(port=PORT):
     class TestServer(SocketServer.TCPServer):
         allow_reuse_address = True
     
-    httpd = TestServer(("", PORT), Handler)
+    httpd = TestServer(("", port), Handler)
+    _servers[port] = httpd
     
-    print 'Serving test HTTP server at port', PORT
+    print 'Serving test HTTP server at port', port
 
     httpd_thread = Thread(target=httpd.serve_forever)
     httpd_thread.setDaemon(True)
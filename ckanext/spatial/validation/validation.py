@@ -1,4 +1,5 @@
 import os
+import threading
 from pkg_resources import resource_stream
 from ckanext.spatial.model import ISODocument
 
@@ -6,6 +7,51 @@ from lxml import etree
 
 log = __import__("logging").getLogger(__name__)
 
+# Compiled XMLSchema objects, keyed by XSD path: {path: (mtime, schema)}
+_compiled_schemas = {}
+_compiled_schemas_lock = threading.Lock()
+
+
+def get_schema(xsd_filepath):
+    '''
+    Returns the compiled etree.XMLSchema for an XSD file.
+
+    Compiling the ISO19139 schema sets takes seconds, so the compiled
+    schemas are kept in a process-wide cache and reused by every validation.
+    The modification time of the XSD file is stored alongside, so an updated
+    file gets recompiled.
+
+    Params:
+      xsd_filepath - full path to the XSD file
+
+    Returns:
+      etree.XMLSchema
+    '''
+    mtime = os.path.getmtime(xsd_filepath)
+    cached = _compiled_schemas.get(xsd_filepath)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with _compiled_schemas_lock:
+        # Another thread may have compiled it while we were waiting
+        cached = _compiled_schemas.get(xsd_filepath)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        log.info('Compiling XSD schema %s', xsd_filepath)
+        xsd = etree.parse(xsd_filepath)
+        # With libxml2 versions before 2.9, this fails with this error:
+        #    gmx_schema = etree.XMLSchema(gmx_xsd)
+        # File "xmlschema.pxi", line 103, in
+        # lxml.etree.XMLSchema.__init__ (src/lxml/lxml.etree.c:116069)
+        # XMLSchemaParseError: local list type: A type, derived by list or
+        # union, must have the simple ur-type definition as base type,
+        # not '{http://www.opengis.net/gml/3.2}doubleList'., line 118
+        schema = etree.XMLSchema(xsd)
+        _compiled_schemas[xsd_filepath] = (mtime, schema)
+
+    return schema
+
 
 class BaseValidator(object):
     '''Base class for a validator.'''
@@ -25,10 +71,32 @@ class BaseValidator(object):
         '''
         raise NotImplementedError
 
+    @classmethod
+    def warm_up(cls):
+        '''
+        Prepares anything expensive the validator needs (eg compiled schemas)
+        so the first call to `is_valid` does not have to. Does nothing by
+        default.
+        '''
+        pass
+
 
 class XsdValidator(BaseValidator):
     '''Base class for validators that use an XSD schema.'''
 
+    @classmethod
+    def get_xsd_filepaths(cls):
+        '''
+        Returns the full paths of the XSD files the validator may use, so
+        they can be compiled in advance by `warm_up`.
+        '''
+        return []
+
+    @classmethod
+    def warm_up(cls):
+        for xsd_filepath in cls.get_xsd_filepaths():
+            get_schema(xsd_filepath)
+
     @classmethod
     def _is_valid(cls, xml, xsd_filepath, xsd_name):
         '''Returns whether or not an XML file is valid according to
@@ -44,15 +112,7 @@ class XsdValidator(BaseValidator):
         Returns:
           (is_valid, [(error_message_string, error_line_number)])
         '''
-        xsd = etree.parse(xsd_filepath)
-        schema = etree.XMLSchema(xsd)
-        # With libxml2 versions before 2.9, this fails with this error:
-        #    gmx_schema = etree.XMLSchema(gmx_xsd)
-        # File "xmlschema.pxi", line 103, in
-        # lxml.etree.XMLSchema.__init__ (src/lxml/lxml.etree.c:116069)
-        # XMLSchemaParseError: local list type: A type, derived by list or
-        # union, must have the simple ur-type definition as base type,
-        # not '{http://www.opengis.net/gml/3.2}doubleList'., line 118
+        schema = get_schema(xsd_filepath)
         try:
             schema.assertValid(xml)
         except etree.DocumentInvalid:
@@ -71,10 +131,14 @@ class ISO19139Schema(XsdValidator):
     title = 'ISO19139 XSD Schema'
 
     @classmethod
-    def is_valid(cls, xml):
+    def get_xsd_filepaths(cls):
         xsd_path = 'xml/iso19139'
-        gmx_xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                        xsd_path, 'gmx/gmx.xsd')
+        return [os.path.join(os.path.dirname(__file__),
+                             xsd_path, 'gmx/gmx.xsd')]
+
+    @classmethod
+    def is_valid(cls, xml):
+        gmx_xsd_filepath = cls.get_xsd_filepaths()[0]
         xsd_name = 'Dataset schema (gmx.xsd)'
         is_valid, errors = cls._is_valid(xml, gmx_xsd_filepath, xsd_name)
         if not is_valid:
@@ -89,14 +153,21 @@ class ISO19139EdenSchema(XsdValidator):
     title = 'ISO19139 XSD Schema (EDEN 2009-03-16)'
 
     @classmethod
-    def is_valid(cls, xml):
+    def get_xsd_filepaths(cls):
         xsd_path = 'xml/iso19139eden'
+        return [
+            os.path.join(os.path.dirname(__file__), xsd_path, 'gmx/gmx.xsd'),
+            os.path.join(os.path.dirname(__file__), xsd_path,
+                         'gmx_and_srv.xsd'),
+        ]
+
+    @classmethod
+    def is_valid(cls, xml):
+        gmx_xsd_filepath, gmx_and_srv_xsd_filepath = cls.get_xsd_filepaths()
 
         metadata_type = cls.get_record_type(xml)
 
         if metadata_type in ('dataset', 'series'):
-            gmx_xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                            xsd_path, 'gmx/gmx.xsd')
             xsd_name = 'Dataset schema (gmx.xsd)'
             is_valid, errors = cls._is_valid(xml, gmx_xsd_filepath, xsd_name)
             if not is_valid:
@@ -105,8 +176,6 @@ class ISO19139EdenSchema(XsdValidator):
                 errors.insert(
                     0, ('{0} Validation Error'.format(xsd_name), None))
         elif metadata_type == 'service':
-            gmx_and_srv_xsd_filepath = os.path.join(
-                os.path.dirname(__file__), xsd_path, 'gmx_and_srv.xsd')
             xsd_name = 'Service schemas (gmx.xsd & srv.xsd)'
             is_valid, errors = cls._is_valid(
                 xml, gmx_and_srv_xsd_filepath, xsd_name)
@@ -153,11 +222,14 @@ class ISO19139NGDCSchema(XsdValidator):
     title = 'ISO19139 XSD Schema (NGDC)'
 
     @classmethod
-    def is_valid(cls, xml):
+    def get_xsd_filepaths(cls):
         xsd_path = 'xml/iso19139ngdc'
+        return [os.path.join(os.path.dirname(__file__),
+                             xsd_path, 'schema.xsd')]
 
-        xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                    xsd_path, 'schema.xsd')
+    @classmethod
+    def is_valid(cls, xml):
+        xsd_filepath = cls.get_xsd_filepaths()[0]
         return cls._is_valid(xml, xsd_filepath, 'NGDC Schema (schema.xsd)')
 
 
@@ -175,11 +247,14 @@ class FGDCSchema(XsdValidator):
     title = 'FGDC XSD Schema'
 
     @classmethod
-    def is_valid(cls, xml):
+    def get_xsd_filepaths(cls):
         xsd_path = 'xml/fgdc'
+        return [os.path.join(os.path.dirname(__file__),
+                             xsd_path, 'fgdc-std-001-1998.xsd')]
 
-        xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                    xsd_path, 'fgdc-std-001-1998.xsd')
+    @classmethod
+    def is_valid(cls, xml):
+        xsd_filepath = cls.get_xsd_filepaths()[0]
         return cls._is_valid(
             xml, xsd_filepath, 'FGDC Schema (fgdc-std-001-1998.xsd)')
 
@@ -209,9 +284,7 @@ class SchematronValidator(BaseValidator):
           (is_valid, [(error_message_string, error_line_number)])
         '''
 
-        if not hasattr(cls, 'schematrons'):
-            log.info('Compiling schematron "%s"', cls.title)
-            cls.schematrons = cls.get_schematrons()
+        cls.warm_up()
         for schematron in cls.schematrons:
             result = schematron(xml)
             errors = []
@@ -231,6 +304,12 @@ class SchematronValidator(BaseValidator):
                 return False, error_details
         return True, []
 
+    @classmethod
+    def warm_up(cls):
+        if not hasattr(cls, 'schematrons'):
+            log.info('Compiling schematron "%s"', cls.title)
+            cls.schematrons = cls.get_schematrons()
+
     @classmethod
     def extract_error_details(cls, failed_assert_element):
         '''Given the XML Element describing a schematron test failure,
@@ -340,6 +419,17 @@ class Validators(object):
     def add_validator(self, validator_class):
             self.validators[validator_class.name] = validator_class
 
+    def warm_up(self):
+        '''
+        Compiles the schemas and schematrons of all the selected profiles,
+        so this cost is paid once when the worker starts rather than on the
+        first validated document.
+        '''
+        for name in self.profiles:
+            validator = self.validators[name]
+            if hasattr(validator, 'warm_up'):
+                validator.warm_up()
+
     def isvalid(self, xml):
         '''For backward compatibility'''
         return self.is_valid(xml)